@@ -26,6 +26,8 @@ FRONTEND_URL = 'http://localhost:5173'
 
 os.environ['PATH'] = r'C:\msys64\mingw64\bin' + ';' + os.environ.get('PATH', '')
 MDCT_COMPRESSOR_PATH = r'C:\Users\lokna\School\MassHealth\backend\mdct_compress.exe'
+# 'auto' uses the external compressor when it exists, else the in-process NumPy codec; or force 'python' / 'external'
+MDCT_BACKEND = os.getenv('MDCT_BACKEND', 'auto')
 
 ALLOWED_HOSTS = [
     'localhost',
@@ -54,13 +56,24 @@ INSTALLED_APPS = [
     'rest_framework_simplejwt',
     'rest_framework_simplejwt.token_blacklist',  # For logout functionality
     'corsheaders',
+    'django_cron',
     
     # Your apps
     'masshealth',  # Your existing app
 ]
 
+# Scheduled jobs, run with `python manage.py runcrons` (e.g. from a system cron every few minutes).
+# SyncToSupabaseCron is not scheduled here; enabling it is a separate decision.
+CRON_CLASSES = [
+    'masshealth.cron.RebuildDailyStatsCron',
+    'masshealth.cron.ProcessPendingSoundsCron',
+    'masshealth.cron.ProcessProfileImagesCron',
+    'masshealth.cron.AnalyzeActivityCron',
+]
+
 MIDDLEWARE = [
     'corsheaders.middleware.CorsMiddleware',
+    'masshealth.middleware.QueryProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -115,6 +128,100 @@ MQTT_CONFIG = {
     'client_id': 'django_masshealth_backend'
 }
 
+# Outbound MQTT queue; unsent messages are spooled to SPOOL_PATH.<pid>.<n> (one file per
+# process) across disconnects and restarts
+MQTT_OUTBOX = {
+    'MAX_QUEUED': 10000,
+    'WINDOW': int(os.getenv('MQTT_OUTBOX_WINDOW', 20)),
+    'ACK_TIMEOUT_SECONDS': 10,
+    'SPOOL_PATH': os.getenv('MQTT_OUTBOX_SPOOL', os.path.join(BASE_DIR, 'mqtt_outbox.spool')),
+    'MAX_SPOOL_BYTES': 50 * 1024 * 1024,
+}
+
+LOCATION_FANOUT = {
+    'FLUSH_INTERVAL_MS': 1000,
+    'MIN_INTERVAL_SECONDS': int(os.getenv('LOCATION_FANOUT_MIN_INTERVAL_SECONDS', 5)),
+    'FOLLOWER_TTL_SECONDS': 300,
+    'MAX_BATCH': 50,
+}
+
+# Logging: JSON lines (LOG_FORMAT=text for key=value lines) written from a
+# background thread. Per-message MQTT payload logging is off unless
+# LOG_MQTT_PAYLOADS=True; the noisiest events are sampled or rate limited.
+LOG_SAMPLING = {
+    'mqtt.message': {'sample_rate': float(os.getenv('LOG_MQTT_PAYLOAD_SAMPLE_RATE', 0.01))},
+    'mqtt.location_saved': {'per_second': 1},
+    'mqtt.decode_failed': {'per_second': 5},
+    'mqtt.handler_failed': {'per_second': 5},
+    'mqtt.invalid_payload': {'per_second': 5},
+    'mqtt.unknown_user': {'per_second': 1},
+    'mqtt.unrouted': {'per_second': 1},
+}
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'formatters': {
+        'structured': {
+            '()': 'masshealth.services.log_events.StructuredFormatter',
+            'style': os.getenv('LOG_FORMAT', 'json'),
+        },
+    },
+    'filters': {
+        'sampling': {
+            '()': 'masshealth.services.log_events.SamplingFilter',
+            'rules': LOG_SAMPLING,
+        },
+    },
+    'handlers': {
+        'background': {
+            'class': 'masshealth.services.log_events.BackgroundHandler',
+            'formatter': 'structured',
+            'filters': ['sampling'],
+        },
+    },
+    'loggers': {
+        'masshealth': {
+            'handlers': ['background'],
+            'level': os.getenv('LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+        'masshealth.mqtt.payloads': {
+            'level': 'DEBUG' if os.getenv('LOG_MQTT_PAYLOADS', 'False') == 'True' else 'WARNING',
+        },
+    },
+}
+
+# Set MQTT_IN_PROCESS=False when ingestion runs in `manage.py mqtt_worker`
+# instead of inside the web process
+MQTT_IN_PROCESS = os.getenv('MQTT_IN_PROCESS', 'True') == 'True'
+
+MQTT_WORKER = {
+    'SHARED_GROUP': os.getenv('MQTT_SHARED_GROUP', 'masshealth'),
+    'CONCURRENCY': int(os.getenv('MQTT_WORKER_CONCURRENCY', 32)),
+    'DB_WORKERS': int(os.getenv('MQTT_WORKER_DB_THREADS', 4)),
+    'SHUTDOWN_TIMEOUT_SECONDS': 10,
+}
+
+# Cache (catalog responses and their version counter). Use a shared backend
+# such as Redis in production so every worker sees the same catalog version.
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'masshealth'),
+    }
+}
+CATALOG_CACHE_TIMEOUT = 60 * 60 * 24  # Rendered catalog bytes, per filter combination
+
+# Per-request profiling: query count, DB/serializer time, slow request log.
+# Off unless QUERY_PROFILING=True, as it wraps every query and DRF serializer.
+REQUEST_PROFILING = {
+    'ENABLED': os.getenv('QUERY_PROFILING', 'False') == 'True',
+    'SERVER_TIMING': os.getenv('SERVER_TIMING', str(DEBUG)) == 'True',
+    'SLOW_REQUEST_MS': int(os.getenv('SLOW_REQUEST_MS', 500)),
+    'SLOW_REQUEST_MAX_QUERIES': 20,  # SQL statements captured for the slow request log
+}
+
 # Database router
 DATABASE_ROUTERS = ['masshealth.routers.SupabaseRouter']
 
@@ -123,6 +230,30 @@ SYNC_TO_SUPABASE = os.getenv('SYNC_TO_SUPABASE', 'True') == 'True'
 SYNC_BATCH_SIZE = 100
 SYNC_INTERVAL_MINUTES = 5
 
+# In-process worker pool for slow jobs such as sound processing
+BACKGROUND_JOBS = {
+    'MAX_WORKERS': int(os.getenv('BACKGROUND_JOB_WORKERS', 2)),
+    'MAX_QUEUED': int(os.getenv('BACKGROUND_JOB_QUEUE', 20)),
+}
+
+# Wearable accelerometer samples are buffered and written as one row per
+# device per window (see masshealth/services/sensor_store.py)
+SENSOR_STORE = {
+    'WINDOW_SECONDS': 60,
+    'LATE_GRACE_SECONDS': 5,
+    'FLUSH_INTERVAL_SECONDS': 5,
+    'MAX_BUFFERED_SAMPLES': int(os.getenv('SENSOR_MAX_BUFFERED_SAMPLES', 100000)),
+}
+
+# Live challenge scores: leaderboard deltas are published at most once per
+# PUBLISH_INTERVAL_MS per challenge and scores persisted in batches
+RIVALRY = {
+    'PUBLISH_INTERVAL_MS': int(os.getenv('RIVALRY_PUBLISH_INTERVAL_MS', 1000)),
+    'SNAPSHOT_INTERVAL_SECONDS': 5,
+    'TICK_MS': 200,
+    'MEMBERSHIP_TTL_SECONDS': 60,
+}
+
 # REST Framework Configuration
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': (
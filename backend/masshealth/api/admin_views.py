@@ -6,10 +6,15 @@ from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import BasePermission
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Upper
 from django.utils import timezone
-from datetime import timedelta
-from django.db.models import Count
-from django.db.models.functions import TruncDate
+from datetime import datetime, timedelta
+import base64
+import hashlib
+import json
 
 CustomUser = get_user_model()
 
@@ -46,61 +51,27 @@ def dashboard_stats(request):
     """
     Get dashboard statistics
     """
-    from ..models import Workout, Routine
+    from ..models import Workout
+    from ..services import daily_stats
     
-    now = timezone.now()
-    today = now.date()
-    week_ago = now - timedelta(days=7)
+    today = timezone.localdate()
     
-    # Basic counts
-    total_users = CustomUser.objects.count()
+    # Pre-aggregated per-day counters instead of scanning users and routines
+    daily_stats.ensure_backfilled()
+    week = daily_stats.get_range(7)
+    totals = daily_stats.get_totals()
     total_workouts = Workout.objects.count()
-    total_routines = Routine.objects.count()
-    
-    # Active today (users who logged in today)
-    active_today = CustomUser.objects.filter(last_login__date=today).count()
-    
-    # New users this week
-    new_users_week = CustomUser.objects.filter(created_at__gte=week_ago).count()
-    
-    # Weekly chart data - users registered per day
-    weekly_user_data = (
-        CustomUser.objects
-        .filter(created_at__gte=week_ago)
-        .annotate(date=TruncDate('created_at'))
-        .values('date')
-        .annotate(count=Count('id'))
-        .order_by('date')
-    )
-    
-    # Weekly chart data - routines created per day
-    weekly_routine_data = (
-        Routine.objects
-        .filter(created_at__gte=week_ago)
-        .annotate(date=TruncDate('created_at'))
-        .values('date')
-        .annotate(count=Count('id'))
-        .order_by('date')
-    )
     
     # Build chart data for the last 7 days
     chart_data = []
     for i in range(7):
-        day = (now - timedelta(days=6-i)).date()
-        day_name = day.strftime('%a')
-        
-        users_count = next(
-            (item['count'] for item in weekly_user_data if item['date'] == day), 0
-        )
-        routines_count = next(
-            (item['count'] for item in weekly_routine_data if item['date'] == day), 0
-        )
-        
+        day = today - timedelta(days=6-i)
+        stat = week.get(day)
         chart_data.append({
-            'name': day_name,
+            'name': day.strftime('%a'),
             'date': day.isoformat(),
-            'users': users_count,
-            'routines': routines_count,
+            'users': stat.signups if stat else 0,
+            'routines': stat.routines_created if stat else 0,
         })
     
     # Recent users
@@ -115,17 +86,34 @@ def dashboard_stats(request):
     
     return Response({
         'stats': {
-            'total_users': total_users,
-            'active_today': active_today,
+            'total_users': totals['users'],
+            'active_today': week[today].active_users if today in week else 0,
             'total_workouts': total_workouts,
-            'total_routines': total_routines,
-            'new_users_week': new_users_week,
+            'total_routines': totals['routines'],
+            'new_users_week': sum(stat.signups for stat in week.values()),
         },
         'chart_data': chart_data,
         'recent_users': recent_users_data,
     })
 
 
+@api_view(['GET', 'DELETE'])
+@permission_classes([IsAdminUser])
+def request_metrics(request):
+    """
+    Per-view latency, query count, DB and serializer time histograms
+    collected by QueryProfilingMiddleware (this process only, with QUERY_PROFILING on).
+    DELETE resets the counters.
+    """
+    from ..services.metrics import registry
+
+    if request.method == 'DELETE':
+        registry.reset()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    return Response(registry.snapshot(prefix=request.query_params.get('prefix', '')))
+
+
 @api_view(['GET'])
 @permission_classes([IsAdminUser])
 def list_admins(request):
@@ -148,41 +136,108 @@ def list_admins(request):
     return Response(data)
 
 
+USER_LIST_FIELDS = (
+    'id', 'email', 'full_name', 'is_staff', 'is_superuser',
+    'is_active', 'is_verified', 'created_at', 'last_login',
+)
+USER_COUNT_CACHE_TIMEOUT = 60
+
+
+def _encode_user_cursor(row):
+    raw = json.dumps([row['created_at'].isoformat(), row['id']])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def _decode_user_cursor(cursor):
+    try:
+        created_at, user_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(created_at), int(user_id)
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+
+def _filter_users(users, params):
+    search = params.get('search', '').strip()
+    if search:
+        # Compare against the same UPPER() expressions the prefix indexes are built on
+        term = search.upper()
+        users = users.annotate(email_upper=Upper('email'), full_name_upper=Upper('full_name')).filter(
+            Q(email_upper__startswith=term) | Q(full_name_upper__startswith=term)
+        )
+
+    role = params.get('role')
+    if role == 'admin':
+        users = users.filter(Q(is_staff=True) | Q(is_superuser=True))
+    elif role == 'user':
+        users = users.filter(is_staff=False, is_superuser=False)
+
+    for flag in ('is_active', 'is_verified'):
+        if flag in params:
+            users = users.filter(**{flag: params[flag].lower() in ('1', 'true')})
+    return users
+
+
+def _count_users(users, params):
+    """Total for the listing: the daily rollup when unfiltered, otherwise a briefly cached COUNT"""
+    from ..services import daily_stats
+
+    filters = sorted((key, params[key]) for key in ('search', 'role', 'is_active', 'is_verified') if params.get(key))
+    if not filters:
+        daily_stats.ensure_backfilled()
+        return daily_stats.get_totals()['users']
+
+    cache_key = 'admin:user-count:' + hashlib.sha1(repr(filters).encode()).hexdigest()
+    return cache.get_or_set(cache_key, users.count, USER_COUNT_CACHE_TIMEOUT)
+
+
 @api_view(['GET'])
 @permission_classes([IsAdminUser])
 def list_all_users(request):
     """
-    List all users (admin only)
+    List all users (admin only), newest first.
+    Keyset paginated on (created_at, id): pass the returned next_cursor as
+    `cursor` to get the next page. `page` is still accepted for old clients.
+    Filters: search (email / name prefix), role (admin|user), is_active, is_verified
     """
-    users = CustomUser.objects.all().order_by('-created_at')
-    
-    # Pagination (basic)
-    page = int(request.query_params.get('page', 1))
-    per_page = int(request.query_params.get('per_page', 20))
-    start = (page - 1) * per_page
-    end = start + per_page
-    
-    total = users.count()
-    users_page = users[start:end]
-    
-    data = [{
-        'id': user.id,
-        'email': user.email,
-        'full_name': user.full_name,
-        'is_staff': user.is_staff,
-        'is_superuser': user.is_superuser,
-        'is_active': user.is_active,
-        'is_verified': user.is_verified,
-        'created_at': user.created_at,
-        'last_login': user.last_login
-    } for user in users_page]
-    
+    params = request.query_params
+    try:
+        per_page = min(max(int(params.get('per_page', 20)), 1), 100)
+    except ValueError:
+        per_page = 20
+
+    users = _filter_users(CustomUser.objects.all(), params)
+    total = _count_users(users, params)
+    users = users.order_by('-created_at', '-id').values(*USER_LIST_FIELDS)
+
+    page = None
+    cursor = params.get('cursor')
+    if cursor:
+        try:
+            created_at, user_id = _decode_user_cursor(cursor)
+        except ValueError as e:
+            return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+        users = users.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=user_id))
+        rows = list(users[:per_page + 1])
+    elif 'page' in params:
+        try:
+            page = max(int(params['page']), 1)
+        except ValueError:
+            page = 1
+        start = (page - 1) * per_page
+        rows = list(users[start:start + per_page + 1])
+    else:
+        rows = list(users[:per_page + 1])
+
+    has_more = len(rows) > per_page
+    rows = rows[:per_page]
+
     return Response({
-        'users': data,
+        'users': rows,
         'total': total,
         'page': page,
         'per_page': per_page,
-        'total_pages': (total + per_page - 1) // per_page
+        'total_pages': max((total + per_page - 1) // per_page, 1),
+        'next_cursor': _encode_user_cursor(rows[-1]) if has_more else None,
     })
 
 
@@ -449,19 +504,30 @@ def send_password_reset(request, user_id):
         return Response({'error': f'Failed to send email: {str(e)}'}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+def _sound_data(request, sound):
+    from ..services.sound_assets import media_urls
+
+    return {
+        'id': str(sound.id),
+        'name': sound.name,
+        'file_url': request.build_absolute_uri(sound.file.url) if sound.file else None,
+        **media_urls(request, sound),
+        'peaks': sound.peaks or None,
+        'duration': sound.duration,
+        'created_at': sound.created_at,
+        'status': sound.status,
+        'compression': sound.compression or None,
+        'error': sound.error or None,
+    }
+
+
 @api_view(['GET'])
 @permission_classes([IsAdminUser])
 def list_sounds(request):
     from ..models import Sound
     
     sounds = Sound.objects.all()
-    data = [{
-        'id': str(sound.id),
-        'name': sound.name,
-        'file_url': request.build_absolute_uri(sound.file.url) if sound.file else None,
-        'duration': sound.duration,
-        'created_at': sound.created_at,
-    } for sound in sounds]
+    data = [_sound_data(request, sound) for sound in sounds]
     
     return Response(data)
 
@@ -469,136 +535,61 @@ def list_sounds(request):
 @api_view(['POST'])
 @permission_classes([IsAdminUser])
 def upload_sound(request):
+    """
+    Store an uploaded sound and queue it for processing (transcode, MDCT
+    compression, duration probe). Returns 202 with the sound id, which is
+    also the job id for the status endpoint.
+    """
     from ..models import Sound
-    from django.conf import settings
-    import subprocess
-    import tempfile
-    import os
-    import mutagen
+    from ..services.sound_processing import enqueue_sound_processing
     
     if 'file' not in request.FILES:
         return Response({'error': 'No file provided'}, status=status.HTTP_400_BAD_REQUEST)
     
     file = request.FILES['file']
     name = request.data.get('name', file.name)
-    block_size_n = int(request.data.get('block_size_n', 1024))
-    discard_m = int(request.data.get('discard_m', 100))
+    try:
+        block_size_n = int(request.data.get('block_size_n', 1024))
+        discard_m = int(request.data.get('discard_m', 100))
+    except (TypeError, ValueError):
+        return Response({'error': 'N and M must be integers'}, status=status.HTTP_400_BAD_REQUEST)
     
+    if block_size_n <= 0 or discard_m < 0:
+        return Response({'error': 'N must be positive and M non-negative'}, status=status.HTTP_400_BAD_REQUEST)
     if discard_m >= block_size_n:
         return Response({'error': 'M must be less than N'}, status=status.HTTP_400_BAD_REQUEST)
     
-    sound = Sound.objects.create(
-        name=name,
-        file=file,
-        uploaded_by=request.user
-    )
-    
-    compression_stats = {
-        'compressed': False,
-        'original_size': 0,
-        'compressed_size': 0,
-        'ratio': 0,
-        'savings_percent': 0,
-        'error': None
-    }
+    with transaction.atomic():
+        sound = Sound.objects.create(
+            name=name,
+            file=file,
+            uploaded_by=request.user,
+            status=Sound.STATUS_PENDING,
+            block_size_n=block_size_n,
+            discard_m=discard_m,
+        )
+        enqueue_sound_processing(sound)
     
-    try:
-        original_path = sound.file.path
-        compression_stats['original_size'] = os.path.getsize(original_path)
-        
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_wav:
-            tmp_wav_path = tmp_wav.name
-        
-        with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_out:
-            tmp_out_path = tmp_out.name
-        
-        ffmpeg_ok = False
-        try:
-            subprocess.run([
-                'ffmpeg', '-y', '-i', original_path, 
-                '-ar', '44100', '-ac', '2', tmp_wav_path
-            ], check=True, capture_output=True)
-            ffmpeg_ok = True
-        except FileNotFoundError:
-            compression_stats['error'] = 'ffmpeg not found'
-            tmp_wav_path = original_path
-        except subprocess.CalledProcessError as e:
-            compression_stats['error'] = f'ffmpeg failed: {e.stderr.decode()[:100]}'
-            tmp_wav_path = original_path
-        
-        mdct_path = getattr(settings, 'MDCT_COMPRESSOR_PATH', None)
-        if mdct_path and os.path.exists(mdct_path):
-            try:
-                # Use absolute paths for Windows compatibility
-                abs_input = os.path.abspath(tmp_wav_path)
-                abs_output = os.path.abspath(tmp_out_path)
-                
-                print(f"MDCT running: {mdct_path} {abs_input} {abs_output} {block_size_n} {discard_m}")
-                
-                result = subprocess.run([
-                    mdct_path, abs_input, abs_output, 
-                    str(block_size_n), str(discard_m)
-                ], capture_output=True, timeout=600, cwd=os.path.dirname(mdct_path))
-                
-                stdout = result.stdout.decode('utf-8', errors='replace') if result.stdout else ''
-                stderr = result.stderr.decode('utf-8', errors='replace') if result.stderr else ''
-                
-                print(f"MDCT returncode: {result.returncode}")
-                print(f"MDCT stdout: {stdout}")
-                print(f"MDCT stderr: {stderr}")
-                
-                if result.returncode != 0:
-                    compression_stats['error'] = f'MDCT exit {result.returncode}: {stderr or stdout or "no output"}'[:200]
-                elif os.path.exists(tmp_out_path) and os.path.getsize(tmp_out_path) > 0:
-                    compressed_dir = os.path.join(settings.MEDIA_ROOT, 'sounds', 'compressed')
-                    os.makedirs(compressed_dir, exist_ok=True)
-                    compressed_path = os.path.join(compressed_dir, f"{sound.id}.wav")
-                    os.rename(tmp_out_path, compressed_path)
-                    
-                    sound.file.name = f"sounds/compressed/{sound.id}.wav"
-                    sound.save()
-                    
-                    compression_stats['compressed'] = True
-                    compression_stats['compressed_size'] = os.path.getsize(compressed_path)
-                    if compression_stats['original_size'] > 0:
-                        compression_stats['ratio'] = round(compression_stats['original_size'] / compression_stats['compressed_size'], 2)
-                        compression_stats['savings_percent'] = round(100 * (compression_stats['original_size'] - compression_stats['compressed_size']) / compression_stats['original_size'], 1)
-                else:
-                    compression_stats['error'] = 'MDCT produced empty output'
-                    
-            except subprocess.CalledProcessError as e:
-                err_msg = e.stderr if e.stderr else (e.stdout if e.stdout else 'no output')
-                compression_stats['error'] = f'MDCT failed: {err_msg[:200]}'
-                print(f"MDCT CalledProcessError: {err_msg}")
-            except Exception as e:
-                compression_stats['error'] = f'MDCT error: {str(e)[:100]}'
-        else:
-            compression_stats['error'] = 'MDCT compressor not configured'
-        
-        if tmp_wav_path != original_path and os.path.exists(tmp_wav_path):
-            os.unlink(tmp_wav_path)
-        if os.path.exists(tmp_out_path):
-            os.unlink(tmp_out_path)
-            
-    except Exception as e:
-        compression_stats['error'] = f'Pipeline error: {str(e)[:100]}'
+    return Response({
+        **_sound_data(request, sound),
+        'job_id': str(sound.id),
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def sound_status(request, sound_id):
+    """
+    Processing status of an uploaded sound (poll until ready or failed)
+    """
+    from ..models import Sound
     
     try:
-        audio = mutagen.File(sound.file.path)
-        if audio and hasattr(audio, 'info') and hasattr(audio.info, 'length'):
-            sound.duration = audio.info.length
-            sound.save()
-    except Exception as e:
-        print(f"Could not get audio duration: {e}")
+        sound = Sound.objects.get(id=sound_id)
+    except Sound.DoesNotExist:
+        return Response({'error': 'Sound not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    return Response({
-        'id': str(sound.id),
-        'name': sound.name,
-        'file_url': request.build_absolute_uri(sound.file.url),
-        'duration': sound.duration,
-        'created_at': sound.created_at,
-        'compression': compression_stats
-    }, status=status.HTTP_201_CREATED)
+    return Response(_sound_data(request, sound))
 
 
 @api_view(['DELETE'])
@@ -614,9 +605,11 @@ def delete_sound(request, sound_id):
     except Sound.DoesNotExist:
         return Response({'error': 'Sound not found'}, status=status.HTTP_404_NOT_FOUND)
     
-    # Delete the file from storage
+    # Delete the files from storage
     if sound.file:
         sound.file.delete(save=False)
+    if sound.preview:
+        sound.preview.delete(save=False)
     
     sound.delete()
     
@@ -626,98 +619,29 @@ def delete_sound(request, sound_id):
 @api_view(['POST'])
 @permission_classes([IsAdminUser])
 def import_exercises(request):
-    from ..models import Workout, MuscleGroup
-    
-    exercises = request.data.get('exercises', [])
-    if not exercises:
-        return Response({'error': 'No exercises provided'}, status=status.HTTP_400_BAD_REQUEST)
+    """
+    Bulk import exercises (admin only).
+    Accepts {"exercises": [...]} as JSON, or a streamed `file` upload in
+    NDJSON, CSV or JSON format (override detection with `format`).
+    Existing exercises are skipped unless `overwrite` is set, globally or per exercise.
+    """
+    from ..services.exercise_import import import_exercises as run_import, iter_uploaded_exercises
     
-    created = 0
-    updated = 0
-    skipped = 0
-    errors = []
+    overwrite = str(request.data.get('overwrite', '')).lower() in ('1', 'true')
+    upload = request.FILES.get('file')
+    if upload:
+        exercises = iter_uploaded_exercises(upload, request.data.get('format'))
+    else:
+        exercises = request.data.get('exercises', [])
+        if not exercises:
+            return Response({'error': 'No exercises provided'}, status=status.HTTP_400_BAD_REQUEST)
     
-    for ex in exercises:
-        try:
-            name = ex.get('name')
-            if not name:
-                errors.append('Exercise missing name')
-                continue
-            
-            overwrite = ex.get('overwrite', False)
-            existing = Workout.objects.filter(name__iexact=name).first()
-            
-            if existing and not overwrite:
-                skipped += 1
-                continue
-            
-            muscle_group = None
-            mg_name = ex.get('primary_muscle') or ex.get('muscle_group')
-            if isinstance(mg_name, dict):
-                mg_name = mg_name.get('name')
-            if not mg_name and ex.get('primary_muscles'):
-                mg_name = ex.get('primary_muscles')[0] if ex.get('primary_muscles') else None
-            if mg_name:
-                mg_name = mg_name.strip().title()
-                muscle_group, _ = MuscleGroup.objects.get_or_create(name=mg_name)
-            
-            video_url = ''
-            video_urls = ex.get('video_urls')
-            if video_urls:
-                if isinstance(video_urls, dict):
-                    video_url = video_urls.get('front') or video_urls.get('side') or ''
-                elif isinstance(video_urls, str):
-                    video_url = video_urls
-            if not video_url:
-                video_url = ex.get('video_url', '')
-            
-            equipment = ex.get('equipment') or ex.get('equipment_required') or ''
-            if equipment:
-                equipment = equipment.lower().replace(' ', '_').replace('-', '_')
-            
-            exp_level = ex.get('experience_level', 'beginner')
-            if exp_level:
-                exp_level = exp_level.lower()
-            
-            exercise_type = ex.get('exercise_type', 'strength')
-            if exercise_type:
-                exercise_type = exercise_type.lower().replace(' ', '_')
-            
-            mechanics = ex.get('mechanics_type') or ex.get('mechanics') or ''
-            if mechanics:
-                mechanics = mechanics.lower()
-            
-            force_type = ex.get('force_type', '')
-            if force_type:
-                force_type = force_type.lower().replace(' ', '_')
-            
-            defaults = {
-                'muscle_group': muscle_group,
-                'exercise_type': exercise_type,
-                'equipment_required': equipment,
-                'experience_level': exp_level,
-                'video_url': video_url,
-                'mechanics': mechanics,
-                'force_type': force_type,
-            }
-            
-            if existing and overwrite:
-                for key, value in defaults.items():
-                    if value:
-                        setattr(existing, key, value)
-                existing.save()
-                updated += 1
-            else:
-                Workout.objects.create(name=name, **defaults)
-                created += 1
-                
-        except Exception as e:
-            errors.append(f"Error importing {ex.get('name', 'unknown')}: {str(e)}")
+    result = run_import(exercises, overwrite=overwrite)
+    if result['error']:
+        # The upload could not be read to the end; what came before it was imported
+        return Response(result, status=status.HTTP_400_BAD_REQUEST)
     
     return Response({
-        'message': f'Import complete: {created} created, {updated} updated, {skipped} skipped',
-        'created': created,
-        'updated': updated,
-        'skipped': skipped,
-        'errors': errors
-    })
\ No newline at end of file
+        'message': f"Import complete: {result['created']} created, {result['updated']} updated, {result['skipped']} skipped",
+        **result,
+    })
@@ -0,0 +1,13 @@
+from rest_framework.pagination import CursorPagination
+
+
+class WorkoutCursorPagination(CursorPagination):
+    """
+    Keyset pagination for the workout catalog.
+    Pages are fetched with an indexed `name > cursor` seek, so deep pages
+    cost the same as the first one and no COUNT(*) is issued.
+    """
+    ordering = ('name', 'id')
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
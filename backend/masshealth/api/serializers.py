@@ -2,6 +2,7 @@ from rest_framework import serializers
 from django.contrib.auth import authenticate
 from django.contrib.auth.password_validation import validate_password
 from ..models import ConditionOrInjury, CustomUser, FitnessGoal, Workout, UserMetadata, MuscleGroup, Routine, RoutineWorkout
+from ..services.image_renditions import PROFILE_IMAGE_SIZE, profile_image_url, rendition_urls
 
 class UserRegistrationSerializer(serializers.ModelSerializer):
     password = serializers.CharField(write_only=True, validators=[validate_password])
@@ -67,31 +68,31 @@ class UserProfileSerializer(serializers.ModelSerializer):
     def get_profile_image_url(self, obj):
         try:
             if hasattr(obj, 'metadata') and obj.metadata.profile_image:
-                request = self.context.get('request')
-                if request:
-                    return request.build_absolute_uri(obj.metadata.profile_image.url)
-                return obj.metadata.profile_image.url
+                size = self.context.get('profile_image_size', PROFILE_IMAGE_SIZE)
+                return profile_image_url(obj.metadata, size, self.context.get('request'))
         except (AttributeError, UserMetadata.DoesNotExist):
             pass
         return None
 
 class UserMetadataSerializer(serializers.ModelSerializer):
     profile_image_url = serializers.SerializerMethodField()
+    profile_image_renditions = serializers.SerializerMethodField()
 
     class Meta:
         model = UserMetadata
         fields = ['username', 'age', 'gender', 'height', 'weight', 'fitness_experience', 
-                 'profile_image', 'profile_image_url', 'created_at', 'updated_at']
+                 'profile_image', 'profile_image_url', 'profile_image_renditions', 'created_at', 'updated_at']
         read_only_fields = ['created_at', 'updated_at']
 
     def get_profile_image_url(self, obj):
         if obj.profile_image:
-            request = self.context.get('request')
-            if request:
-                return request.build_absolute_uri(obj.profile_image.url)
-            return obj.profile_image.url
+            size = self.context.get('profile_image_size', PROFILE_IMAGE_SIZE)
+            return profile_image_url(obj, size, self.context.get('request'))
         return None
 
+    def get_profile_image_renditions(self, obj):
+        return rendition_urls(obj, self.context.get('request'))
+
 class TwoFactorAuthSerializer(serializers.ModelSerializer):
     class Meta:
         model = CustomUser
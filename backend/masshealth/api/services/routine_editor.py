@@ -0,0 +1,209 @@
+from django.core.exceptions import ValidationError
+from django.db.models import F, Max
+from django.utils import timezone
+from rest_framework import serializers
+
+from masshealth.models import Routine, RoutineWorkout, Workout, queue_supabase_sync
+from ..serializers import RoutineWorkoutCreateUpdateSerializer
+
+# Per-routine workout settings and the values a freshly added workout gets
+ROUTINE_WORKOUT_DEFAULTS = {
+    'workout_mode': 'reps_sets',
+    'custom_sets': None,
+    'custom_reps': None,
+    'timer_duration': None,
+    'duration_minutes': None,
+    'rest_between_sets': 60,
+    'notes': '',
+}
+
+
+class RoutineEditError(Exception):
+    """Raised when a routine edit references missing workouts or invalid positions"""
+    pass
+
+
+def _as_id(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RoutineEditError(f'Invalid workout_id: {value!r}')
+
+
+def resolve_workouts(workout_ids):
+    """Load every referenced workout in one query, keyed by id"""
+    ids = [_as_id(workout_id) for workout_id in workout_ids]
+    workouts = Workout.objects.in_bulk(set(ids))
+    missing = sorted({workout_id for workout_id in ids if workout_id not in workouts})
+    if missing:
+        raise RoutineEditError(f'Workout(s) not found: {", ".join(map(str, missing))}')
+    return workouts
+
+
+def close_gap(routine, order):
+    """Shift every workout after `order` up by one slot with two UPDATEs"""
+    following = RoutineWorkout.objects.filter(routine=routine, order__gt=order)
+    shifted_pks = list(following.values_list('pk', flat=True))
+    if shifted_pks:
+        # UPDATE ignores order_by and the (routine, workout, order) constraint is
+        # checked row by row, so park the rows above every order before the shift
+        offset = following.aggregate(top=Max('order'))['top'] + 1
+        shifted = RoutineWorkout.objects.filter(pk__in=shifted_pks)
+        shifted.update(order=F('order') + offset)
+        shifted.update(order=F('order') - offset - 1)
+    queue_supabase_sync(RoutineWorkout, upserts=shifted_pks)
+
+
+def replace_routine_workouts(routine, workout_data):
+    """
+    Make the routine's workouts match `workout_data` (an ordered list of dicts
+    with `workout_id` and optional per-routine settings).
+
+    Rows are matched by position, so unchanged positions are left alone,
+    changed ones go out in one bulk_update and new ones in one bulk_create.
+    """
+    workout_ids = [info.get('workout_id') for info in workout_data]
+    resolve_workouts(workout_ids)
+
+    existing = {rw.order: rw for rw in RoutineWorkout.objects.filter(routine=routine)}
+    to_create = []
+    to_update = []
+
+    for order, (workout_id, info) in enumerate(zip(workout_ids, workout_data), start=1):
+        values = {field: info.get(field, default) for field, default in ROUTINE_WORKOUT_DEFAULTS.items()}
+        values['workout_id'] = _as_id(workout_id)
+
+        current = existing.pop(order, None)
+        if current is None:
+            to_create.append(RoutineWorkout(routine=routine, order=order, **values))
+        elif any(getattr(current, field) != value for field, value in values.items()):
+            for field, value in values.items():
+                setattr(current, field, value)
+            to_update.append(current)
+
+    stale_pks = [rw.pk for rw in existing.values()]
+    if stale_pks:
+        RoutineWorkout.objects.filter(pk__in=stale_pks).delete()
+    if to_update:
+        RoutineWorkout.objects.bulk_update(to_update, ['workout', *ROUTINE_WORKOUT_DEFAULTS])
+    created = RoutineWorkout.objects.bulk_create(to_create)
+
+    queue_supabase_sync(
+        RoutineWorkout,
+        upserts=[rw.pk for rw in to_update + created],
+        deletes=stale_pks,
+    )
+
+
+def _position(op, key, upper):
+    try:
+        position = int(op[key])
+    except KeyError:
+        raise RoutineEditError(f'"{key}" is required')
+    except (TypeError, ValueError):
+        raise RoutineEditError(f'"{key}" must be an integer')
+    if not 1 <= position <= upper:
+        raise RoutineEditError(f'"{key}" must be between 1 and {upper}')
+    return position - 1
+
+
+def _field_values(op):
+    # Field-level validation only; cross-field rules are checked on the final rows
+    serializer_fields = RoutineWorkoutCreateUpdateSerializer().fields
+    values = {}
+    for field in ROUTINE_WORKOUT_DEFAULTS:
+        if field in op:
+            try:
+                values[field] = serializer_fields[field].run_validation(op[field])
+            except serializers.ValidationError as e:
+                raise RoutineEditError(f'{field}: {"; ".join(map(str, e.detail))}')
+    return values
+
+
+def _apply_operation(routine, rows, op, workouts):
+    kind = op.get('op')
+
+    if kind == 'add':
+        index = _position(op, 'position', len(rows) + 1) if 'position' in op else len(rows)
+        values = {**ROUTINE_WORKOUT_DEFAULTS, **_field_values(op)}
+        rows.insert(index, RoutineWorkout(routine=routine, workout=workouts[_as_id(op.get('workout_id'))], **values))
+    elif kind == 'remove':
+        rows.pop(_position(op, 'order', len(rows)))
+    elif kind == 'move':
+        row = rows.pop(_position(op, 'from', len(rows)))
+        rows.insert(_position(op, 'to', len(rows) + 1), row)
+    elif kind == 'update':
+        row = rows[_position(op, 'order', len(rows))]
+        for field, value in _field_values(op).items():
+            setattr(row, field, value)
+    else:
+        raise RoutineEditError(f'Unknown op {kind!r}, expected add, remove, move or update')
+
+
+def apply_operations(routine, operations):
+    """
+    Apply an ordered list of edit operations to a routine, JSON Patch style:
+    each operation sees the result of the previous one and positions are the
+    1-based workout orders at that point. Callers wrap this in a transaction,
+    so a failing operation leaves the routine untouched.
+
+    Supported operations:
+        {"op": "add", "workout_id": 3, "position": 2, ...settings}
+        {"op": "remove", "order": 1}
+        {"op": "move", "from": 4, "to": 1}
+        {"op": "update", "order": 2, ...settings}
+    """
+    if not isinstance(operations, list) or not operations:
+        raise RoutineEditError('operations must be a non-empty list')
+    if not all(isinstance(op, dict) for op in operations):
+        raise RoutineEditError('Each operation must be an object')
+
+    workouts = resolve_workouts([op.get('workout_id') for op in operations if op.get('op') == 'add'])
+    rows = list(RoutineWorkout.objects.filter(routine=routine).order_by('order'))
+    snapshot = {
+        rw.pk: tuple(getattr(rw, field) for field in ('order', *ROUTINE_WORKOUT_DEFAULTS))
+        for rw in rows
+    }
+
+    for index, op in enumerate(operations):
+        try:
+            _apply_operation(routine, rows, op, workouts)
+        except RoutineEditError as e:
+            raise RoutineEditError(f'Operation {index}: {e}')
+
+    for order, row in enumerate(rows, start=1):
+        row.order = order
+        try:
+            row.clean()
+        except ValidationError as e:
+            raise RoutineEditError(f'Workout at position {order}: {"; ".join(e.messages)}')
+
+    kept_pks = {row.pk for row in rows if row.pk is not None}
+    deleted_pks = [pk for pk in snapshot if pk not in kept_pks]
+    to_create = [row for row in rows if row.pk is None]
+    to_update = [
+        row for row in rows
+        if row.pk is not None
+        and snapshot[row.pk] != tuple(getattr(row, field) for field in ('order', *ROUTINE_WORKOUT_DEFAULTS))
+    ]
+
+    if deleted_pks:
+        RoutineWorkout.objects.filter(pk__in=deleted_pks).delete()
+    if to_update:
+        moved_pks = [row.pk for row in to_update if row.order != snapshot[row.pk][0]]
+        if moved_pks:
+            # Park moved rows above every old and new order first, so the
+            # (routine, workout, order) constraint never sees a transient clash
+            offset = max(len(rows), *(values[0] for values in snapshot.values())) + 1
+            RoutineWorkout.objects.filter(pk__in=moved_pks).update(order=F('order') + offset)
+        RoutineWorkout.objects.bulk_update(to_update, ['order', *ROUTINE_WORKOUT_DEFAULTS])
+    created = RoutineWorkout.objects.bulk_create(to_create)
+
+    if deleted_pks or to_update or created:
+        Routine.objects.filter(pk=routine.pk).update(updated_at=timezone.now())
+        queue_supabase_sync(Routine, upserts=[routine.pk])
+        queue_supabase_sync(
+            RoutineWorkout,
+            upserts=[row.pk for row in to_update + created],
+            deletes=deleted_pks,
+        )
@@ -41,6 +41,7 @@ urlpatterns = [
     path('challenge/<int:challengeId>/decline/', views.decline_challenge, name='decline_challenge'),
     path('challenges/pending/', views.get_pending_challenges, name='get_pending_challenges'),
     path('challenge/<int:challengeId>/routine/', views.get_challenge_routine_detail, name='challenge-routine-detail'),
+    path('challenge/<int:challengeId>/leaderboard/', views.get_challenge_leaderboard, name='challenge-leaderboard'),
     path('challenges/accepted/', views.get_accepted_challenges, name='get_accepted_challenges'),
 
 
@@ -74,11 +75,18 @@ urlpatterns = [
          views.add_workout_to_routine, name='add-workout-to-routine'),
      path('routines/<int:routine_id>/workouts/<int:workout_order>/delete/', 
          views.remove_workout_from_routine, name='remove-workout-from-routine'),
+     path('routines/<int:routine_id>/workouts/batch/', 
+         views.batch_edit_routine_workouts, name='batch-edit-routine-workouts'),
 
 
+    # Sound URLs
+    path('sounds/', views.list_sounds, name='sounds'),
+    path('sounds/<uuid:sound_id>/<str:variant>/', views.sound_media, name='sound-media'),
+
     # Admin endpoints
     path('admin/check/', admin_views.admin_check, name='admin-check'),
     path('admin/stats/', admin_views.dashboard_stats, name='dashboard-stats'),
+    path('admin/metrics/', admin_views.request_metrics, name='request-metrics'),
     path('admin/list/', admin_views.list_admins, name='list-admins'),
     path('admin/users/', admin_views.list_all_users, name='list-all-users'),
     path('admin/create/', admin_views.create_admin, name='create-admin'),
@@ -92,4 +100,8 @@ urlpatterns = [
     path('admin/sounds/', admin_views.list_sounds, name='list-sounds'),
     path('admin/sounds/upload/', admin_views.upload_sound, name='upload-sound'),
     path('admin/sounds/<uuid:sound_id>/', admin_views.delete_sound, name='delete-sound'),
+    path('admin/sounds/<uuid:sound_id>/status/', admin_views.sound_status, name='sound-status'),
+    
+    # Exercise catalog import
+    path('admin/exercises/import/', admin_views.import_exercises, name='import-exercises'),
 ]
\ No newline at end of file
@@ -1,11 +1,14 @@
-import traceback
+import logging
 from rest_framework import status, generics, permissions
-from rest_framework.decorators import api_view, permission_classes
+from rest_framework.decorators import api_view, authentication_classes, permission_classes
 from rest_framework.response import Response
+from rest_framework.exceptions import NotFound
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework_simplejwt.tokens import RefreshToken
 from django.contrib.auth import login
+from django.contrib.auth.signals import user_logged_in
 from django.shortcuts import get_object_or_404
+from django.utils.decorators import method_decorator
 from django.db import models
 from django.db import models, transaction 
 from datetime import datetime, timedelta
@@ -13,20 +16,30 @@ import jwt
 from django.conf import settings
 
 from masshealth.api.services.workoutrecommendation import WorkoutRecommendationEngine
+from masshealth.api.services.routine_editor import RoutineEditError, apply_operations, close_gap, replace_routine_workouts
+from masshealth.services import daily_stats
+from masshealth.services.catalog_cache import catalog_cached, resolve_muscle_group_ids
+from masshealth.services.image_renditions import AVATAR_SIZE, profile_image_url
+from masshealth.services.log_events import log_event
+from masshealth.services.sound_assets import media_urls, media_version, ranged_file_response
 
 
 from .serializers import (ConditionOrInjurySerializer, FitnessGoalSerializer, RoutineWorkoutSerializer, UserRegistrationSerializer, UserLoginSerializer, 
                          UserProfileSerializer, UserMetadataSerializer, TwoFactorAuthSerializer,
                          MuscleGroupSerializer, WorkoutSerializer, 
                          RoutineSerializer, RoutineWorkoutCreateUpdateSerializer, RoutineDetailSerializer)
-from ..models import Challenge, ConditionOrInjury, CustomUser, FitnessGoal, UserMetadata, FriendRequest, Workout, Routine, RoutineWorkout, MuscleGroup
+from ..models import Challenge, ConditionOrInjury, CustomUser, FitnessGoal, UserMetadata, FriendRequest, Workout, Routine, RoutineWorkout, MuscleGroup, Sound, coalesced_supabase_sync
 from .forms import ProfilePicForm
+from .pagination import WorkoutCursorPagination
+import mimetypes
 import os
 import numpy as np
 import cv2
 from insightface.app import FaceAnalysis
 from django.utils import timezone
 
+logger = logging.getLogger(__name__)
+
 
 class RegisterView(generics.CreateAPIView):
     queryset = CustomUser.objects.all()
@@ -57,6 +70,10 @@ class LoginView(generics.GenericAPIView):
         serializer.is_valid(raise_exception=True)
         user = serializer.validated_data['user']
         
+        # Count the login before user_logged_in moves last_login forward
+        daily_stats.record_login(user)
+        user_logged_in.send(sender=user.__class__, request=request, user=user)
+        
         # Generate JWT tokens
         refresh = RefreshToken.for_user(user)
         
@@ -132,11 +149,7 @@ def remove_profile_image(request):
         metadata = get_object_or_404(UserMetadata, user=request.user)
         
         if metadata.profile_image:
-            # Delete the image file
-            if os.path.isfile(metadata.profile_image.path):
-                os.remove(metadata.profile_image.path)
-            
-            # Clear the image field
+            # Clearing the field releases the file once no other profile shares it
             metadata.profile_image = None
             metadata.save()
             
@@ -415,15 +428,17 @@ def get_pending_requests(request):
 @permission_classes([permissions.IsAuthenticated])
 def get_friends_list(request):
     try:
-        friends = request.user.friends.all()
+        friends = request.user.friends.select_related('metadata')
         
         friends_data = []
         for friend in friends:
+            metadata = getattr(friend, 'metadata', None)
             friends_data.append({
                 'id': friend.id,
                 'name': friend.full_name,
-                'username': friend.metadata.username if hasattr(friend, 'metadata') else f'user_{friend.id}',
-                'profile_image_url': friend.metadata.profile_image.url if hasattr(friend, 'metadata') and friend.metadata.profile_image else None
+                'username': metadata.username if metadata else f'user_{friend.id}',
+                'profile_image_url': profile_image_url(metadata, AVATAR_SIZE) if metadata else None,
+                'profile_image_webp_url': profile_image_url(metadata, AVATAR_SIZE, fmt='webp') if metadata else None,
             })
         
         return Response({
@@ -645,20 +660,22 @@ def search_users(request):
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 # Workout views
+@method_decorator(catalog_cached('workouts'), name='get')
 class WorkoutListView(generics.ListAPIView):
     queryset = Workout.objects.all()
     serializer_class = WorkoutSerializer  
     permission_classes = [permissions.IsAuthenticated]
+    pagination_class = WorkoutCursorPagination
 
     def get_queryset(self):  
-        queryset = Workout.objects.all()
+        queryset = Workout.objects.select_related('muscle_group')
         
         muscle_group = self.request.query_params.get('muscle_group')
         exercise_type = self.request.query_params.get('exercise_type')
         experience_level = self.request.query_params.get('experience_level')
         
         if muscle_group:
-            queryset = queryset.filter(muscle_group__name__icontains=muscle_group)
+            queryset = queryset.filter(muscle_group_id__in=resolve_muscle_group_ids(muscle_group))
         if exercise_type:
             queryset = queryset.filter(exercise_type=exercise_type)
         if experience_level:
@@ -682,6 +699,7 @@ def get_workout_by_muscle_group(request, muscle_group_name):
         )
     
 @api_view(['GET'])
+@catalog_cached('muscle-groups')
 def get_muscle_groups(request):
     try:
         muscle_groups = MuscleGroup.objects.all()
@@ -702,21 +720,14 @@ class RoutineCreateView(generics.CreateAPIView):
     permission_classes = [permissions.IsAuthenticated]
 
     def perform_create(self, serializer):  
-        routine = serializer.save(user=self.request.user)
-
         workout_data = self.request.data.get('workouts', [])
 
-        for index, workout_info in enumerate(workout_data):
-            workout_id = workout_info.get('workout_id')
-            workout = get_object_or_404(Workout, id=workout_id)
-
-            RoutineWorkout.objects.create(
-                routine=routine,
-                workout=workout,
-                order=index + 1,
-                rest_between_sets=workout_info.get('rest_between_sets', 60),
-                notes=workout_info.get('notes', '')
-            )
+        with transaction.atomic(), coalesced_supabase_sync():
+            routine = serializer.save(user=self.request.user)
+            try:
+                replace_routine_workouts(routine, workout_data)
+            except RoutineEditError as e:
+                raise NotFound(str(e))
 
 class RoutineDetailView(generics.RetrieveAPIView):
     serializer_class = RoutineDetailSerializer
@@ -756,26 +767,18 @@ class RoutineUpdateView(generics.UpdateAPIView):
         return Routine.objects.filter(user=self.request.user)
     
     def perform_update(self, serializer):
-        routine = serializer.save()
-        
-        # Handle workout updates if provided
         workout_data = self.request.data.get('workouts')
-        if workout_data is not None:
-            # Clear existing workout relationships
-            RoutineWorkout.objects.filter(routine=routine).delete()
+
+        # One transaction and one Supabase sync job for the whole edit
+        with transaction.atomic(), coalesced_supabase_sync():
+            routine = serializer.save()
             
-            # Add new workout relationships
-            for index, workout_info in enumerate(workout_data):
-                workout_id = workout_info.get('workout_id')
-                workout = get_object_or_404(Workout, id=workout_id)
-                
-                RoutineWorkout.objects.create(
-                    routine=routine,
-                    workout=workout,
-                    order=index + 1,
-                    rest_between_sets=workout_info.get('rest_between_sets', 60),
-                    notes=workout_info.get('notes', '')
-                )
+            # Handle workout updates if provided
+            if workout_data is not None:
+                try:
+                    replace_routine_workouts(routine, workout_data)
+                except RoutineEditError as e:
+                    raise NotFound(str(e))
 
 class RoutineDeleteView(generics.DestroyAPIView):
     permission_classes = [permissions.IsAuthenticated]
@@ -950,26 +953,45 @@ def remove_workout_from_routine(request, routine_id, workout_order):
             order=workout_order
         )
         
-        # Delete the workout
-        routine_workout.delete()
-        
-        # Reorder remaining workouts
-        remaining_workouts = RoutineWorkout.objects.filter(
-            routine=routine,
-            order__gt=workout_order
-        ).order_by('order')
-        
-        for i, rw in enumerate(remaining_workouts):
-            rw.order = workout_order + i
-            rw.save()
+        with transaction.atomic(), coalesced_supabase_sync():
+            # Delete the workout
+            routine_workout.delete()
+            
+            # Reorder remaining workouts
+            close_gap(routine, workout_order)
         
         return Response({'message': 'Workout removed successfully'}, status=status.HTTP_200_OK)
         
     except Exception as e:
         return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+@api_view(['POST'])
+@permission_classes([IsAuthenticated])
+def batch_edit_routine_workouts(request, routine_id):
+    """
+    Apply several add/remove/move/update operations to a routine in one
+    transaction and return the resulting routine
+    """
+    routine = get_object_or_404(Routine, id=routine_id, user=request.user)
+    if not isinstance(request.data, dict):
+        return Response({'error': 'Body must be an object with an operations list'}, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        with transaction.atomic(), coalesced_supabase_sync():
+            apply_operations(routine, request.data.get('operations'))
+    except RoutineEditError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    except Exception as e:
+        return Response({'error': str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    routine = Routine.objects.prefetch_related(
+        'routine_workouts__workout__muscle_group'
+    ).get(pk=routine.pk)
+    return Response(RoutineDetailSerializer(routine).data, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([IsAuthenticated])
+@catalog_cached('workout-modes')
 def get_workout_modes(request):
     from ..models import RoutineWorkout
     
@@ -1093,6 +1115,35 @@ def delete_notification_token(request):
             'error': f'An error occurred: {str(e)}'
         }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
     
+@api_view(['GET'])
+@permission_classes([permissions.IsAuthenticated])
+def get_challenge_leaderboard(request, challengeId):
+    """
+    Last persisted scores of a challenge, for clients (re)joining the live
+    rivalries/<id>/leaderboard deltas. May trail live scores by a few seconds.
+    """
+    challenge = get_object_or_404(Challenge, id=challengeId)
+    if request.user.id not in (challenge.from_user_id, challenge.to_user_id):
+        return Response({
+            'success': False,
+            'error': 'You do not have permission to view this challenge'
+        }, status=status.HTTP_403_FORBIDDEN)
+
+    scores = dict(challenge.scores.values_list('user_id', 'score'))
+    participants = sorted(
+        (challenge.from_user_id, challenge.to_user_id),
+        key=lambda user_id: -scores.get(user_id, 0),
+    )
+    return Response({
+        'success': True,
+        'challenge_id': challenge.id,
+        'status': challenge.status,
+        'standings': [
+            {'user_id': user_id, 'score': scores.get(user_id, 0), 'rank': position}
+            for position, user_id in enumerate(participants, start=1)
+        ],
+    }, status=status.HTTP_200_OK)
+
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
 def get_challenge_routine_detail(request, challengeId):
@@ -1220,7 +1271,7 @@ def add_fitness_goals(request):
         }, status=status.HTTP_200_OK)
 
     except Exception as e:
-        print(f"Error in add_fitness_goals: {traceback.format_exc()}")
+        logger.exception("Error in add_fitness_goals")
         return Response({
             'success': False,
             'error': str(e)
@@ -1273,7 +1324,7 @@ def add_conditions(request):
         }, status=status.HTTP_200_OK)
 
     except Exception as e:
-        print(f"Error in add_conditions: {traceback.format_exc()}")
+        logger.exception("Error in add_conditions")
         return Response({
             'success': False,
             'error': str(e)
@@ -1325,6 +1376,7 @@ def get_conditions(request):
     
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
+@catalog_cached('conditions')
 def get_all_conditions(request):
     try:
         conditions = ConditionOrInjury.objects.all()
@@ -1343,6 +1395,7 @@ def get_all_conditions(request):
     
 @api_view(['GET'])
 @permission_classes([permissions.IsAuthenticated])
+@catalog_cached('fitness-goals')
 def get_all_goals(request):
     try:
         goals = FitnessGoal.objects.all()
@@ -1377,7 +1430,7 @@ def generate_personalized_workout(request):
             metadata.conditions_and_injuries.values_list('key', flat=True)
         )
 
-        print(f"User {user.id} - Goals: {fitness_goals}, Conditions: {conditions}")
+        logger.debug("User %s - Goals: %s, Conditions: %s", user.id, fitness_goals, conditions)
 
         # Validate that user has set goals
         if not fitness_goals:
@@ -1406,15 +1459,11 @@ def generate_personalized_workout(request):
                 'video_url': workout.video_url if hasattr(workout, 'video_url') else ''
             })
 
-        print(f"Found {len(workouts_data)} workouts in database")
-
         # Get user's experience level - add default if field doesn't exist
         experience_level = getattr(metadata, 'experience_level', 'beginner')
         if experience_level not in ['beginner', 'intermediate', 'advanced', 'expert']:
             experience_level = 'beginner'
 
-        print(f"User experience level: {experience_level}")
-
         # Build user profile
         user_profile = {
             'goals': fitness_goals,
@@ -1425,9 +1474,8 @@ def generate_personalized_workout(request):
         # Initialize recommendation engine
         try:
             engine = WorkoutRecommendationEngine(workouts_data, user_profile)
-            print("Recommendation engine initialized")
         except Exception as init_error:
-            print(f"Error initializing engine: {traceback.format_exc()}")
+            logger.exception("Error initializing recommendation engine")
             return Response({
                 'success': False,
                 'error': f'Error initializing recommendation engine: {str(init_error)}'
@@ -1436,9 +1484,8 @@ def generate_personalized_workout(request):
         # Generate routines
         try:
             routines_data = engine.generate_routines(num_routines=3, workouts_per_routine=5)
-            print(f"Generated {len(routines_data)} routine templates")
         except Exception as engine_error:
-            print(f"Error generating routines: {traceback.format_exc()}")
+            logger.exception("Error generating routines")
             return Response({
                 'success': False,
                 'error': f'Error generating routines: {str(engine_error)}'
@@ -1464,15 +1511,13 @@ def generate_personalized_workout(request):
                         is_public=False
                     )
                     
-                    print(f"Created routine: {routine.name}")
-                    
                     # Create RoutineWorkouts for each workout
                     workouts_created = 0
                     for order, workout_config in enumerate(routine_data['workouts'], start=1):
                         try:
                             workout_id = workout_config.get('workout_id')
                             if not workout_id:
-                                print(f"Warning: No workout_id in config: {workout_config}")
+                                logger.warning("No workout_id in config: %s", workout_config)
                                 continue
                                 
                             workout = Workout.objects.get(id=workout_id)
@@ -1492,22 +1537,20 @@ def generate_personalized_workout(request):
                             workouts_created += 1
                             
                         except Workout.DoesNotExist:
-                            print(f"Warning: Workout {workout_id} does not exist, skipping")
+                            logger.warning("Workout %s does not exist, skipping", workout_id)
                             continue
                         except Exception as workout_error:
-                            print(f"Error creating routine workout: {traceback.format_exc()}")
+                            logger.exception("Error creating routine workout")
                             continue
                     
                     if workouts_created > 0:
                         created_routines.append(routine)
-                        print(f"Added {workouts_created} workouts to routine {routine.name}")
                     else:
                         # Delete routine if no workouts were added
                         routine.delete()
-                        print(f"Deleted routine {routine.name} - no workouts added")
                         
                 except Exception as routine_error:
-                    print(f"Error creating routine: {traceback.format_exc()}")
+                    logger.exception("Error creating routine")
                     continue
 
         if not created_routines:
@@ -1519,8 +1562,8 @@ def generate_personalized_workout(request):
         # Serialize and return
         serializer = RoutineDetailSerializer(created_routines, many=True)
         
-        print(f"Successfully created {len(created_routines)} routines")
-        
+        log_event(logger, logging.INFO, 'workout.routines_generated', user_id=user.id, routines=len(created_routines))
+
         return Response({
             'success': True,
             'message': f'Successfully generated {len(created_routines)} personalized routines',
@@ -1528,8 +1571,7 @@ def generate_personalized_workout(request):
         }, status=status.HTTP_201_CREATED)
 
     except Exception as e:
-        # Log the full error for debugging
-        print(f"Full error traceback in generate_personalized_workout:\n{traceback.format_exc()}")
+        logger.exception("Error in generate_personalized_workout")
         
         return Response({
             'success': False,
@@ -1599,7 +1641,50 @@ def get_mqtt_credentials(request):
             ],
             'subscribe': [
                 f"friends/{user.id}/locations",
-                f"rivalries/+/updates"  # + is wildcard
+                f"rivalries/+/updates",  # + is wildcard
+                f"rivalries/+/leaderboard"
             ]
         }
-    })
\ No newline at end of file
+    })
+
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def list_sounds(request):
+    """
+    Ready soundbites with their waveform peaks and streaming URLs, so the
+    app can draw and start playing a sound without downloading it first
+    """
+    sounds = Sound.objects.filter(status=Sound.STATUS_READY)
+    return Response([
+        {
+            'id': str(sound.id),
+            'name': sound.name,
+            'duration': sound.duration,
+            'peaks': sound.peaks or None,
+            **media_urls(request, sound),
+        }
+        for sound in sounds
+    ])
+
+
+@api_view(['GET'])
+@authentication_classes([])
+@permission_classes([AllowAny])
+def sound_media(request, sound_id, variant):
+    """
+    Sound audio ('audio') or preview clip ('preview') with byte-range support.
+    Public like /media/ since audio players can't send the bearer token;
+    URLs carrying the current ?v= are cached as immutable.
+    """
+    sound = get_object_or_404(Sound, id=sound_id)
+    field = {'audio': sound.file, 'preview': sound.preview}.get(variant)
+    if not field or not os.path.exists(field.path):
+        raise NotFound('Sound media not found')
+
+    content_type = mimetypes.guess_type(field.path)[0] or 'application/octet-stream'
+    return ranged_file_response(
+        request, field.path, content_type,
+        etag_seed=f"{sound.id.hex}-{variant}",
+        immutable=request.GET.get('v') == media_version(sound),
+    )
@@ -10,14 +10,16 @@ class MasshealthConfig(AppConfig):
     def ready(self):
         """Initialize MQTT connection when Django starts"""
         import os
+        from . import signals  # noqa: F401
         
-        # ONLY connect in the main process (not the reloader)
-        if os.environ.get('RUN_MAIN') == 'true':
-            print("Initializing MQTT in main process...")
+        from django.conf import settings
+
+        # ONLY connect in the main process (not the reloader), and not when
+        # ingestion runs as a separate mqtt_worker service
+        if os.environ.get('RUN_MAIN') == 'true' and getattr(settings, 'MQTT_IN_PROCESS', True):
+            logger.info("Initializing MQTT in main process")
             try:
                 from masshealth.services.mqtt_client import mqtt_client
                 mqtt_client.connect()
-            except Exception as e:
-                print(f"Error in ready(): {e}")
-                import traceback
-                traceback.print_exc()
\ No newline at end of file
+            except Exception:
+                logger.exception("Error in ready()")
\ No newline at end of file
@@ -8,4 +8,50 @@ class SyncToSupabaseCron(CronJobBase):
     
     def do(self):
         from django.core.management import call_command
-        call_command('sync_to_supabase')
\ No newline at end of file
+        call_command('sync_to_supabase')
+
+
+class RebuildDailyStatsCron(CronJobBase):
+    # Nightly correction for drift in the incrementally updated counters
+    schedule = Schedule(run_at_times=['03:00'])
+    code = 'masshealth.rebuild_daily_stats'
+
+    def do(self):
+        from django.core.management import call_command
+        call_command('rebuild_daily_stats')
+
+
+class ProcessPendingSoundsCron(CronJobBase):
+    # Picks up sound uploads the in-process job queue dropped or lost on restart
+    RUN_EVERY_MINS = 10
+
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'masshealth.process_pending_sounds'
+
+    def do(self):
+        from django.core.management import call_command
+        call_command('process_pending_sounds')
+
+
+class ProcessProfileImagesCron(CronJobBase):
+    # Renditions for uploads whose background job was dropped or lost on restart
+    RUN_EVERY_MINS = 10
+
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'masshealth.process_profile_images'
+
+    def do(self):
+        from django.core.management import call_command
+        call_command('process_profile_images')
+
+
+class AnalyzeActivityCron(CronJobBase):
+    # Step analysis for sensor chunks written since the last run
+    RUN_EVERY_MINS = 15
+
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'masshealth.recompute_activity'
+
+    def do(self):
+        from django.core.management import call_command
+        call_command('recompute_activity')
@@ -0,0 +1,87 @@
+import os
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from masshealth.services import mdct
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the in-process MDCT codec against the external compressor'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--file', type=str, help='16-bit PCM WAV to compress (default: synthetic audio)')
+        parser.add_argument('--seconds', type=float, default=30, help='Length of the synthetic test signal')
+        parser.add_argument('--n', type=int, default=1024, help='Block size N')
+        parser.add_argument('--m', type=int, default=100, help='Coefficients discarded per block M')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per codec (best time is reported)')
+        parser.add_argument('--batch-blocks', type=int, default=mdct.DEFAULT_BATCH_BLOCKS,
+                            help='Blocks per matrix product in the Python codec')
+
+    def handle(self, *args, **options):
+        N, M = options['n'], options['m']
+
+        with tempfile.TemporaryDirectory() as workdir:
+            input_path = options['file'] or self.write_test_signal(workdir, options['seconds'])
+            samples, sample_rate = mdct.read_wav(input_path)
+            audio_seconds = len(samples) / sample_rate
+            self.stdout.write(
+                f'Input: {input_path} ({audio_seconds:.1f}s, {samples.shape[1]} channel(s), {sample_rate} Hz), N={N}, M={M}'
+            )
+
+            python_output = None
+            best = float('inf')
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                python_output, stats = mdct.compress_wav(input_path, N, M, options['batch_blocks'])
+                best = min(best, time.perf_counter() - started)
+            self.report('python', best, audio_seconds)
+            self.stdout.write(f"  encoded {stats['encoded_size']} bytes, ratio {stats['ratio']}:1")
+
+            mdct_path = getattr(settings, 'MDCT_COMPRESSOR_PATH', None)
+            if not (mdct_path and os.path.exists(mdct_path)):
+                self.stdout.write(self.style.WARNING('External compressor not configured, skipping comparison'))
+                return
+
+            external_path = os.path.join(workdir, 'external.wav')
+            best = float('inf')
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                result = subprocess.run(
+                    [mdct_path, os.path.abspath(input_path), external_path, str(N), str(M)],
+                    capture_output=True, cwd=os.path.dirname(mdct_path),
+                )
+                best = min(best, time.perf_counter() - started)
+                if result.returncode != 0:
+                    self.stderr.write(self.style.ERROR(f'External compressor failed: {result.stderr.decode(errors="replace")}'))
+                    return
+            self.report('external', best, audio_seconds)
+
+            ours, _ = mdct.read_wav(python_output)
+            theirs, _ = mdct.read_wav(external_path)
+            length = min(len(ours), len(theirs))
+            difference = np.abs(ours[:length].astype(np.int32) - theirs[:length].astype(np.int32))
+            self.stdout.write(
+                f'Output difference: max {difference.max()} LSB, '
+                f'{np.count_nonzero(difference)} of {difference.size} samples differ'
+            )
+
+    def write_test_signal(self, workdir, seconds, sample_rate=44100):
+        # Two tones and some noise, different per channel so the side channel is not empty
+        t = np.arange(int(seconds * sample_rate)) / sample_rate
+        rng = np.random.default_rng(0)
+        left = 8000 * np.sin(2 * np.pi * 440 * t) + 1000 * rng.standard_normal(t.size)
+        right = 6000 * np.sin(2 * np.pi * 660 * t) + 1000 * rng.standard_normal(t.size)
+        samples = np.clip(np.stack([left, right], axis=1), -32768, 32767).astype('<i2')
+        path = os.path.join(workdir, 'signal.wav')
+        mdct.write_wav(path, samples, sample_rate)
+        return path
+
+    def report(self, name, seconds, audio_seconds):
+        self.stdout.write(self.style.SUCCESS(
+            f'{name}: {seconds * 1000:.0f} ms ({audio_seconds / seconds:.0f}x realtime)'
+        ))
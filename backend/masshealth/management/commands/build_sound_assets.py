@@ -0,0 +1,26 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from masshealth.models import Sound
+from masshealth.services.sound_assets import build_sound_assets
+
+
+class Command(BaseCommand):
+    help = 'Build waveform peaks and preview clips for ready sounds that have none'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Rebuild for every ready sound')
+
+    def handle(self, *args, **options):
+        sounds = Sound.objects.filter(status=Sound.STATUS_READY)
+        if not options['all']:
+            sounds = sounds.filter(peaks={})
+
+        built = 0
+        for sound in sounds.iterator():
+            if build_sound_assets(sound, settings.MEDIA_ROOT) is None:
+                self.stderr.write(f'Could not decode {sound.id} ({sound.name})')
+                continue
+            sound.save(update_fields=['peaks', 'preview', 'updated_at'])
+            built += 1
+        self.stdout.write(self.style.SUCCESS(f'Built assets for {built} sound(s)'))
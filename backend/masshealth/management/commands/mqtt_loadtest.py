@@ -0,0 +1,284 @@
+import json
+import platform
+import queue
+import threading
+import time
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connection
+from django.test.utils import override_settings
+
+from masshealth.models import CustomUser, DailyActivity, SensorChunk, UserLocation
+from masshealth.signals import daily_stats_paused
+from masshealth.services.metrics import registry
+from masshealth.services.mqtt_handlers import SUBSCRIPTIONS, attach_publisher, flush_buffers
+from masshealth.services.mqtt_loadtest import DeviceSimulator, LoopbackBroker, LoopbackWorker
+from masshealth.services.mqtt_outbox import Outbox
+
+USER_EMAIL = 'loadtest-{}@loadtest.invalid'
+DEVICE_PREFIX = 'loadtest-'
+
+# Report key -> (path into the report, True if higher is better)
+COMPARED = {
+    'throughput': (('throughput',), True),
+    'latency p95': (('latency_ms', 'p95'), False),
+    'cpu per message': (('cpu', 'us_per_message'), False),
+    'drop rate': (('drop_rate',), False),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        'Load-test MQTT ingestion against an in-process broker stand-in and write a JSON report. '
+        'Writes users, locations and sensor chunks to the default database (removed afterwards '
+        'unless --keep), so point it at a scratch database.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--target', choices=['client', 'worker'], default='client',
+                            help='Ingest through the in-process paho MQTTClient or the asyncio mqtt_worker')
+        parser.add_argument('--rate', type=int, default=1000, help='Messages per second, all devices together')
+        parser.add_argument('--duration', type=float, default=10, help='Seconds to publish for')
+        parser.add_argument('--users', type=int, default=100, help='Simulated users publishing locations')
+        parser.add_argument('--devices', type=int, default=100, help='Simulated wearables publishing sensor data')
+        parser.add_argument('--location-share', type=float, default=0.2, help='Fraction of messages that are locations')
+        parser.add_argument('--format', choices=['json', 'binary'], default='json', help='Payload encoding')
+        parser.add_argument('--samples', type=int, default=10, help='Accelerometer samples per sensor message')
+        parser.add_argument('--queue', type=int, default=10000, help='Broker queue per subscriber before dropping')
+        parser.add_argument('--concurrency', type=int, help='mqtt_worker in-flight messages')
+        parser.add_argument('--db-workers', type=int, help='mqtt_worker database threads')
+        parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds to wait for the backlog after publishing')
+        parser.add_argument('--output', type=str, help='Write the JSON report here')
+        parser.add_argument('--compare', type=str, help='Baseline report; exit with an error on regressions')
+        parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression for --compare')
+        parser.add_argument('--keep', action='store_true', help='Keep the generated rows')
+
+    def handle(self, *args, **options):
+        if options['target'] == 'worker':
+            try:
+                import aiomqtt  # noqa: F401
+            except ImportError:
+                raise CommandError('--target worker needs the aiomqtt package (pip install aiomqtt)')
+        if options['target'] == 'client':
+            try:
+                import paho.mqtt.client  # noqa: F401
+            except ImportError:
+                raise CommandError('--target client needs the paho-mqtt package (pip install paho-mqtt)')
+
+        # Generated rows must not be mirrored to Supabase
+        with override_settings(SYNC_TO_SUPABASE=False):
+            user_ids = self.create_users(options['users'])
+            device_ids = [f'{DEVICE_PREFIX}{i}' for i in range(options['devices'])]
+            try:
+                report = self.run(options, user_ids, device_ids)
+            finally:
+                if not options['keep']:
+                    self.cleanup(user_ids)
+
+        self.print_report(report)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, indent=2)
+            self.stdout.write(f"Report written to {options['output']}")
+        if options['compare']:
+            self.compare(report, options['compare'], options['tolerance'])
+
+    def create_users(self, count):
+        password = make_password(None)
+        CustomUser.objects.bulk_create(
+            [CustomUser(email=USER_EMAIL.format(i), full_name=f'Load test {i}', password=password) for i in range(count)],
+            ignore_conflicts=True,
+            batch_size=500,
+        )
+        return list(
+            CustomUser.objects.filter(email__in=[USER_EMAIL.format(i) for i in range(count)]).values_list('id', flat=True)
+        )
+
+    def cleanup(self, user_ids):
+        SensorChunk.objects.filter(device_id__startswith=DEVICE_PREFIX).delete()
+        DailyActivity.objects.filter(device_id__startswith=DEVICE_PREFIX).delete()
+        UserLocation.objects.filter(user_id__in=user_ids).delete()
+        # The users were bulk_created without counting signups, so do not count them as deleted
+        with daily_stats_paused():
+            CustomUser.objects.filter(id__in=user_ids).delete()
+
+    def run(self, options, user_ids, device_ids):
+        registry.reset()
+        broker = LoopbackBroker(max_queued=options['queue'])
+        simulator = DeviceSimulator(
+            broker, user_ids, device_ids, options['rate'], options['duration'],
+            location_share=options['location_share'], binary=options['format'] == 'binary',
+            samples_per_message=options['samples'],
+        )
+        latencies = []
+        # Not the process-wide outbox: that one replays the real spool, and
+        # load-test messages left at the end must not be spooled for the live broker
+        outbox = Outbox(config={**getattr(settings, 'MQTT_OUTBOX', {}), 'SPOOL_PATH': None})
+        attach_publisher(outbox.put)
+
+        self.stdout.write(
+            f"Publishing {options['rate']} msg/s for {options['duration']}s to the {options['target']} "
+            f"({len(user_ids)} users, {len(device_ids)} devices, {options['format']})"
+        )
+        cpu_started = time.process_time()
+        started = time.perf_counter()
+        publisher = threading.Thread(target=simulator.run, name='loadtest-devices')
+        if options['target'] == 'client':
+            processed, failed = self.run_client(broker, publisher, latencies, outbox, options['drain_timeout'])
+        else:
+            processed, failed = self.run_worker(broker, publisher, latencies, outbox, options)
+        # The location handler logs and swallows its own exceptions
+        swallowed = self.counter_total('mqtt.handler_failed')
+        processed, failed = processed - swallowed, failed + swallowed
+        wall = time.perf_counter() - started
+        cpu = time.process_time() - cpu_started
+
+        rows = {
+            'user_location': UserLocation.objects.filter(user_id__in=user_ids).count(),
+            'sensor_chunk': SensorChunk.objects.filter(device_id__startswith=DEVICE_PREFIX).count(),
+        }
+        delivered = broker.published - broker.dropped
+        latency = np.asarray(latencies) * 1000
+        return {
+            'config': {
+                key: options[key] for key in (
+                    'target', 'rate', 'duration', 'users', 'devices', 'location_share',
+                    'format', 'samples', 'queue', 'concurrency', 'db_workers',
+                )
+            },
+            'environment': {
+                'python': platform.python_version(),
+                'database': connection.vendor,
+                'machine': platform.machine(),
+            },
+            'published': broker.published,
+            'publish_rate': round(broker.published / simulator.elapsed, 1) if simulator.elapsed else 0,
+            'processed': processed,
+            'failed': failed,
+            'dropped_by_broker': broker.dropped,
+            'unprocessed': max(delivered - processed - failed, 0),
+            'drop_rate': round((broker.published - processed) / broker.published, 5) if broker.published else 0,
+            'wall_seconds': round(wall, 3),
+            'throughput': round(processed / wall, 1),
+            'latency_ms': {
+                name: round(float(value), 3) for name, value in zip(
+                    ('p50', 'p90', 'p95', 'p99', 'max'),
+                    np.percentile(latency, [50, 90, 95, 99, 100]) if len(latency) else [0] * 5,
+                )
+            },
+            'db_rows': rows,
+            'db_rows_per_sec': round(sum(rows.values()) / wall, 1),
+            'cpu': {
+                'seconds': round(cpu, 3),
+                'utilisation': round(cpu / wall, 3),
+                'us_per_message': round(cpu / processed * 1e6, 1) if processed else None,
+            },
+            'server_publishes': broker.server_publishes,
+            'metrics': registry.snapshot('mqtt.'),
+        }
+
+    def wait_for_backlog(self, broker, progress, timeout):
+        """Wait until everything the broker delivered was handled, or the timeout"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if sum(progress()) >= broker.published - broker.dropped:
+                return
+            time.sleep(0.05)
+        self.stderr.write(self.style.WARNING('Drain timeout reached with messages still queued'))
+
+    def run_client(self, broker, publisher, latencies, outbox, drain_timeout):
+        from masshealth.services.mqtt_client import MQTTClient
+
+        client = MQTTClient()
+        outbox.attach(broker.outbox_send)
+        inbox = queue.Queue(broker.max_queued)
+        for topic in SUBSCRIPTIONS:
+            broker.subscribe(topic, inbox)
+        counts = {'handled': 0}
+        errors_before = self.counter_total('mqtt.errors')
+
+        def deliver():
+            # paho calls on_message from its single network thread
+            while True:
+                message = inbox.get()
+                if message is None:
+                    return
+                client.on_message(None, None, message)
+                latencies.append(time.perf_counter() - message.payload.published_at)
+                counts['handled'] += 1
+
+        delivery = threading.Thread(target=deliver, name='loadtest-delivery')
+        delivery.start()
+        publisher.start()
+        publisher.join()
+        self.wait_for_backlog(broker, lambda: (counts['handled'],), drain_timeout)
+        inbox.put(None)
+        delivery.join()
+        flush_buffers()
+        outbox.close()
+        failed = self.counter_total('mqtt.errors') - errors_before
+        return counts['handled'] - failed, failed
+
+    def run_worker(self, broker, publisher, latencies, outbox, options):
+        import asyncio
+
+        worker = LoopbackWorker(
+            broker, latencies,
+            concurrency=options['concurrency'], db_workers=options['db_workers'], outbox=outbox,
+        )
+
+        def drive(loop):
+            publisher.start()
+            publisher.join()
+            self.wait_for_backlog(broker, lambda: (worker.processed, worker.failed), options['drain_timeout'])
+            loop.call_soon_threadsafe(worker.stop)
+
+        async def main():
+            threading.Thread(target=drive, args=(asyncio.get_running_loop(),), name='loadtest-driver').start()
+            await worker.run()
+
+        asyncio.run(main())
+        return worker.processed, worker.failed
+
+    def counter_total(self, name):
+        return sum(registry.snapshot(name).get(name, {}).values())
+
+    def print_report(self, report):
+        latency = report['latency_ms']
+        self.stdout.write(self.style.SUCCESS(
+            f"{report['processed']}/{report['published']} messages in {report['wall_seconds']}s: "
+            f"{report['throughput']} msg/s, latency p50 {latency['p50']} ms / p99 {latency['p99']} ms"
+        ))
+        self.stdout.write(
+            f"dropped {report['dropped_by_broker']}, failed {report['failed']}, unprocessed {report['unprocessed']}; "
+            f"DB rows {report['db_rows']} ({report['db_rows_per_sec']}/s); "
+            f"CPU {report['cpu']['utilisation'] * 100:.0f}% ({report['cpu']['us_per_message']} us/msg); "
+            f"server publishes {report['server_publishes']}"
+        )
+
+    def compare(self, report, baseline_path, tolerance):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+        regressions = []
+        for name, (path, higher_is_better) in COMPARED.items():
+            current, previous = report, baseline
+            for key in path:
+                current, previous = (current or {}).get(key), (previous or {}).get(key)
+            if current is None or previous is None:
+                continue
+            if higher_is_better:
+                regressed = current < previous * (1 - tolerance)
+            else:
+                # Absolute floor so near-zero baselines (no drops) do not flag noise
+                regressed = current > previous * (1 + tolerance) and current - previous > 1e-3
+            self.stdout.write(f"  {name}: {previous} -> {current}{'  REGRESSION' if regressed else ''}")
+            if regressed:
+                regressions.append(name)
+
+        if regressions:
+            raise CommandError(f"Regressed against {baseline_path}: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS(f'No regressions against {baseline_path}'))
@@ -0,0 +1,39 @@
+import asyncio
+
+from django.core.management.base import BaseCommand, CommandError
+
+from masshealth.services.mqtt_handlers import SUBSCRIPTIONS
+
+
+class Command(BaseCommand):
+    help = 'Run MQTT ingestion as a standalone asyncio service (scale out with shared subscriptions)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--topics', nargs='+', choices=SUBSCRIPTIONS,
+            help='Subscriptions to handle, all shared (default: all, with rivalries/ not shared)',
+        )
+        parser.add_argument('--group', type=str, help='Shared subscription group (default: MQTT_WORKER SHARED_GROUP)')
+        parser.add_argument('--no-share', action='store_true', help='Subscribe without $share/, every message to this worker')
+        parser.add_argument('--concurrency', type=int, help='Messages processed at once')
+        parser.add_argument('--db-workers', type=int, help='Threads running database handlers')
+
+    def handle(self, *args, **options):
+        try:
+            import aiomqtt  # noqa: F401
+        except ImportError:
+            raise CommandError('mqtt_worker needs the aiomqtt package (pip install aiomqtt)')
+        from masshealth.services.mqtt_worker import MQTTWorker
+
+        worker = MQTTWorker(
+            topics=options['topics'],
+            group='' if options['no_share'] else options['group'],
+            concurrency=options['concurrency'],
+            db_workers=options['db_workers'],
+        )
+        self.stdout.write(f'Starting MQTT worker for {", ".join(map(worker.subscription, worker.topics))}')
+        try:
+            asyncio.run(worker.run())
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write(self.style.SUCCESS(f'MQTT worker stopped ({worker.processed} messages processed)'))
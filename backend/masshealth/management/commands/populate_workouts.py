@@ -1,11 +1,15 @@
 # management/commands/populate_workouts.py
 
-import json
+import time
 from django.core.management.base import BaseCommand
-from masshealth.models import Workout, MuscleGroup  
+from masshealth.models import coalesced_supabase_sync
+from masshealth.services.catalog_cache import bump_catalog_version
+from masshealth.services.exercise_import import (
+    IMPORT_BATCH_SIZE, ExerciseImporter, ExerciseImportError, iter_json_array, iter_ndjson,
+)
 
 class Command(BaseCommand):
-    help = 'Populate workouts from JSON data'
+    help = 'Populate workouts from JSON data (a JSON array or NDJSON, streamed)'
     
     def add_arguments(self, parser):
         parser.add_argument(
@@ -14,76 +18,100 @@ class Command(BaseCommand):
             help='Path to JSON file containing workout data',
             default='workouts.json'
         )
+        parser.add_argument(
+            '--format',
+            choices=['json', 'ndjson'],
+            help='Input format (default: from the file extension)'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=IMPORT_BATCH_SIZE,
+            help='Rows written per transaction'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Parse and match everything without writing to the database'
+        )
     
     def handle(self, *args, **options):
         file_path = options['file']
+        file_format = options['format'] or ('ndjson' if file_path.endswith(('.ndjson', '.jsonl')) else 'json')
+        batch_size = max(options['batch_size'], 1)
         
         try:
-            with open(file_path, 'r') as file:
-                workouts_data = json.load(file)
+            file = open(file_path, 'r', encoding='utf-8')
         except FileNotFoundError:
             self.stdout.write(
                 self.style.ERROR(f'File {file_path} not found')
             )
             return
-        except json.JSONDecodeError:
-            self.stdout.write(
-                self.style.ERROR('Invalid JSON format')
-            )
-            return
         
-        created_count = 0
-        skipped_count = 0
-        error_count = 0
+        importer = ExerciseImporter(batch_size=batch_size, dry_run=options['dry_run'])
+        entries = iter_ndjson(file) if file_format == 'ndjson' else iter_json_array(file, wrapper_key='exercises')
+        processed = 0
+        reported_batches = 0
+        started = time.monotonic()
         
-        for workout_data in workouts_data:
-            try:
-                # Skip entries without names or with empty target_muscle_group
-                if not workout_data.get('name') or not workout_data.get('target_muscle_group'):
-                    skipped_count += 1
-                    continue
-                
-                # Get or create muscle group
-                muscle_group_name = workout_data['target_muscle_group']
-                muscle_group, _ = MuscleGroup.objects.get_or_create(name=muscle_group_name)
-                
-                # Map field values to model choices
-                exercise_type = self.map_exercise_type(workout_data.get('exercise_type', ''))
-                equipment = self.map_equipment(workout_data.get('equipment_required', ''))
-                experience_level = workout_data.get('experience_level', 'Beginner').lower()
-                
-                # Create workout if it doesn't exist
-                workout, created = Workout.objects.get_or_create(
-                    name=workout_data['name'],
-                    defaults={
-                        'video_url': workout_data.get('video_url', ''),
-                        'exercise_type': exercise_type,
-                        'equipment_required': equipment,
-                        'mechanics': workout_data.get('mechanics', '').lower(),
-                        'force_type': self.map_force_type(workout_data.get('force_type', '')),
-                        'experience_level': experience_level,
-                        'muscle_group': muscle_group,
-                    }
-                )
+        try:
+            with file, coalesced_supabase_sync():
+                try:
+                    for workout_data in entries:
+                        processed += 1
+                        try:
+                            if not isinstance(workout_data, dict):
+                                raise ExerciseImportError(f'Entry {processed} is not an object')
+                            # Skip entries without names or with empty target_muscle_group
+                            if not workout_data.get('name') or not workout_data.get('target_muscle_group'):
+                                importer.skipped += 1
+                                continue
+                            importer.add(*self.map_workout(workout_data))
+                        except (ExerciseImportError, AttributeError, TypeError) as e:
+                            # AttributeError / TypeError: malformed field values (e.g. null strings)
+                            importer.add_error(str(e))
+                            self.stdout.write(
+                                self.style.ERROR(f'Error creating workout: {e}')
+                            )
+                        
+                        if importer.batches_flushed != reported_batches:
+                            reported_batches = importer.batches_flushed
+                            self.report_progress(processed, started)
+                except ExerciseImportError as e:
+                    # Unreadable input: keep (and sync) what was read before it
+                    importer.stop(str(e))
+                    self.stdout.write(
+                        self.style.ERROR(f'Invalid input after {processed} entries: {e}')
+                    )
                 
-                if created:
-                    created_count += 1
-                    self.stdout.write(f'Created: {workout_data["name"]}')
-                else:
-                    skipped_count += 1
-                    
-            except Exception as e:
-                error_count += 1
-                self.stdout.write(
-                    self.style.ERROR(f'Error creating workout {workout_data.get("name", "Unknown")}: {str(e)}')
-                )
+                importer.flush()
+        finally:
+            if (importer.created or importer.updated) and not options['dry_run']:
+                bump_catalog_version()
         
+        self.report_progress(processed, started)
+        prefix = '[dry run] ' if options['dry_run'] else ''
         self.stdout.write(
             self.style.SUCCESS(
-                f'\nSummary: {created_count} created, {skipped_count} skipped, {error_count} errors'
+                f'\n{prefix}Summary: {importer.created} created, {importer.skipped} skipped, {importer.error_count} errors'
             )
         )
     
+    def report_progress(self, processed, started):
+        elapsed = max(time.monotonic() - started, 1e-6)
+        self.stdout.write(f'Processed {processed} entries in {elapsed:.1f}s ({processed / elapsed:.0f}/s)')
+    
+    def map_workout(self, workout_data):
+        """(name, muscle group name, field values) for the importer"""
+        return workout_data['name'], workout_data['target_muscle_group'], {
+            'video_url': workout_data.get('video_url', ''),
+            'exercise_type': self.map_exercise_type(workout_data.get('exercise_type', '')),
+            'equipment_required': self.map_equipment(workout_data.get('equipment_required', '')),
+            'mechanics': workout_data.get('mechanics', '').lower(),
+            'force_type': self.map_force_type(workout_data.get('force_type', '')),
+            'experience_level': workout_data.get('experience_level', 'Beginner').lower(),
+        }
+    
     def map_exercise_type(self, exercise_type):
         mapping = {
             'Strength': 'strength',
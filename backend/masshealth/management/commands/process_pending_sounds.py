@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from masshealth.services.sound_processing import process_sound, stale_pending_sounds
+
+
+class Command(BaseCommand):
+    help = 'Process sound uploads stuck in the pending state'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            default=10,
+            help='Only pick up sounds pending for at least this many minutes'
+        )
+
+    def handle(self, *args, **options):
+        sound_ids = stale_pending_sounds(options['older_than'])
+        for sound_id in sound_ids:
+            process_sound(sound_id)
+            self.stdout.write(f'Processed sound {sound_id}')
+        self.stdout.write(self.style.SUCCESS(f'{len(sound_ids)} pending sound(s) processed'))
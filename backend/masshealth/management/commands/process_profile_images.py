@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+
+from masshealth.services.image_renditions import missing_renditions, process_profile_image
+
+
+class Command(BaseCommand):
+    help = 'Build renditions for profile images that have none (new uploads the job queue missed, or older images)'
+
+    def handle(self, *args, **options):
+        processed = 0
+        for metadata_id, image_name in missing_renditions():
+            try:
+                process_profile_image(metadata_id, image_name)
+            except Exception as e:
+                self.stderr.write(f'Could not process {image_name}: {e}')
+                continue
+            processed += 1
+            self.stdout.write(f'Processed {image_name}')
+        self.stdout.write(self.style.SUCCESS(f'{processed} profile image(s) processed'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from masshealth.services.daily_stats import rebuild_daily_stats
+
+
+class Command(BaseCommand):
+    help = 'Recompute the admin dashboard daily counters from the source tables'
+
+    def handle(self, *args, **options):
+        days = rebuild_daily_stats()
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt daily stats for {days} day(s)'))
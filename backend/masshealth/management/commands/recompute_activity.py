@@ -0,0 +1,37 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from masshealth.services.step_analytics import ALGORITHM_VERSION, analyze_day, stale_days
+
+
+class Command(BaseCommand):
+    help = 'Run step analysis over stored sensor chunks (new data, or history after an algorithm change)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true', help='Reprocess every day, not only stale ones')
+        parser.add_argument('--days', type=int, help='Only the last N days')
+        parser.add_argument('--device', type=str, help='Only this device id')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['days']:
+            since = timezone.localdate() - timedelta(days=options['days'] - 1)
+
+        pending = stale_days(all_days=options['all'], since=since, device_id=options['device'])
+        self.stdout.write(f'{len(pending)} device-day(s) to analyse with algorithm v{ALGORITHM_VERSION}')
+
+        started = time.perf_counter()
+        samples = 0
+        for device_id, day in pending:
+            activity = analyze_day(device_id, day)
+            if activity is None:
+                continue
+            samples += activity.samples
+            self.stdout.write(f'{device_id} {day}: {activity.steps} steps, {activity.active_minutes} active min')
+
+        elapsed = time.perf_counter() - started
+        rate = f', {samples / elapsed:,.0f} samples/s' if elapsed and samples else ''
+        self.stdout.write(self.style.SUCCESS(f'Analysed {samples:,} samples in {elapsed:.1f}s{rate}'))
@@ -0,0 +1,144 @@
+import contextvars
+import heapq
+import logging
+import time
+from collections import Counter
+from contextlib import ExitStack
+from functools import wraps
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from .services.metrics import COUNT_BUCKETS, registry
+
+logger = logging.getLogger(__name__)
+
+_current_profile = contextvars.ContextVar('request_profile', default=None)
+
+
+class RequestProfile:
+    """Timings collected while a single request is being handled"""
+
+    def __init__(self, max_queries):
+        self.max_queries = max_queries
+        self.query_count = 0
+        self.db_ms = 0.0
+        self.serializer_ms = 0.0
+        self.serializing = False
+        self.queries = []  # min-heap of the max_queries slowest (duration_ms, sql)
+        self.statements = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = (time.perf_counter() - start) * 1000
+            self.query_count += 1
+            self.db_ms += duration
+            self.statements[sql] += 1
+            alias = context['connection'].alias
+            entry = (duration, sql if alias == 'default' else f'[{alias}] {sql}')
+            if len(self.queries) < self.max_queries:
+                heapq.heappush(self.queries, entry)
+            elif duration > self.queries[0][0]:
+                heapq.heapreplace(self.queries, entry)
+
+
+def _timed_serializer_data(fget):
+    @wraps(fget)
+    def data(self):
+        profile = _current_profile.get()
+        if profile is None or profile.serializing:
+            return fget(self)
+        profile.serializing = True
+        start = time.perf_counter()
+        try:
+            return fget(self)
+        finally:
+            profile.serializer_ms += (time.perf_counter() - start) * 1000
+            profile.serializing = False
+    data.profiled = True
+    return data
+
+
+def install_serializer_timing():
+    """Time the top-level `.data` of every DRF serializer (nested ones are counted once)"""
+    from rest_framework import serializers
+
+    for serializer_class in (serializers.Serializer, serializers.ListSerializer):
+        prop = serializer_class.__dict__['data']
+        if not getattr(prop.fget, 'profiled', False):
+            serializer_class.data = property(_timed_serializer_data(prop.fget))
+
+
+class QueryProfilingMiddleware:
+    """
+    Records query count, DB time, serializer time and total latency for every
+    request into per-view histograms (see the admin metrics endpoint).
+    Optionally adds a Server-Timing header and logs slow requests with their SQL.
+    Only active with REQUEST_PROFILING['ENABLED'] (QUERY_PROFILING=True).
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        config = getattr(settings, 'REQUEST_PROFILING', {})
+        if not config.get('ENABLED', False):
+            raise MiddlewareNotUsed
+        self.server_timing = config.get('SERVER_TIMING', False)
+        self.slow_request_ms = config.get('SLOW_REQUEST_MS', 500)
+        self.max_logged_queries = config.get('SLOW_REQUEST_MAX_QUERIES', 20)
+        install_serializer_timing()
+
+    def __call__(self, request):
+        profile = RequestProfile(self.max_logged_queries)
+        token = _current_profile.set(profile)
+        start = time.perf_counter()
+        try:
+            # Every configured database, so Supabase queries are counted too
+            with ExitStack() as wrappers:
+                for db in connections.all():
+                    wrappers.enter_context(db.execute_wrapper(profile))
+                response = self.get_response(request)
+        finally:
+            _current_profile.reset(token)
+        total_ms = (time.perf_counter() - start) * 1000
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.view_name or f'{match.func.__module__}.{match.func.__qualname__}') if match else 'unresolved'
+        registry.histogram('http.latency_ms', view).observe(total_ms)
+        registry.histogram('http.db_ms', view).observe(profile.db_ms)
+        registry.histogram('http.serializer_ms', view).observe(profile.serializer_ms)
+        registry.histogram('http.queries', view, buckets=COUNT_BUCKETS).observe(profile.query_count)
+
+        if self.server_timing:
+            response['Server-Timing'] = (
+                f'db;dur={profile.db_ms:.1f};desc="{profile.query_count} queries", '
+                f'ser;dur={profile.serializer_ms:.1f}, '
+                f'total;dur={total_ms:.1f}'
+            )
+
+        if total_ms >= self.slow_request_ms:
+            registry.counter('http.slow_requests', view).inc()
+            self.log_slow_request(request, view, total_ms, profile)
+
+        return response
+
+    def log_slow_request(self, request, view, total_ms, profile):
+        repeated = [
+            f'  {count}x {sql[:200]}'
+            for sql, count in profile.statements.most_common(3) if count > 1
+        ]
+        slowest = [
+            f'  {duration:.1f}ms {sql[:500]}'
+            for duration, sql in sorted(profile.queries, reverse=True)
+        ]
+        logger.warning(
+            "Slow request %s %s (%s): %.1fms total, %d queries in %.1fms, serializers %.1fms\n"
+            "Repeated statements:\n%s\nSlowest queries:\n%s",
+            request.method, request.path, view, total_ms,
+            profile.query_count, profile.db_ms, profile.serializer_ms,
+            '\n'.join(repeated) or '  none',
+            '\n'.join(slowest) or '  none',
+        )
@@ -1,12 +1,14 @@
 from django.contrib.auth.models import AbstractUser, BaseUserManager
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Upper
 from django.core.exceptions import ValidationError
 from django.conf import settings
 import os
 import uuid
-from PIL import Image
 import threading
 import logging
+from collections import defaultdict
+from contextlib import contextmanager
 from django.utils import timezone
 
 logger = logging.getLogger(__name__)
@@ -23,6 +25,9 @@ def validate_image_format(image):
         raise ValidationError("Invalid image format")
     
 def profile_image_path(instance, filename):
+    if instance.profile_image_hash:
+        from .services.image_renditions import content_name
+        return content_name(instance.profile_image_hash, filename)
     ext = filename.split('.')[-1]
     filename = f"{uuid.uuid4()}.{ext}"
     return f'profile_images/user_{instance.user.id}/{filename}'
@@ -32,6 +37,82 @@ def sound_file_path(instance, filename):
     filename = f"{uuid.uuid4()}.{ext}"
     return f'sounds/{filename}'
 
+_sync_state = threading.local()
+
+
+class SupabaseSyncBatch:
+    """Collects pending Supabase syncs so a group of writes is pushed by one background job"""
+
+    def __init__(self):
+        self.upserts = {}  # (model, pk) -> None, insertion ordered so parents sync before children
+        self.deletes = []
+
+    def add_upserts(self, model, pks):
+        for pk in pks:
+            if pk is not None:
+                self.upserts[(model, pk)] = None
+
+    def add_deletes(self, model, pks):
+        for pk in pks:
+            if pk is not None:
+                self.upserts.pop((model, pk), None)
+                self.deletes.append((model, pk))
+
+    def flush(self):
+        if not (self.upserts or self.deletes) or not getattr(settings, 'SYNC_TO_SUPABASE', True):
+            return
+        threading.Thread(target=self._run, args=(list(self.upserts), list(self.deletes))).start()
+
+    @staticmethod
+    def _run(upserts, deletes):
+        deletes_by_model = defaultdict(list)
+        for model, pk in deletes:
+            deletes_by_model[model].append(pk)
+        for model, pks in deletes_by_model.items():
+            try:
+                model.objects.using('supabase').filter(pk__in=pks).delete()
+            except Exception as e:
+                logger.error(f"Failed to delete {len(pks)} {model.__name__} rows from Supabase: {e}")
+
+        for model, pk in upserts:
+            model(pk=pk)._sync_to_supabase()
+
+
+@contextmanager
+def coalesced_supabase_sync():
+    """
+    Gather every Supabase sync triggered inside the block (saves, deletes and
+    queue_supabase_sync calls) and send them as a single background job once
+    the surrounding transaction commits. Nested blocks share the outer batch.
+    """
+    batch = getattr(_sync_state, 'batch', None)
+    if batch is not None:
+        yield batch
+        return
+
+    batch = _sync_state.batch = SupabaseSyncBatch()
+    try:
+        yield batch
+    finally:
+        _sync_state.batch = None
+        # Also when the block raised: rows already written in autocommit mode
+        # still need syncing, and inside a rolled back transaction on_commit
+        # callbacks are discarded anyway
+        transaction.on_commit(batch.flush)
+
+
+def queue_supabase_sync(model, upserts=(), deletes=()):
+    """Sync rows written with bulk queries, which bypass save()/delete()"""
+    batch = getattr(_sync_state, 'batch', None)
+    if batch is None:
+        with coalesced_supabase_sync() as batch:
+            batch.add_upserts(model, upserts)
+            batch.add_deletes(model, deletes)
+        return
+    batch.add_upserts(model, upserts)
+    batch.add_deletes(model, deletes)
+
+
 class SyncToSupabaseMixin(models.Model):
     """Mixin to handle Supabase synchronization"""
     synced_at = models.DateTimeField(null=True, blank=True)
@@ -58,7 +139,11 @@ class SyncToSupabaseMixin(models.Model):
         # Queue sync to Supabase in background (non-blocking)
         # Only sync if we're saving to default database and sync is enabled
         if using_db == 'default' and getattr(settings, 'SYNC_TO_SUPABASE', True):
-            threading.Thread(target=self._sync_to_supabase).start()
+            batch = getattr(_sync_state, 'batch', None)
+            if batch is not None:
+                batch.add_upserts(self.__class__, [self.pk])
+            else:
+                threading.Thread(target=self._sync_to_supabase).start()
     
     def _sync_to_supabase(self):
         """Background sync to Supabase"""
@@ -132,9 +217,13 @@ class SyncToSupabaseMixin(models.Model):
         # Delete from Supabase in background if deleting from default
         if using_db == 'default' and getattr(settings, 'SYNC_TO_SUPABASE', True):
             pk_to_delete = self.pk
-            threading.Thread(
-                target=lambda: self.__class__.objects.using('supabase').filter(pk=pk_to_delete).delete()
-            ).start()
+            batch = getattr(_sync_state, 'batch', None)
+            if batch is not None:
+                batch.add_deletes(self.__class__, [pk_to_delete])
+            else:
+                threading.Thread(
+                    target=lambda: self.__class__.objects.using('supabase').filter(pk=pk_to_delete).delete()
+                ).start()
         
         # Delete locally
         super().delete(*args, **kwargs)
@@ -156,6 +245,25 @@ class CustomUserManager(BaseUserManager):
         return self.create_user(email, password, **extra_fields)
 
 
+class PrefixSearchIndex(models.Index):
+    """
+    Expression index that LIKE 'prefix%' lookups can use: created with
+    varchar_pattern_ops on PostgreSQL (whose default operator class only
+    serves LIKE under the C collation), as a plain index elsewhere.
+    """
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        index = self
+        if schema_editor.connection.vendor == 'postgresql':
+            from django.contrib.postgres.indexes import OpClass
+
+            index = models.Index(
+                *(OpClass(expression, name='varchar_pattern_ops') for expression in self.expressions),
+                name=self.name,
+            )
+        return models.Index.create_sql(index, model, schema_editor, using=using, **kwargs)
+
+
 class CustomUser(AbstractUser, SyncToSupabaseMixin):
     username = None  
     email = models.EmailField(unique=True)
@@ -167,6 +275,20 @@ class CustomUser(AbstractUser, SyncToSupabaseMixin):
     friends = models.ManyToManyField("self", blank=True, symmetrical=False)
     embedding = models.JSONField(null=True, blank=True)
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # Admin user listing: keyset pagination, prefix search and filters
+            models.Index(fields=['-created_at', '-id'], name='user_created_keyset_idx'),
+            PrefixSearchIndex(Upper('email'), name='user_email_upper_idx'),
+            PrefixSearchIndex(Upper('full_name'), name='user_full_name_upper_idx'),
+            models.Index(fields=['is_active', '-created_at', '-id'], name='user_active_keyset_idx'),
+            models.Index(fields=['is_verified', '-created_at', '-id'], name='user_verified_keyset_idx'),
+            models.Index(
+                fields=['-created_at', '-id'],
+                condition=models.Q(is_staff=True) | models.Q(is_superuser=True),
+                name='user_admin_keyset_idx',
+            ),
+        ]
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['full_name']
@@ -248,36 +370,62 @@ class UserMetadata(SyncToSupabaseMixin, models.Model):
         upload_to=profile_image_path,
         null=True,
         blank=True,
+        db_index=True,
         validators=[validate_image_size, validate_image_format],
         help_text="Upload a profile image (max 5MB)"
     )
+    # SHA-256 of the image; uploads are stored by content so duplicates share files
+    profile_image_hash = models.CharField(max_length=64, blank=True)
+    # Resized copies built in the background (see services/image_renditions.py)
+    profile_image_renditions = models.JSONField(default=dict, blank=True)
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if 'profile_image' in instance.__dict__:
+            instance._stored_profile_image = instance.profile_image.name or ''
+        return instance
+
+    def _stored_image_name(self):
+        if hasattr(self, '_stored_profile_image'):
+            return self._stored_profile_image
+        if self._state.adding:
+            return ''
+        stored = UserMetadata.objects.filter(pk=self.pk).values_list('profile_image', flat=True).first()
+        return stored or ''
 
     def save(self, *args, **kwargs):
-        if self.pk:
-            try:
-                old_instance = UserMetadata.objects.get(pk=self.pk)
-                if old_instance.profile_image and old_instance.profile_image != self.profile_image:
-                    if os.path.isfile(old_instance.profile_image.path):
-                        os.remove(old_instance.profile_image.path)
-            except UserMetadata.DoesNotExist:
-                pass
-        super().save(*args, **kwargs)
-
-        if self.profile_image:
-            self.resize_image()
-    
-    def resize_image(self):
-        if not self.profile_image:
-            return
+        from .services import image_renditions
+
+        # A deferred profile_image was not touched, so it cannot have changed
+        image_changed = False
+        stored = ''
+        if 'profile_image' in self.__dict__:
+            if self.profile_image and not self.profile_image._committed:
+                image_renditions.dedupe_upload(self)
+            elif not self.profile_image:
+                self.profile_image_hash = ''
+
+            stored = self._stored_image_name()
+            image_changed = (self.profile_image.name or '') != stored
+            if image_changed:
+                if self.profile_image:
+                    self.profile_image_renditions = image_renditions.shared_renditions(self.profile_image.name)
+                else:
+                    self.profile_image_renditions = {}
+                update_fields = kwargs.get('update_fields')
+                if update_fields is not None and 'profile_image' in update_fields:
+                    kwargs['update_fields'] = {*update_fields, 'profile_image_hash', 'profile_image_renditions'}
 
-        img = Image.open(self.profile_image.path)
-
-        if img.mode == 'RGBA':
-            img = img.convert('RGB')
-        
-        img.thumbnail((400, 400), Image.LANCZOS)
-        img.save(self.profile_image.path, 'JPEG', quality=85)
+        super().save(*args, **kwargs)
 
+        if 'profile_image' in self.__dict__:
+            self._stored_profile_image = self.profile_image.name or ''
+        if image_changed and stored:
+            pk = self.pk
+            transaction.on_commit(lambda: image_renditions.release(stored, exclude_pk=pk))
+        if image_changed and self.profile_image and not self.profile_image_renditions:
+            image_renditions.enqueue_profile_image(self)
 
     def __str__(self):
         return f"{self.user.full_name} ({self.user.email})"
@@ -366,6 +514,22 @@ class Challenge(SyncToSupabaseMixin, models.Model):
     class Meta:
         ordering = ['-created_at']
 
+class ChallengeScore(models.Model):
+    """
+    Last persisted score of a participant in a challenge. Live scores are
+    kept in memory and written here in periodic batches (services/rivalry.py).
+    """
+    challenge = models.ForeignKey(Challenge, on_delete=models.CASCADE, related_name='scores')
+    user = models.ForeignKey(CustomUser, on_delete=models.CASCADE, related_name='challenge_scores')
+    score = models.IntegerField(default=0)
+    updated_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('challenge', 'user')
+
+    def __str__(self):
+        return f"Challenge {self.challenge_id}: user {self.user_id} = {self.score}"
+
 class Workout(SyncToSupabaseMixin, models.Model):
     EXPERIENCE_LEVELS = [
         ('beginner', 'Beginner'),
@@ -448,6 +612,11 @@ class Workout(SyncToSupabaseMixin, models.Model):
     
     class Meta:
         ordering = ['name']
+        indexes = [
+            models.Index(fields=['name', 'id']),  # Cursor pagination seek
+            models.Index(fields=['exercise_type', 'experience_level', 'muscle_group']),  # Catalog filters
+            models.Index(fields=['muscle_group', 'name']),  # Muscle group filter + ordering
+        ]
 
 
 class RoutineWorkout(SyncToSupabaseMixin, models.Model):
@@ -590,11 +759,37 @@ class UserFitnessGoal(SyncToSupabaseMixin, models.Model):
 
 class Sound(models.Model):
     """Sound/audio file model for workout soundbites"""
+    STATUS_PENDING = 'pending'
+    STATUS_PROCESSING = 'processing'
+    STATUS_READY = 'ready'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_PENDING, 'Pending'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_READY, 'Ready'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     name = models.CharField(max_length=200)
     file = models.FileField(upload_to=sound_file_path)
     duration = models.FloatField(default=0, help_text="Duration in seconds")
+
+    # Background processing (see services/sound_processing.py); rows from
+    # before the job queue were processed inline, hence the ready default
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_READY, db_index=True)
+    block_size_n = models.PositiveIntegerField(default=1024, help_text="MDCT block size N")
+    discard_m = models.PositiveIntegerField(default=100, help_text="MDCT coefficients discarded per block")
+    compression = models.JSONField(default=dict, blank=True)
+    error = models.TextField(blank=True)
+    processed_at = models.DateTimeField(null=True, blank=True)
+
+    # Built at processing time (see services/sound_assets.py)
+    peaks = models.JSONField(default=dict, blank=True, help_text="Downsampled waveform, audiowaveform JSON layout")
+    preview = models.FileField(upload_to='sounds/previews/', blank=True)
+
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
     uploaded_by = models.ForeignKey(
         'CustomUser', 
         on_delete=models.SET_NULL, 
@@ -606,4 +801,101 @@ class Sound(models.Model):
         ordering = ['-created_at']
 
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class DailyStat(models.Model):
+    """
+    Per-day counters for the admin dashboard. Kept up to date incrementally
+    by signals (see services/daily_stats.py) and rebuilt from the source
+    tables by the rebuild_daily_stats command.
+    """
+    date = models.DateField(unique=True)
+    signups = models.PositiveIntegerField(default=0)
+    users_deleted = models.PositiveIntegerField(default=0)
+    logins = models.PositiveIntegerField(default=0)
+    active_users = models.PositiveIntegerField(default=0, help_text="Distinct users who logged in that day")
+    routines_created = models.PositiveIntegerField(default=0)
+    routines_deleted = models.PositiveIntegerField(default=0)
+    challenges_created = models.PositiveIntegerField(default=0)
+    locations_ingested = models.PositiveIntegerField(default=0)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-date']
+
+    def __str__(self):
+        return f"Stats for {self.date}"
+
+
+class SensorChunk(models.Model):
+    """
+    Accelerometer samples of one device for one time window, stored as a
+    single compressed columnar blob (see services/sensor_store.py) instead
+    of a row per sample. Late data for a window already written becomes an
+    extra chunk for the same window. Not synced to Supabase.
+    """
+    device_id = models.CharField(max_length=64)
+    user = models.ForeignKey(
+        'CustomUser',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='sensor_chunks'
+    )
+    day = models.DateField(help_text="Local date of the window, for daily rollups")
+    start_ms = models.BigIntegerField(help_text="Epoch ms of the first sample")
+    end_ms = models.BigIntegerField(help_text="Epoch ms of the last sample")
+    sample_count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    steps = models.PositiveIntegerField(null=True, blank=True, help_text="Steps detected in this chunk, once analysed")
+    analysis_version = models.PositiveSmallIntegerField(
+        null=True,
+        blank=True,
+        help_text="Step algorithm version that produced steps (see services/step_analytics.py)"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ['device_id', 'start_ms']
+        indexes = [
+            models.Index(fields=['device_id', 'start_ms']),
+            models.Index(fields=['user', 'day']),
+            models.Index(fields=['device_id', 'day']),
+        ]
+
+    def __str__(self):
+        return f"{self.device_id} @ {self.start_ms} ({self.sample_count} samples)"
+
+
+class DailyActivity(models.Model):
+    """
+    Per device and day results of the server-side step analysis
+    (services/step_analytics.py), recomputed from the stored samples.
+    """
+    device_id = models.CharField(max_length=64)
+    user = models.ForeignKey(
+        'CustomUser',
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name='daily_activity'
+    )
+    day = models.DateField()
+    steps = models.PositiveIntegerField(default=0)
+    active_minutes = models.PositiveIntegerField(default=0, help_text="Minutes at a cadence of 100 steps/min or more")
+    zone_minutes = models.JSONField(default=dict, blank=True, help_text="Minutes per intensity zone")
+    peak_cadence = models.PositiveIntegerField(default=0, help_text="Highest steps in a single minute")
+    samples = models.PositiveIntegerField(default=0)
+    algorithm_version = models.PositiveSmallIntegerField()
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        unique_together = ('device_id', 'day')
+        ordering = ['-day']
+        indexes = [
+            models.Index(fields=['user', 'day']),
+        ]
+        verbose_name_plural = "Daily activity"
+
+    def __str__(self):
+        return f"{self.device_id} on {self.day}: {self.steps} steps"
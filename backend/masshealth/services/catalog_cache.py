@@ -0,0 +1,117 @@
+import hashlib
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse, HttpResponseNotModified
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags
+from rest_framework.renderers import JSONRenderer
+
+CATALOG_VERSION_KEY = 'catalog:version'
+
+
+def get_catalog_version():
+    """Current catalog version (a timestamp, doubles as Last-Modified)"""
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        cache.add(CATALOG_VERSION_KEY, time.time(), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version(**kwargs):
+    """
+    Invalidate every cached catalog response.
+    Accepts signal kwargs so it can be connected directly as a receiver.
+    """
+    previous = cache.get(CATALOG_VERSION_KEY) or 0
+    cache.set(CATALOG_VERSION_KEY, max(time.time(), previous + 0.001), timeout=None)
+
+
+def get_muscle_group_index():
+    """(id, lowercase name) pairs for every muscle group, cached per catalog version"""
+    from masshealth.models import MuscleGroup
+
+    cache_key = f"catalog:muscle-group-index:{get_catalog_version()}"
+    index = cache.get(cache_key)
+    if index is None:
+        index = [(pk, name.lower()) for pk, name in MuscleGroup.objects.values_list('id', 'name')]
+        cache.set(cache_key, index, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 86400))
+    return index
+
+
+def resolve_muscle_group_ids(value):
+    """
+    Turn a muscle_group filter into exact ids.
+    Accepts comma separated ids, or a name fragment matched like the old
+    icontains filter but against the cached index instead of a JOIN + LIKE.
+    """
+    parts = [part.strip() for part in value.split(',') if part.strip()]
+    if parts and all(part.isdigit() for part in parts):
+        return [int(part) for part in parts]
+
+    term = value.strip().lower()
+    return [pk for pk, name in get_muscle_group_index() if term in name]
+
+
+def _variant(request, kwargs):
+    # Paginated responses embed absolute links, so the host is part of the variant
+    params = sorted(request.GET.lists())
+    return f"{request.scheme}://{request.get_host()}|{sorted(kwargs.items())}|{params}"
+
+
+def _digest(namespace, version, variant):
+    return hashlib.sha1(f"{namespace}:{version}:{variant}".encode()).hexdigest()
+
+
+def _not_modified(request, etag):
+    # Only the ETag is trusted: If-Modified-Since has one-second granularity,
+    # and two catalog edits within the same second would get a stale 304
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if not if_none_match:
+        return False
+    etags = parse_etags(if_none_match)
+    return etag in etags or '*' in etags
+
+
+def _with_validators(response, etag, version):
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(version)
+    # Clients may keep the body but must revalidate; the 304 path is cheap
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
+
+
+def catalog_cached(namespace):
+    """
+    Cache a catalog view's rendered JSON per query string, keyed on the catalog version.
+
+    Requests whose If-None-Match matches the current version get a 304
+    without running the view. Only 200 responses are stored.
+    """
+    def decorator(view_func):
+        @wraps(view_func)
+        def wrapper(request, *args, **kwargs):
+            version = get_catalog_version()
+            variant = _variant(request, kwargs)
+            digest = _digest(namespace, version, variant)
+            etag = f'"{digest}"'
+
+            if _not_modified(request, etag):
+                return _with_validators(HttpResponseNotModified(), etag, version)
+
+            cache_key = f"catalog:{namespace}:{digest}"
+            content = cache.get(cache_key)
+            if content is None:
+                response = view_func(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                content = JSONRenderer().render(response.data)
+                cache.set(cache_key, content, getattr(settings, 'CATALOG_CACHE_TIMEOUT', 86400))
+
+            response = HttpResponse(content, content_type='application/json')
+            return _with_validators(response, etag, version)
+        return wrapper
+    return decorator
@@ -0,0 +1,130 @@
+from collections import defaultdict
+from datetime import timedelta
+
+from django.core.cache import cache
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+# Counters that can be recomputed from the rows still in the database
+REBUILDABLE_SOURCES = {
+    'signups': ('CustomUser', 'created_at'),
+    'routines_created': ('Routine', 'created_at'),
+    'challenges_created': ('Challenge', 'created_at'),
+    'locations_ingested': ('UserLocation', 'logged_at'),
+}
+
+BACKFILL_CHECK_KEY = 'daily_stats:backfilled'
+BACKFILL_CHECK_TIMEOUT = 60 * 60
+
+
+def increment(field, amount=1, day=None):
+    """Add `amount` to one counter of the day's row with a single UPDATE, creating the row if needed"""
+    from masshealth.models import DailyStat
+
+    day = day or timezone.localdate()
+    values = {field: F(field) + amount, 'updated_at': timezone.now()}
+    if DailyStat.objects.filter(date=day).update(**values):
+        return
+    try:
+        with transaction.atomic():
+            DailyStat.objects.create(date=day, **{field: amount})
+    except IntegrityError:
+        # Another request created the row first
+        DailyStat.objects.filter(date=day).update(**values)
+
+
+def record_login(user):
+    """Count a login; call before last_login is updated so the first login of the day is detected"""
+    increment('logins')
+    if user.last_login is None or timezone.localdate(user.last_login) != timezone.localdate():
+        increment('active_users')
+
+
+def get_range(days):
+    """DailyStat rows for the last `days` days (today included), keyed by date"""
+    from masshealth.models import DailyStat
+
+    first_day = timezone.localdate() - timedelta(days=days - 1)
+    return {stat.date: stat for stat in DailyStat.objects.filter(date__gte=first_day)}
+
+
+def get_totals():
+    """Running totals derived from the counters, one aggregate over the rollup rows"""
+    from masshealth.models import DailyStat
+
+    totals = DailyStat.objects.aggregate(
+        users=Sum(F('signups') - F('users_deleted')),
+        routines=Sum(F('routines_created') - F('routines_deleted')),
+    )
+    return {name: value or 0 for name, value in totals.items()}
+
+
+def ensure_backfilled():
+    """
+    Rebuild the rollup if it does not reach back to the first signup, e.g. on
+    the first dashboard load after deploying onto an existing database, where
+    the signals have only counted rows created since. Returns True if it rebuilt.
+    """
+    from masshealth.models import CustomUser, DailyStat
+
+    if cache.get(BACKFILL_CHECK_KEY):
+        return False
+    first_signup = CustomUser.objects.order_by('created_at').values_list('created_at', flat=True).first()
+    rebuilt = (
+        first_signup is not None
+        and not DailyStat.objects.filter(date=timezone.localdate(first_signup)).exists()
+    )
+    if rebuilt:
+        rebuild_daily_stats()
+    cache.set(BACKFILL_CHECK_KEY, True, BACKFILL_CHECK_TIMEOUT)
+    return rebuilt
+
+
+def rebuild_daily_stats():
+    """
+    Recompute the rebuildable counters from the source tables. Deletion
+    counters are reset since deleted rows are no longer counted as created;
+    login counters cannot be reconstructed and are kept as they are.
+    Returns the number of days written.
+    """
+    from django.apps import apps
+    from masshealth.models import DailyStat
+
+    counts = defaultdict(dict)
+    for field, (model_name, date_field) in REBUILDABLE_SOURCES.items():
+        model = apps.get_model('masshealth', model_name)
+        rows = (
+            model.objects
+            .order_by()
+            .annotate(day=TruncDate(date_field))
+            .values('day')
+            .annotate(n=Count('pk'))
+            .values_list('day', 'n')
+        )
+        for day, n in rows:
+            counts[day][field] = n
+
+    now = timezone.now()
+    with transaction.atomic():
+        existing = {stat.date: stat for stat in DailyStat.objects.select_for_update()}
+        to_create = []
+        for day in set(existing) | set(counts):
+            stat = existing.get(day) or DailyStat(date=day)
+            for field in REBUILDABLE_SOURCES:
+                setattr(stat, field, counts[day].get(field, 0))
+            stat.users_deleted = 0
+            stat.routines_deleted = 0
+            stat.updated_at = now
+            if stat.pk is None:
+                to_create.append(stat)
+
+        DailyStat.objects.bulk_update(
+            existing.values(),
+            [*REBUILDABLE_SOURCES, 'users_deleted', 'routines_deleted', 'updated_at'],
+            batch_size=500,
+        )
+        DailyStat.objects.bulk_create(to_create, batch_size=500)
+
+    return len(existing) + len(to_create)
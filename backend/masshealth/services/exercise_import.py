@@ -0,0 +1,342 @@
+import csv
+import io
+import json
+import re
+
+from django.db import transaction
+
+from masshealth.models import MuscleGroup, Workout, coalesced_supabase_sync, queue_supabase_sync
+from .catalog_cache import bump_catalog_version
+
+IMPORT_BATCH_SIZE = 1000
+MAX_REPORTED_ERRORS = 100
+
+WORKOUT_IMPORT_FIELDS = [
+    'muscle_group', 'exercise_type', 'equipment_required', 'experience_level',
+    'video_url', 'mechanics', 'force_type',
+]
+
+
+class ExerciseImportError(Exception):
+    """Raised for a single exercise that cannot be imported"""
+    pass
+
+
+def normalize_name(name):
+    """Key used to match exercises and muscle groups regardless of case and spacing"""
+    return ' '.join(name.split()).casefold()
+
+
+def _slug(value):
+    return value.lower().replace(' ', '_').replace('-', '_') if value else ''
+
+
+def map_admin_exercise(ex):
+    """
+    Map one exercise from the admin web importer (or an NDJSON/CSV row) to
+    (name, muscle group name, workout field values).
+    """
+    name = (ex.get('name') or '').strip()
+    if not name:
+        raise ExerciseImportError('Exercise missing name')
+
+    mg_name = ex.get('primary_muscle') or ex.get('muscle_group')
+    if isinstance(mg_name, dict):
+        mg_name = mg_name.get('name')
+    if not mg_name and ex.get('primary_muscles'):
+        primary_muscles = ex['primary_muscles']
+        # CSV rows carry lists as comma separated strings
+        if isinstance(primary_muscles, str):
+            primary_muscles = primary_muscles.split(',')
+        mg_name = primary_muscles[0] if primary_muscles else None
+    mg_name = mg_name.strip().title() if mg_name else None
+
+    video_url = ''
+    video_urls = ex.get('video_urls')
+    if isinstance(video_urls, dict):
+        video_url = video_urls.get('front') or video_urls.get('side') or ''
+    elif isinstance(video_urls, str):
+        video_url = video_urls
+    if not video_url:
+        video_url = ex.get('video_url') or ''
+
+    values = {
+        'exercise_type': _slug(ex.get('exercise_type', 'strength')),
+        'equipment_required': _slug(ex.get('equipment') or ex.get('equipment_required') or ''),
+        'experience_level': (ex.get('experience_level') or 'beginner').lower(),
+        'video_url': video_url,
+        'mechanics': (ex.get('mechanics_type') or ex.get('mechanics') or '').lower(),
+        'force_type': _slug(ex.get('force_type', '')),
+    }
+    return name, mg_name, values
+
+
+class ExerciseImporter:
+    """
+    Imports exercises in batches against a single preload of the catalog.
+
+    Existing workouts (by normalized name) and muscle groups are loaded once;
+    each batch then needs one bulk_create for new muscle groups, one
+    bulk_create and one bulk_update for workouts. Supabase sync is queued per
+    batch instead of per row, and the catalog cache is bumped once at the end.
+    """
+
+    def __init__(self, overwrite=False, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+        self.overwrite = overwrite
+        self.batch_size = batch_size
+        self.dry_run = dry_run
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.error_count = 0
+        self.errors = []
+        self.input_error = None
+        self.batches_flushed = 0
+
+        self.workouts = {normalize_name(w.name): w for w in Workout.objects.all()}
+        self.muscle_groups = {normalize_name(mg.name): mg for mg in MuscleGroup.objects.all()}
+        self.muscle_group_keys = {mg.pk: key for key, mg in self.muscle_groups.items()}
+
+        self._to_create = []
+        self._to_update = {}
+        self._new_muscle_groups = {}
+        self._pending_muscle_groups = {}  # id(workout) -> (workout, muscle group key), resolved on flush
+
+    def add(self, name, muscle_group_name, values, overwrite=None):
+        """Queue one exercise; writes happen once a batch fills up"""
+        overwrite = self.overwrite if overwrite is None else overwrite
+        key = normalize_name(name)
+        existing = self.workouts.get(key)
+
+        if existing is not None and not overwrite:
+            self.skipped += 1
+            return
+
+        self._validate(name, muscle_group_name, values)
+        mg_key = normalize_name(muscle_group_name) if muscle_group_name else None
+        if existing is None and mg_key is None:
+            raise ExerciseImportError(f'{name}: missing muscle group')
+
+        if existing is None:
+            workout = Workout(name=name, **values)
+            self.workouts[key] = workout
+            self._to_create.append(workout)
+            self.created += 1
+        else:
+            workout = existing
+            changed = False
+            for field, value in values.items():
+                if value and getattr(workout, field) != value:
+                    setattr(workout, field, value)
+                    changed = True
+            if mg_key and self.muscle_group_keys.get(workout.muscle_group_id) != mg_key:
+                changed = True
+            if not changed:
+                self.skipped += 1
+                return
+            if workout.pk is not None and workout.pk not in self._to_update:
+                self._to_update[workout.pk] = workout
+                self.updated += 1
+
+        if mg_key:
+            if mg_key not in self.muscle_groups and mg_key not in self._new_muscle_groups:
+                self._new_muscle_groups[mg_key] = MuscleGroup(name=muscle_group_name)
+            self._pending_muscle_groups[id(workout)] = (workout, mg_key)
+
+        if len(self._to_create) + len(self._to_update) >= self.batch_size:
+            self.flush()
+
+    def stop(self, message):
+        """Record an error that ends the input; rows queued before it are still written"""
+        self.input_error = message
+        self.add_error(message)
+
+    def add_error(self, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(message)
+
+    def _validate(self, name, muscle_group_name, values):
+        # bulk writes fail a whole batch on one bad row, so check column limits up front
+        if len(name) > Workout._meta.get_field('name').max_length:
+            raise ExerciseImportError(f'{name[:50]}...: name too long')
+        mg_max_length = MuscleGroup._meta.get_field('name').max_length
+        if muscle_group_name and len(muscle_group_name) > mg_max_length:
+            raise ExerciseImportError(f'{name}: muscle group longer than {mg_max_length} characters')
+        for field, value in values.items():
+            max_length = Workout._meta.get_field(field).max_length
+            if isinstance(value, str) and max_length and len(value) > max_length:
+                raise ExerciseImportError(f'{name}: {field} longer than {max_length} characters')
+
+    def flush(self):
+        """Write the current batch in one transaction"""
+        if not (self._to_create or self._to_update or self._new_muscle_groups):
+            return
+        if self.dry_run:
+            self._reset_batch()
+            self.batches_flushed += 1
+            return
+
+        with transaction.atomic():
+            if self._new_muscle_groups:
+                MuscleGroup.objects.bulk_create(self._new_muscle_groups.values(), ignore_conflicts=True)
+                names = [mg.name for mg in self._new_muscle_groups.values()]
+                created_groups = list(MuscleGroup.objects.filter(name__in=names))
+                for mg in created_groups:
+                    self.muscle_groups[normalize_name(mg.name)] = mg
+                    self.muscle_group_keys[mg.pk] = normalize_name(mg.name)
+                queue_supabase_sync(MuscleGroup, upserts=[mg.pk for mg in created_groups])
+
+            for workout, mg_key in self._pending_muscle_groups.values():
+                workout.muscle_group = self.muscle_groups[mg_key]
+
+            created = Workout.objects.bulk_create(self._to_create, batch_size=self.batch_size)
+            if self._to_update:
+                Workout.objects.bulk_update(self._to_update.values(), WORKOUT_IMPORT_FIELDS, batch_size=self.batch_size)
+            queue_supabase_sync(Workout, upserts=[w.pk for w in created] + list(self._to_update))
+
+        self._reset_batch()
+        self.batches_flushed += 1
+
+    def _reset_batch(self):
+        self._to_create = []
+        self._to_update = {}
+        self._new_muscle_groups = {}
+        self._pending_muscle_groups = {}
+
+    def summary(self):
+        return {
+            'created': self.created,
+            'updated': self.updated,
+            'skipped': self.skipped,
+            'error_count': self.error_count,
+            'errors': self.errors,
+            'error': self.input_error,
+        }
+
+
+def iter_json_array(fp, chunk_size=64 * 1024, wrapper_key=None):
+    """
+    Yield the items of a top-level JSON array from a text file object,
+    reading `chunk_size` characters at a time instead of loading the file.
+    With `wrapper_key`, an object holding the array under that key is
+    accepted too; it is streamed when the key comes first, loaded otherwise.
+    """
+    decoder = json.JSONDecoder()
+    buffer = fp.read(chunk_size).lstrip()
+    if wrapper_key and buffer.startswith('{'):
+        match = re.match(r'\{\s*' + re.escape(json.dumps(wrapper_key)) + r'\s*:\s*', buffer)
+        if match is None:
+            yield from _load_wrapped_array(buffer + fp.read(), wrapper_key)
+            return
+        buffer = buffer[match.end():]
+    if not buffer.startswith('['):
+        raise ExerciseImportError('Expected a JSON array')
+    position = 1
+    eof = False
+
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                raise ExerciseImportError('Unterminated JSON array')
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buffer, position = chunk, 0
+            continue
+        if buffer[position] == ']':
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError as e:
+            if eof:
+                raise ExerciseImportError(f'Invalid JSON ({e.msg})')
+            end = None
+        # An item ending exactly at the buffer edge may be cut short (e.g. a number)
+        if end is None or (end == len(buffer) and not eof):
+            chunk = fp.read(chunk_size)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+
+        yield item
+        position = end
+
+
+def _load_wrapped_array(document, wrapper_key):
+    try:
+        items = json.loads(document).get(wrapper_key)
+    except json.JSONDecodeError as e:
+        raise ExerciseImportError(f'Invalid JSON ({e.msg})')
+    if not isinstance(items, list):
+        raise ExerciseImportError(f'Expected a JSON array under {wrapper_key!r}')
+    yield from items
+
+
+def iter_ndjson(lines):
+    """Yield one object per non-empty line"""
+    for line_number, line in enumerate(lines, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError as e:
+            raise ExerciseImportError(f'Line {line_number}: invalid JSON ({e.msg})')
+
+
+def iter_uploaded_exercises(upload, file_format=None):
+    """
+    Yield exercise dicts from an uploaded file without loading it whole.
+    Supports NDJSON (one object per line), CSV with a header row, and a
+    JSON array, bare or as {"exercises": [...]} like the JSON request body.
+    The format comes from `file_format` or the extension.
+    """
+    file_format = (file_format or upload.name.rsplit('.', 1)[-1]).lower()
+
+    if file_format in ('ndjson', 'jsonl'):
+        yield from iter_ndjson(upload)
+    elif file_format == 'csv':
+        reader = csv.DictReader(io.TextIOWrapper(upload, encoding='utf-8-sig', newline=''))
+        for row in reader:
+            yield {key.strip(): value.strip() for key, value in row.items() if key and value}
+    elif file_format == 'json':
+        yield from iter_json_array(io.TextIOWrapper(upload, encoding='utf-8-sig'), wrapper_key='exercises')
+    else:
+        raise ExerciseImportError(f'Unsupported file format {file_format!r}, expected ndjson, csv or json')
+
+
+def import_exercises(exercises, overwrite=False, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Import an iterable of admin-format exercise dicts; returns the importer summary.
+    If the iterable itself fails (a malformed upload), the rows read so far are
+    still written and synced, and the summary's `error` says where it stopped.
+    """
+    importer = ExerciseImporter(overwrite=overwrite, batch_size=batch_size)
+    try:
+        with coalesced_supabase_sync():
+            try:
+                for ex in exercises:
+                    try:
+                        if not isinstance(ex, dict):
+                            raise ExerciseImportError('Exercise must be an object')
+                        importer.add(*map_admin_exercise(ex), overwrite=_as_bool(ex.get('overwrite', overwrite)))
+                    except ExerciseImportError as e:
+                        importer.add_error(str(e))
+            except (ExerciseImportError, UnicodeDecodeError, csv.Error) as e:
+                processed = importer.created + importer.updated + importer.skipped + importer.error_count
+                importer.stop(f'Input unreadable after {processed} exercises: {e}')
+            importer.flush()
+    finally:
+        # Earlier batches are committed even if a later one failed
+        if importer.created or importer.updated:
+            bump_catalog_version()
+    return importer.summary()
+
+
+def _as_bool(value):
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
@@ -0,0 +1,240 @@
+"""
+Profile image renditions, built in the background once per upload.
+
+Each upload is rendered to square-bounded JPEG and WebP copies at the
+sizes below. UserMetadata.profile_image_renditions records which upload
+they were made from ('source') and where each one lives, so a stale or
+missing set simply falls back to the original image.
+
+Uploads are stored under their SHA-256, so re-uploading an image that is
+already stored (by anyone) reuses the stored file and its renditions.
+Files are only deleted once no profile references them any more. Reusing
+a file leases it by moving its mtime REUSE_LEASE_SECONDS ahead, so a
+concurrent release() keeps it until the new reference is committed.
+"""
+import hashlib
+import logging
+import os
+import time
+
+from django.conf import settings
+from django.db import transaction
+from PIL import Image, ImageOps
+
+from .jobs import background_jobs
+
+logger = logging.getLogger(__name__)
+
+# (name, longest side in px), smallest first
+RENDITIONS = (
+    ('avatar', 64),
+    ('list', 128),
+    ('profile', 400),
+)
+FORMATS = {
+    'jpeg': ('jpg', {'quality': 85, 'optimize': True, 'progressive': True}),
+    'webp': ('webp', {'quality': 80, 'method': 4}),
+}
+
+# Display sizes callers ask for; the smallest rendition at least this big is served
+AVATAR_SIZE = 64
+PROFILE_IMAGE_SIZE = 400
+
+# JPEGs are decoded at the smallest 1/2, 1/4 or 1/8 scale that still leaves
+# this many times the largest rendition, which keeps LANCZOS quality
+DRAFT_OVERSAMPLE = 2
+
+# Longer than any request takes from dedupe_upload to its commit
+REUSE_LEASE_SECONDS = 300
+
+
+def content_hash(file):
+    digest = hashlib.sha256()
+    for chunk in file.chunks():
+        digest.update(chunk)
+    return digest.hexdigest()
+
+
+def content_name(digest, filename):
+    ext = os.path.splitext(filename)[1].lower()
+    if ext == '.jpeg':
+        ext = '.jpg'
+    return f"profile_images/{digest[:2]}/{digest}{ext}"
+
+
+def rendition_name(source_name, size, fmt):
+    directory, filename = os.path.split(source_name)
+    stem = os.path.splitext(filename)[0]
+    return f"{directory}/renditions/{stem}_{size}.{FORMATS[fmt][0]}"
+
+
+def render(image_path, source_name, media_root):
+    """Write every rendition of an image; returns the renditions map to store"""
+    with Image.open(image_path) as img:
+        # Reduced-scale JPEG decode: full camera resolution is never materialised
+        largest = RENDITIONS[-1][1] * DRAFT_OVERSAMPLE
+        img.draft('RGB', (largest, largest))
+        # Phone cameras store rotation in EXIF instead of rotating pixels
+        img = ImageOps.exif_transpose(img)
+        if img.mode != 'RGB':
+            img = img.convert('RGB')
+
+        sizes = {}
+        # Largest first so each smaller size resamples the previous one instead of the original
+        for name, size in reversed(RENDITIONS):
+            img.thumbnail((size, size), Image.LANCZOS)
+            files = {}
+            for fmt, (_, options) in FORMATS.items():
+                files[fmt] = rendition_name(source_name, size, fmt)
+                path = os.path.join(media_root, files[fmt])
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                img.save(path, fmt.upper(), **options)
+            sizes[name] = {'size': size, 'width': img.width, 'height': img.height, **files}
+
+    return {'source': source_name, 'sizes': sizes}
+
+
+def _remove_media(name):
+    path = os.path.join(settings.MEDIA_ROOT, name)
+    if os.path.isfile(path):
+        os.remove(path)
+
+
+def release(source_name, exclude_pk=None):
+    """Delete an image and its renditions unless another profile still uses or just reused it"""
+    from masshealth.models import UserMetadata
+
+    with transaction.atomic():
+        checked_at = time.time()
+        # Locking the referencing rows keeps them from letting go of the file mid-check
+        referenced = list(
+            UserMetadata.objects.select_for_update()
+            .filter(profile_image=source_name).exclude(pk=exclude_pk)
+            .values_list('pk', flat=True)
+        )
+        if referenced:
+            return
+        try:
+            if os.path.getmtime(os.path.join(settings.MEDIA_ROOT, source_name)) > checked_at:
+                return  # leased by dedupe_upload for a reference not committed yet
+        except FileNotFoundError:
+            pass
+        _remove_media(source_name)
+        for _, size in RENDITIONS:
+            for fmt in FORMATS:
+                _remove_media(rendition_name(source_name, size, fmt))
+
+
+def _lease(name):
+    """Push a stored file's mtime past REUSE_LEASE_SECONDS from now; False if it is gone"""
+    until = time.time() + REUSE_LEASE_SECONDS
+    try:
+        os.utime(os.path.join(settings.MEDIA_ROOT, name), (until, until))
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def dedupe_upload(metadata):
+    """
+    Give a fresh upload its content-addressed name. If that content is
+    already stored, the upload is dropped in favour of the stored file.
+    """
+    field = metadata.profile_image
+    metadata.profile_image_hash = content_hash(field)
+    name = content_name(metadata.profile_image_hash, field.name)
+    if field.storage.exists(name) and _lease(name):
+        metadata.profile_image = name
+
+
+def shared_renditions(source_name, exclude_pk=None):
+    """Finished renditions of `source_name` from any profile using the same file, or {}"""
+    from masshealth.models import UserMetadata
+
+    candidates = (
+        UserMetadata.objects
+        .filter(profile_image=source_name)
+        .exclude(pk=exclude_pk)
+        .values_list('profile_image_renditions', flat=True)
+    )
+    return next((r for r in candidates if (r or {}).get('source') == source_name), {})
+
+
+def process_profile_image(metadata_id, source_name):
+    """Background job: render one uploaded profile image, unless it was replaced meanwhile"""
+    from masshealth.models import UserMetadata, queue_supabase_sync
+
+    source_path = os.path.join(settings.MEDIA_ROOT, source_name)
+    if not os.path.isfile(source_path):
+        return
+    renditions = shared_renditions(source_name, exclude_pk=metadata_id) or render(
+        source_path, source_name, settings.MEDIA_ROOT
+    )
+
+    # Only store them if the upload is still the current one
+    updated = UserMetadata.objects.filter(pk=metadata_id, profile_image=source_name).update(
+        profile_image_renditions=renditions
+    )
+    if updated:
+        queue_supabase_sync(UserMetadata, [metadata_id])
+    else:
+        release(source_name)
+
+
+def enqueue_profile_image(metadata):
+    background_jobs.submit_on_commit(process_profile_image, metadata.pk, metadata.profile_image.name)
+
+
+def missing_renditions():
+    """(metadata id, image name) for profile images whose renditions are absent or stale"""
+    from masshealth.models import UserMetadata
+
+    rows = (
+        UserMetadata.objects
+        .exclude(profile_image='').exclude(profile_image__isnull=True)
+        .values_list('pk', 'profile_image', 'profile_image_renditions')
+    )
+    return [(pk, name) for pk, name, renditions in rows if (renditions or {}).get('source') != name]
+
+
+def pick_rendition(metadata, size, fmt='jpeg'):
+    """
+    Storage name of the smallest rendition at least `size` px, or the
+    largest one if none is that big. While renditions are missing or belong
+    to a previous upload, JPEG requests fall back to the original image and
+    other formats get None.
+    """
+    name = metadata.profile_image.name
+    if not name:
+        return None
+    renditions = metadata.profile_image_renditions or {}
+    if renditions.get('source') != name or not renditions.get('sizes'):
+        return name if fmt == 'jpeg' else None
+
+    entries = sorted(renditions['sizes'].values(), key=lambda entry: entry['size'])
+    entry = next((entry for entry in entries if entry['size'] >= size), entries[-1])
+    return entry.get(fmt) or entry['jpeg']
+
+
+def profile_image_url(metadata, size, request=None, fmt='jpeg'):
+    name = pick_rendition(metadata, size, fmt)
+    if name is None:
+        return None
+    url = metadata.profile_image.storage.url(name)
+    return request.build_absolute_uri(url) if request else url
+
+
+def rendition_urls(metadata, request=None):
+    """{rendition name: {format: url}} for clients that choose their own size"""
+    renditions = metadata.profile_image_renditions or {}
+    if not metadata.profile_image or renditions.get('source') != metadata.profile_image.name:
+        return {}
+
+    storage = metadata.profile_image.storage
+    urls = {}
+    for name, entry in renditions.get('sizes', {}).items():
+        urls[name] = {
+            fmt: request.build_absolute_uri(storage.url(entry[fmt])) if request else storage.url(entry[fmt])
+            for fmt in FORMATS if entry.get(fmt)
+        }
+    return urls
@@ -0,0 +1,74 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+
+class JobQueueFull(Exception):
+    """Raised when the background pool already has its maximum number of jobs queued"""
+    pass
+
+
+class BackgroundJobs:
+    """
+    Bounded worker pool for slow work that should not hold a web worker
+    (transcoding, compression, image processing).
+
+    At most MAX_WORKERS jobs run at once and MAX_QUEUED more may wait;
+    beyond that submit() raises JobQueueFull so callers can fall back
+    to a periodic sweep instead of growing the queue without limit.
+    Jobs are in-memory only: anything still queued is lost on restart,
+    so callers keep their own persistent status to recover from.
+    """
+
+    def __init__(self):
+        config = getattr(settings, 'BACKGROUND_JOBS', {})
+        self.max_workers = config.get('MAX_WORKERS', 2)
+        self.max_queued = config.get('MAX_QUEUED', 20)
+        self._slots = threading.BoundedSemaphore(self.max_workers + self.max_queued)
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers,
+                    thread_name_prefix='masshealth-job',
+                )
+            return self._executor
+
+    def submit(self, func, *args, **kwargs):
+        if not self._slots.acquire(blocking=False):
+            raise JobQueueFull(f'{self.max_workers + self.max_queued} jobs already pending')
+        try:
+            return self._get_executor().submit(self._run, func, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def submit_on_commit(self, func, *args, **kwargs):
+        """Submit once the current transaction commits, so the job sees the rows it needs"""
+        def enqueue():
+            try:
+                self.submit(func, *args, **kwargs)
+            except JobQueueFull as e:
+                logger.warning("Background job %s not queued: %s", func.__name__, e)
+        transaction.on_commit(enqueue)
+
+    def _run(self, func, *args, **kwargs):
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            logger.exception("Background job %s failed", func.__name__)
+        finally:
+            connection.close()
+            self._slots.release()
+
+
+background_jobs = BackgroundJobs()
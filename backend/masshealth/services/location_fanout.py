@@ -0,0 +1,176 @@
+"""
+Friend location fan-out: positions received on users/<id>/location are
+republished to friends/<follower id>/locations for everyone who has the
+sender in their friends list, so a client needs a single subscription.
+
+Positions are coalesced per sender (only the latest is kept) and sent at
+most once every MIN_INTERVAL_SECONDS per sender. Every FLUSH_INTERVAL_MS
+each follower with news gets one message batching all of them:
+
+    {"locations": [{"user_id": 5, "latitude": .., "longitude": ..,
+                    "accuracy": .., "ts": <epoch ms>}, ...], "ts": <epoch ms>}
+
+Who follows whom is cached per sender. Entries are dropped when the
+friends relation changes in this process (m2m_changed) and otherwise
+expire after FOLLOWER_TTL_SECONDS, which bounds staleness in a separate
+mqtt_worker process.
+"""
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+
+class FollowerIndex:
+    """sender id -> frozenset of user ids that have the sender as a friend"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}  # user id -> (followers, loaded at)
+        self._lock = threading.Lock()
+
+    def followers_of(self, user_ids):
+        """{user id: followers} for all of user_ids, loading misses with one query"""
+        from masshealth.models import CustomUser
+
+        now = time.monotonic()
+        found, missing = {}, []
+        with self._lock:
+            for user_id in user_ids:
+                entry = self._entries.get(user_id)
+                if entry is not None and now - entry[1] < self.ttl:
+                    found[user_id] = entry[0]
+                else:
+                    missing.append(user_id)
+        if missing:
+            loaded = defaultdict(set)
+            rows = (
+                CustomUser.friends.through.objects
+                .filter(to_customuser_id__in=missing)
+                .values_list('to_customuser_id', 'from_customuser_id')
+            )
+            for user_id, follower_id in rows:
+                loaded[user_id].add(follower_id)
+            with self._lock:
+                for user_id in missing:
+                    found[user_id] = frozenset(loaded[user_id])
+                    self._entries[user_id] = (found[user_id], now)
+        return found
+
+    def invalidate(self, user_ids=None):
+        with self._lock:
+            if user_ids is None:
+                self._entries.clear()
+            for user_id in user_ids or ():
+                self._entries.pop(user_id, None)
+
+
+class LocationFanout:
+    def __init__(self):
+        config = getattr(settings, 'LOCATION_FANOUT', {})
+        self.flush_interval = config.get('FLUSH_INTERVAL_MS', 1000) / 1000
+        self.min_interval = config.get('MIN_INTERVAL_SECONDS', 5)
+        self.max_batch = config.get('MAX_BATCH', 50)
+        self.index = FollowerIndex(config.get('FOLLOWER_TTL_SECONDS', 300))
+        self.publisher = None  # callable(topic, payload), set by the MQTT client
+        self._pending = {}  # sender id -> latest position
+        self._last_sent = {}  # sender id -> monotonic time of the last fan-out
+        self._lock = threading.Lock()
+        self._ticker = None
+
+    def record(self, user_id, latitude, longitude, accuracy=None, ts=None):
+        """Queue a sender's latest position; replaces any position not yet sent"""
+        if latitude is None or longitude is None:
+            return
+        with self._lock:
+            self._pending[user_id] = {
+                'user_id': user_id,
+                'latitude': latitude,
+                'longitude': longitude,
+                'accuracy': accuracy,
+                'ts': ts if ts is not None else int(time.time() * 1000),
+            }
+        self._ensure_ticker()
+
+    def _take_due(self, now):
+        with self._lock:
+            # Only senders inside their interval are kept, so this stays as
+            # small as the number of recently active senders
+            self._last_sent = {
+                user_id: sent for user_id, sent in self._last_sent.items()
+                if now - sent < self.min_interval
+            }
+            due = [user_id for user_id in self._pending if user_id not in self._last_sent]
+            for user_id in due:
+                self._last_sent[user_id] = now
+            return [self._pending.pop(user_id) for user_id in due]
+
+    def flush(self, now=None):
+        """Publish due positions, one message per follower; returns the number of messages"""
+        now = time.monotonic() if now is None else now
+        positions = self._take_due(now)
+        if not positions or self.publisher is None:
+            return 0
+
+        followers = self.index.followers_of([position['user_id'] for position in positions])
+        batches = defaultdict(list)
+        for position in positions:
+            for follower_id in followers[position['user_id']]:
+                batches[follower_id].append(position)
+
+        sent_at = int(time.time() * 1000)
+        messages = 0
+        for follower_id, batch in batches.items():
+            for start in range(0, len(batch), self.max_batch):
+                self.publisher(
+                    f"friends/{follower_id}/locations",
+                    {'locations': batch[start:start + self.max_batch], 'ts': sent_at},
+                )
+                messages += 1
+        return messages
+
+    def _ensure_ticker(self):
+        if self._ticker is not None:
+            return
+        with self._lock:
+            if self._ticker is None:
+                self._ticker = threading.Thread(target=self._run, name='location-fanout', daemon=True)
+                self._ticker.start()
+                atexit.register(self.flush, now=float('inf'))
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Location fan-out failed")
+
+
+location_fanout = LocationFanout()
+
+
+def friends_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    """m2m_changed receiver for CustomUser.friends: drop the affected follower sets"""
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    if reverse:
+        # instance's followers changed
+        location_fanout.index.invalidate([instance.pk])
+    elif pk_set is not None:
+        # instance followed or unfollowed the users in pk_set
+        location_fanout.index.invalidate(pk_set)
+    else:
+        location_fanout.index.invalidate()
+
+
+def user_deleted(sender, instance, **kwargs):
+    # The user's friend rows are gone without m2m_changed; it may be in any set
+    location_fanout.index.invalidate()
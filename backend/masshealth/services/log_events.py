@@ -0,0 +1,141 @@
+"""
+Structured, sampled, non-blocking logging (wired up in settings.LOGGING).
+
+- log_event(logger, level, 'mqtt.location_saved', user_id=5) logs a named
+  event with fields; the level check comes first, so disabled events
+  (payload dumps by default) cost one comparison
+- SamplingFilter keeps a fraction of an event ('sample_rate') and/or caps
+  it per second ('per_second'); the next record that gets through carries
+  the number suppressed meanwhile, which is also counted as log.suppressed
+- BackgroundHandler only enqueues: formatting and the stream write happen
+  on a QueueListener thread, so MQTT and request threads never block on
+  stdout. When the queue is full records are dropped (log.dropped)
+- StructuredFormatter writes one JSON object per line, or key=value text
+"""
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+
+from .metrics import registry
+
+# LogRecord attributes that are not event fields
+_RECORD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def log_event(logger, level, event, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'event': event, 'fields': fields})
+
+
+def _fields(record):
+    fields = dict(getattr(record, 'fields', None) or {})
+    for key, value in vars(record).items():
+        if key not in _RECORD_ATTRS and key not in ('event', 'fields'):
+            fields[key] = value
+    return fields
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Per-event sampling and rate limits, e.g.
+        {'mqtt.message': {'sample_rate': 0.01}, 'mqtt.unrouted': {'per_second': 1}}
+    Records are keyed by their event name, or their unformatted message.
+    """
+
+    def __init__(self, rules=None):
+        super().__init__()
+        self.rules = rules or {}
+        self._buckets = {}  # key -> [tokens, last refill]
+        self._suppressed = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'event', None) or record.msg
+        rule = self.rules.get(key)
+        if rule is None:
+            return True
+
+        allowed = random.random() < rule['sample_rate'] if 'sample_rate' in rule else True
+        per_second = rule.get('per_second')
+        with self._lock:
+            if allowed and per_second is not None:
+                now = time.monotonic()
+                tokens, last = self._buckets.get(key, (per_second, now))
+                tokens = min(per_second, tokens + (now - last) * per_second)
+                allowed = tokens >= 1
+                self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if not allowed:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                registry.counter('log.suppressed', str(key)).inc()
+                return False
+            suppressed = self._suppressed.pop(key, 0)
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+
+class StructuredFormatter(logging.Formatter):
+    def __init__(self, style='json'):
+        super().__init__()
+        self.output = style
+
+    def format(self, record):
+        message = record.getMessage()
+        fields = _fields(record)
+        event = getattr(record, 'event', None)
+        if self.output == 'json':
+            entry = {
+                'ts': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(timespec='milliseconds'),
+                'level': record.levelname,
+                'logger': record.name,
+                'event': event,
+                'message': message if message != event else None,
+                **fields,
+            }
+            if record.exc_info:
+                entry['exc'] = self.formatException(record.exc_info)
+            return json.dumps({k: v for k, v in entry.items() if v is not None}, default=repr)
+
+        text = f"{self.formatTime(record)} {record.levelname} {record.name}: {message}"
+        if fields:
+            text += ' ' + ' '.join(f'{key}={value!r}' for key, value in fields.items())
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
+
+
+class BackgroundHandler(QueueHandler):
+    """QueueHandler that owns its listener and target handler (stderr by default)"""
+
+    def __init__(self, target=None, capacity=10000):
+        super().__init__(Queue(capacity))
+        self.target = target or logging.StreamHandler()
+        self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+        self.listener.start()
+
+    def setFormatter(self, fmt):
+        # Formatting happens on the listener thread, in the target handler
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # Same process: the record is passed as is instead of pre-formatted,
+        # so callers do not pay for getMessage() and traceback rendering
+        return record
+
+    def close(self):
+        # Called by logging.shutdown() at exit: drain the queue before the target closes
+        if self.listener._thread is not None:
+            self.listener.stop()
+        self.target.close()
+        super().close()
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            registry.counter('log.dropped').inc()
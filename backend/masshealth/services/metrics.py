@@ -0,0 +1,137 @@
+import bisect
+import threading
+from collections import defaultdict
+
+# Upper bounds in milliseconds; the last bucket is +Inf
+DEFAULT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+class Histogram:
+    """Bucketed distribution with count/sum/max, safe to update from several threads"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS_MS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket_count in zip(self.buckets, self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), self.counts):
+                cumulative += bucket_count
+                buckets[str(bound)] = cumulative
+            return {
+                'count': self.count,
+                'sum': round(self.total, 3),
+                'mean': round(self.total / self.count, 3) if self.count else 0,
+                'max': round(self.max, 3),
+                'p50': self.quantile(0.5),
+                'p95': self.quantile(0.95),
+                'p99': self.quantile(0.99),
+                'buckets': buckets,
+            }
+
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+
+class Gauge:
+    """Current level of something (queue depth, in-flight messages), plus its high-water mark"""
+
+    def __init__(self):
+        self.value = 0
+        self.max = 0
+        self._lock = threading.Lock()
+
+    def set(self, value):
+        with self._lock:
+            self.value = value
+            self.max = max(self.max, value)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+            self.max = max(self.max, self.value)
+
+    def dec(self, amount=1):
+        with self._lock:
+            self.value -= amount
+
+    def snapshot(self):
+        return {'value': self.value, 'max': self.max}
+
+
+class MetricsRegistry:
+    """Process-local metrics keyed by name and a single label (view name, topic route, ...)"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, factory, name, label):
+        key = (name, label)
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.get(key)
+                if metric is None:
+                    metric = self._metrics[key] = factory()
+        return metric
+
+    def histogram(self, name, label='', buckets=DEFAULT_BUCKETS_MS):
+        return self._get(lambda: Histogram(buckets), name, label)
+
+    def counter(self, name, label=''):
+        return self._get(Counter, name, label)
+
+    def gauge(self, name, label=''):
+        return self._get(Gauge, name, label)
+
+    def snapshot(self, prefix=''):
+        data = defaultdict(dict)
+        for (name, label), metric in list(self._metrics.items()):
+            if name.startswith(prefix):
+                data[name][label] = metric.snapshot()
+        return dict(data)
+
+    def reset(self):
+        with self._lock:
+            self._metrics.clear()
+
+
+registry = MetricsRegistry()
@@ -0,0 +1,95 @@
+"""
+Handlers for incoming MQTT messages, shared by the in-process paho client
+(services/mqtt_client.py) and the standalone mqtt_worker command. They are
+synchronous and may touch the database, so the worker runs them on its
+DB executor.
+"""
+import logging
+
+from .location_fanout import location_fanout
+from .log_events import log_event
+from .metrics import registry
+from .payload_codecs import LOCATION, SENSOR_BATCH
+from .topic_router import TopicRouter
+
+logger = logging.getLogger(__name__)
+
+router = TopicRouter()
+
+
+@router.route('users/{user_id:int}/location', codec=LOCATION)
+def handle_location_update(topic, payload, user_id):
+    try:
+        from masshealth.models import UserLocation, CustomUser
+
+        user = CustomUser.objects.get(id=user_id)
+
+        location = UserLocation.objects.create(
+            user=user,
+            latitude=payload.get('latitude'),
+            longitude=payload.get('longitude'),
+            accuracy=payload.get('accuracy'),
+        )
+        location_fanout.record(
+            user_id, location.latitude, location.longitude, location.accuracy,
+            int(location.logged_at.timestamp() * 1000),
+        )
+        log_event(logger, logging.DEBUG, 'mqtt.location_saved', user_id=user_id)
+    except CustomUser.DoesNotExist:
+        log_event(logger, logging.WARNING, 'mqtt.unknown_user', topic=topic, user_id=user_id)
+    except Exception as e:
+        # Swallowed here, so the router's mqtt.errors never sees it
+        registry.counter('mqtt.handler_failed', 'handle_location_update').inc()
+        log_event(logger, logging.ERROR, 'mqtt.handler_failed', topic=topic, error=str(e))
+
+
+@router.route('rivalries/{challenge_id:int}/updates')
+def handle_rivalry_update(topic, payload, challenge_id):
+    from masshealth.services.rivalry import RivalryUpdateError, rivalry_engine
+
+    try:
+        if not rivalry_engine.handle_update(challenge_id, payload):
+            log_event(logger, logging.DEBUG, 'mqtt.challenge_not_live', challenge_id=challenge_id)
+    except (RivalryUpdateError, ValueError) as e:
+        log_event(logger, logging.WARNING, 'mqtt.invalid_payload', topic=topic, error=str(e))
+
+
+@router.route('gyrosensor/{device_id}/data', codec=SENSOR_BATCH)
+def handle_sensor_data(topic, payload, device_id):
+    from masshealth.services.sensor_store import SensorPayloadError, ingest
+
+    try:
+        ingest(device_id, payload)
+    except SensorPayloadError as e:
+        log_event(logger, logging.WARNING, 'mqtt.invalid_payload', topic=topic, error=str(e))
+        return
+
+    # Step counts from a user's wearable also score their live challenges
+    if device_id.isdigit() and payload.get('steps'):
+        from masshealth.services.rivalry import rivalry_engine
+        rivalry_engine.record_steps(int(device_id), int(payload['steps']))
+
+
+SUBSCRIPTIONS = router.subscriptions
+# Handlers whose per-process state goes wrong when a worker gets only part of
+# the messages: leaderboards publish ranks from their own scores. Sensor windows
+# split across workers are fine, each stores its own chunk and read_range merges them.
+STATEFUL_SUBSCRIPTIONS = ('rivalries/+/updates',)
+dispatch = router.dispatch
+
+
+def attach_publisher(publish):
+    """Route server-side publishes (leaderboards, friend locations) through `publish(topic, payload)`"""
+    from masshealth.services.rivalry import rivalry_engine
+
+    rivalry_engine.publisher = publish
+    location_fanout.publisher = publish
+
+
+def flush_buffers():
+    """Persist the in-memory sensor windows and challenge scores (on shutdown)"""
+    from masshealth.services.rivalry import rivalry_engine
+    from masshealth.services.sensor_store import sensor_buffer
+
+    sensor_buffer.flush(force=True)
+    rivalry_engine.snapshot()
@@ -0,0 +1,222 @@
+"""
+In-process MQTT load generator for `manage.py mqtt_loadtest`.
+
+LoopbackBroker stands in for the MQTT broker: simulated devices publish
+into it and it delivers to the real ingestion code through bounded
+per-subscriber queues, counting what it has to drop when a subscriber
+falls behind. Two consumers can be driven:
+
+- 'client': MQTTClient.on_message on a single delivery thread, the way
+  paho's network loop calls it
+- 'worker': the asyncio MQTTWorker (aiomqtt needed), with LoopbackClient
+  standing in for aiomqtt.Client
+
+Payloads are StampedPayload bytes carrying their publish time, so
+end-to-end latency (publish -> handler done) is measured without
+changing what the handlers see. Server-side publishes (friend locations,
+leaderboards) are acknowledged immediately by the stand-in and counted.
+"""
+import asyncio
+import json
+import queue
+import threading
+import time
+
+import numpy as np
+
+from .mqtt_worker import MQTTWorker
+from .payload_codecs import encode_location, encode_sensor_batch
+from .topic_router import topic_matches
+
+
+class StampedPayload(bytes):
+    """Message body that remembers when it was published (time.perf_counter())"""
+    published_at = 0.0
+
+
+class TopicName(str):
+    @property
+    def value(self):
+        return str(self)
+
+
+class LoopbackMessage:
+    __slots__ = ('topic', 'payload', 'qos', 'properties')
+
+    def __init__(self, topic, payload, qos=1):
+        self.topic = TopicName(topic)
+        self.payload = payload
+        self.qos = qos
+        self.properties = None
+
+
+class LoopbackBroker:
+    def __init__(self, max_queued=10_000):
+        self.max_queued = max_queued
+        self.published = 0
+        self.dropped = 0
+        self.server_publishes = 0
+        self._subscriptions = []  # (topic filter, queue)
+        self._lock = threading.Lock()
+
+    def subscribe(self, topic_filter, inbox=None):
+        if topic_filter.startswith('$share/'):
+            topic_filter = topic_filter.split('/', 2)[2]
+        inbox = inbox or queue.Queue(self.max_queued)
+        with self._lock:
+            self._subscriptions.append((topic_filter, inbox))
+        return inbox
+
+    def publish(self, topic, payload):
+        self.published += 1
+        message = LoopbackMessage(topic, payload)
+        for topic_filter, inbox in self._subscriptions:
+            if topic_matches(topic_filter, topic):
+                try:
+                    inbox.put_nowait(message)
+                except queue.Full:
+                    self.dropped += 1
+
+    def server_publish(self, topic, data):
+        """A publish from the server side (outbox); acknowledged at once"""
+        with self._lock:
+            self.server_publishes += 1
+
+    def outbox_send(self, topic, data):
+        self.server_publish(topic, data)
+        return lambda timeout: True
+
+
+class LoopbackClient:
+    """The part of aiomqtt.Client that MQTTWorker uses"""
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.inbox = queue.Queue(broker.max_queued)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def subscribe(self, topic, qos=0):
+        self.broker.subscribe(topic, self.inbox)
+
+    async def publish(self, topic, payload, qos=0):
+        self.broker.server_publish(topic, payload)
+
+    @property
+    def messages(self):
+        return self._messages()
+
+    def _next(self):
+        # Short timeout so the executor thread ends soon after the worker stops
+        try:
+            return self.inbox.get(timeout=0.2)
+        except queue.Empty:
+            return None
+
+    async def _messages(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            # One executor hop per burst rather than per message
+            message = await loop.run_in_executor(None, self._next)
+            if message is None:
+                continue
+            yield message
+            while True:
+                try:
+                    message = self.inbox.get_nowait()
+                except queue.Empty:
+                    break
+                yield message
+
+
+class LoopbackWorker(MQTTWorker):
+    """MQTTWorker connected to a LoopbackBroker, recording end-to-end latency"""
+
+    def __init__(self, broker, latencies, **options):
+        super().__init__(group='', **options)
+        self.broker = broker
+        self.latencies = latencies
+
+    def _make_client(self):
+        return LoopbackClient(self.broker)
+
+    async def _handle(self, topic, raw, content_type=None):
+        await super()._handle(topic, raw, content_type)
+        self.latencies.append(time.perf_counter() - raw.published_at)
+
+
+class DeviceSimulator:
+    """
+    Publishes a paced mix of location and sensor messages from simulated
+    users (users/<id>/location) and wearables (gyrosensor/<device>/data)
+    """
+
+    def __init__(self, broker, user_ids, device_ids, rate, duration, location_share=0.2,
+                 binary=False, samples_per_message=10, sample_rate=100, seed=0):
+        self.broker = broker
+        self.user_ids = list(user_ids)
+        self.device_ids = list(device_ids)
+        self.rate = rate
+        self.duration = duration
+        self.location_share = location_share
+        self.binary = binary
+        self.samples_per_message = samples_per_message
+        self.sample_rate = sample_rate
+        self.sent = {'location': 0, 'sensor': 0}
+        self.elapsed = 0.0
+        rng = np.random.default_rng(seed)
+        self._positions = rng.uniform((45.4, 13.4), (46.9, 16.6), (len(self.user_ids), 2))
+        self._blocks = [
+            rng.integers(-2000, 2000, (samples_per_message, 3)).astype(np.int16)
+            for _ in self.device_ids
+        ]
+        self._json_blocks = [json.dumps(block.tolist()) for block in self._blocks]
+
+    def location_payload(self, index):
+        latitude, longitude = self._positions[index]
+        if self.binary:
+            return encode_location(latitude, longitude, 5.0)
+        return json.dumps({'latitude': latitude, 'longitude': longitude, 'accuracy': 5.0}).encode()
+
+    def sensor_payload(self, index, ts):
+        if self.binary:
+            return encode_sensor_batch(ts, self.sample_rate, self._blocks[index])
+        return (
+            f'{{"ts": {ts}, "rate": {self.sample_rate}, "samples": {self._json_blocks[index]}}}'
+        ).encode()
+
+    def _publish(self, topic, body):
+        payload = StampedPayload(body)
+        payload.published_at = time.perf_counter()
+        self.broker.publish(topic, payload)
+
+    def run(self):
+        started = time.perf_counter()
+        sent = 0
+        location_every = 1 / self.location_share if self.location_share else None
+        next_location = 0.0
+        while True:
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.duration:
+                break
+            due = int(self.rate * elapsed) - sent
+            for _ in range(due):
+                if location_every is not None and sent >= next_location and self.user_ids:
+                    index = self.sent['location'] % len(self.user_ids)
+                    self._publish(f'users/{self.user_ids[index]}/location', self.location_payload(index))
+                    self.sent['location'] += 1
+                    next_location += location_every
+                elif self.device_ids:
+                    index = self.sent['sensor'] % len(self.device_ids)
+                    # Consecutive batches of a device follow on in time
+                    ts = int(time.time() * 1000)
+                    self._publish(f'gyrosensor/{self.device_ids[index]}/data', self.sensor_payload(index, ts))
+                    self.sent['sensor'] += 1
+                sent += 1
+            time.sleep(0.001)
+        self.elapsed = time.perf_counter() - started
+        return sent
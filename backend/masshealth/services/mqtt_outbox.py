@@ -0,0 +1,466 @@
+"""
+Outbound MQTT messages (leaderboard deltas, friend locations).
+
+Publishers call outbox.put(topic, payload) and never block. A sender
+thread drains the queue into whichever client is attached:
+
+- the queue is bounded (MAX_QUEUED); when full the oldest message moves
+  to the disk spool (or is dropped without one), so the spool only ever
+  holds messages older than the queue
+- a message still queued for a topic with a COALESCE rule absorbs newer
+  messages for that topic instead of queueing another one, so a slow or
+  absent connection sends the latest state once rather than every step
+- at most WINDOW messages are unacknowledged at a time; the sender waits
+  for the oldest PUBACK (paho wait_for_publish) before sending more
+- messages in flight when the connection drops are sent again before the
+  queue, and whatever is left at exit is spooled and replayed by the next
+  process (at-least-once, duplicates are possible)
+- the spool is replayed a batch at a time ahead of the queue; a replayed
+  message for a topic still queued is merged into it as the older value.
+  Topics in DISCARD_ON_RESTART are skipped in spools of earlier processes,
+  as their payloads only make sense to the process that produced them
+
+Each process spools to its own SPOOL_PATH.<pid>.<n> file and keeps it
+locked while open, so web processes and mqtt_worker replicas sharing a
+SPOOL_PATH never read or write each other's files. Files left by processes
+that are gone are taken over when a client first attaches. Replay reads forward from an
+offset and never rewrites a file.
+
+Gauges mqtt.outbox.queued / inflight / spooled and counters
+mqtt.outbox.published / coalesced / dropped / retried are in services.metrics.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from itertools import count
+
+from django.conf import settings
+
+from .metrics import registry
+from .topic_router import topic_matches
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger(__name__)
+
+
+def merge_by_user(list_key):
+    """Merge rule: entries of payload[list_key] are replaced per user_id, other keys from the newer payload"""
+    def merge(older, newer):
+        entries = {entry['user_id']: entry for entry in older.get(list_key, [])}
+        entries.update((entry['user_id'], entry) for entry in newer.get(list_key, []))
+        return {**older, **newer, list_key: list(entries.values())}
+    return merge
+
+
+def replace(older, newer):
+    return newer
+
+
+# Topic filter -> merge(older payload, newer payload); other topics are sent as is
+COALESCE = (
+    ('friends/+/locations', merge_by_user('locations')),
+    ('rivalries/+/leaderboard', merge_by_user('changes')),
+    ('users/+/status', replace),
+)
+
+# Leaderboard deltas carry a per-process version that restarts at 1
+DISCARD_ON_RESTART = ('rivalries/+/leaderboard',)
+
+
+def _encode(topic, payload):
+    return (json.dumps([topic, payload], default=str) + '\n').encode()
+
+
+def _try_lock(handle):
+    """Exclusive lock without waiting, held until the file is closed"""
+    try:
+        if fcntl:
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+class SpoolFile:
+    """A JSON-lines spool file, locked by the one process reading or appending to it"""
+
+    def __init__(self, path, handle, discard=()):
+        self.path = path
+        self.handle = handle
+        self.discard = discard
+        self.offset = 0  # start of the first line not replayed yet
+
+    @classmethod
+    def create(cls, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        handle = open(path, 'a+b')
+        _try_lock(handle)  # a fresh name, nobody else has it open
+        return cls(path, handle)
+
+    @classmethod
+    def adopt(cls, path, discard):
+        """Take over the spool of a process that is gone, or None if it is still in use"""
+        try:
+            handle = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        try:
+            # Still the file at `path`, not one a faster process already removed?
+            if _try_lock(handle) and os.path.samestat(os.fstat(handle.fileno()), os.stat(path)):
+                return cls(path, handle, discard)
+        except FileNotFoundError:
+            pass
+        handle.close()
+        return None
+
+    def decode(self, line):
+        """(topic, payload), or None for a line cut short by a crash or a discarded topic"""
+        try:
+            topic, payload = json.loads(line)
+        except ValueError:
+            return None
+        if any(topic_matches(topic_filter, topic) for topic_filter in self.discard):
+            return None
+        return topic, payload
+
+    def unread(self):
+        self.handle.seek(self.offset)
+        return self.handle.readlines()
+
+    def readline(self):
+        self.handle.seek(self.offset)
+        line = self.handle.readline()
+        self.offset += len(line)
+        return line
+
+    def size(self):
+        return os.fstat(self.handle.fileno()).st_size
+
+    def remove(self):
+        try:
+            os.remove(self.path)  # while still locked, where the platform allows it
+        except PermissionError:
+            self.handle.close()
+            os.remove(self.path)
+        self.handle.close()
+
+
+class Outbox:
+    def __init__(self, coalesce=COALESCE, discard_on_restart=DISCARD_ON_RESTART, config=None):
+        if config is None:
+            config = getattr(settings, 'MQTT_OUTBOX', {})
+        self.max_queued = config.get('MAX_QUEUED', 10_000)
+        self.window = config.get('WINDOW', 20)
+        self.ack_timeout = config.get('ACK_TIMEOUT_SECONDS', 10)
+        self.spool_path = config.get('SPOOL_PATH')
+        self.max_spool_bytes = config.get('MAX_SPOOL_BYTES', 50 * 1024 * 1024)
+        self.coalesce = coalesce
+        self._queue = OrderedDict()  # topic (coalesced) or (topic, seq) -> [topic, payload]
+        self._backlog = deque()  # [topic, payload] older than the spool and the queue, sent first
+        self._inflight = deque()  # (wait, topic, payload)
+        self._sequence = count()
+        self._send = None
+        self._cond = threading.Condition()
+        self._sender = None
+        self._spool_files = deque()  # SpoolFile, oldest first; this process's own file last
+        self._own_spool = None
+        self._spooled = 0  # messages in the unread part of the spool files
+        self._spool_bytes = 0
+        self._discard_on_restart = discard_on_restart
+        self._adopted = False
+
+    def _rule(self, topic):
+        for topic_filter, merge in self.coalesce:
+            if topic_matches(topic_filter, topic):
+                return merge
+        return None
+
+    def _enqueue(self, topic, payload, front=False):
+        """
+        Add under the lock. `front` is for a message older than everything
+        queued (requeued from flight or replayed from the spool): it goes to
+        the backlog unless it can be merged into the queue. When the queue
+        is full its oldest message moves to the spool.
+        """
+        merge = self._rule(topic)
+        key = topic if merge else (topic, next(self._sequence))
+        queued = self._queue.get(key)
+        if queued is not None:
+            # Oldest first: a front message is older than the queued one
+            queued[1] = merge(payload, queued[1]) if front else merge(queued[1], payload)
+            registry.counter('mqtt.outbox.coalesced').inc()
+        elif front:
+            self._backlog.appendleft([topic, payload])
+        else:
+            if len(self._queue) >= self.max_queued:
+                self._spool([tuple(self._queue.popitem(last=False)[1])])
+            self._queue[key] = [topic, payload]
+
+    def put(self, topic, payload):
+        with self._cond:
+            self._enqueue(topic, payload)
+            self._cond.notify()
+            self._update_gauges()
+        self._ensure_sender()
+
+    def attach(self, send):
+        """
+        Start sending through `send(topic, data)`, which returns wait(timeout):
+        True once acknowledged, False while pending, raising if it failed
+        """
+        with self._cond:
+            if not self._adopted:
+                # Only a process that sends takes over earlier spools, not one that merely imports this
+                self._adopt_spools()
+            self._send = send
+            self._cond.notify()
+        self._ensure_sender()
+
+    def detach(self):
+        """Connection lost: stop sending and queue unacknowledged messages again"""
+        with self._cond:
+            self._send = None
+            self._requeue_inflight()
+            self._update_gauges()
+
+    def _requeue_inflight(self):
+        while self._inflight:
+            _, topic, payload = self._inflight.pop()
+            self._enqueue(topic, payload, front=True)
+            registry.counter('mqtt.outbox.retried').inc()
+
+    def _update_gauges(self):
+        registry.gauge('mqtt.outbox.queued').set(len(self._queue) + len(self._backlog))
+        registry.gauge('mqtt.outbox.inflight').set(len(self._inflight))
+
+    def _ensure_sender(self):
+        if self._sender is not None:
+            return
+        with self._cond:
+            if self._sender is None:
+                self._sender = threading.Thread(target=self._run, name='mqtt-outbox', daemon=True)
+                self._sender.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._step()
+            except Exception:
+                logger.exception("MQTT outbox sender failed")
+                time.sleep(1)
+
+    def _step(self):
+        with self._cond:
+            while self._send is None or not (self._queue or self._backlog or self._inflight or self._spooled):
+                self._cond.wait()
+            send = self._send
+            # Oldest first: the backlog, then the spool, then the queue
+            replay = not self._backlog and self._spooled
+            message = None
+            if not replay and len(self._inflight) < self.window:
+                if self._backlog:
+                    message = tuple(self._backlog.popleft())
+                elif self._queue:
+                    _, (topic, payload) = self._queue.popitem(last=False)
+                    message = (topic, payload)
+
+        if replay:
+            self._replay_spool()
+            return
+        if message is not None:
+            topic, payload = message
+            try:
+                wait = send(topic, json.dumps(payload, default=str))
+            except Exception as e:
+                logger.warning("Publish to %s failed: %s", topic, e)
+                with self._cond:
+                    self._enqueue(topic, payload, front=True)
+                time.sleep(0.1)
+                return
+            with self._cond:
+                if self._send is send:
+                    self._inflight.append((wait, topic, payload))
+                else:
+                    self._enqueue(topic, payload, front=True)
+                self._update_gauges()
+        self._reap(block=message is None)
+
+    def _reap(self, block):
+        """Drop acknowledged messages from the window; waits on the oldest when `block`"""
+        while True:
+            with self._cond:
+                if not self._inflight:
+                    return
+                wait, topic, payload = self._inflight[0]
+            try:
+                acked = wait(self.ack_timeout if block else 0)
+            except Exception as e:
+                logger.warning("Publish to %s was not acknowledged: %s", topic, e)
+                acked = None
+            with self._cond:
+                if not self._inflight or self._inflight[0][0] is not wait:
+                    return  # detached meanwhile, already requeued
+                if acked is False:
+                    return
+                self._inflight.popleft()
+                if acked is None:
+                    self._enqueue(topic, payload, front=True)
+                    registry.counter('mqtt.outbox.retried').inc()
+                else:
+                    registry.counter('mqtt.outbox.published').inc()
+                self._update_gauges()
+            block = False
+
+    # Disk spool (JSON lines), for disconnects and restarts
+
+    def _adopt_spools(self):
+        """Take over the spool files of earlier processes, oldest first"""
+        self._adopted = True
+        if not self.spool_path:
+            return
+        found = []
+        for path in glob.glob(glob.escape(self.spool_path) + '.*') + [self.spool_path]:
+            try:
+                found.append((os.path.getmtime(path), path))
+            except OSError:
+                continue  # removed meanwhile, or no spool at all
+        for _, path in sorted(found):
+            spool = SpoolFile.adopt(path, self._discard_on_restart)
+            if spool is None:
+                continue
+            lines = spool.unread()
+            kept = sum(spool.decode(line) is not None for line in lines)
+            if kept != len(lines):
+                logger.info("Skipping %s spooled message(s) from the previous run", len(lines) - kept)
+            self._spool_files.append(spool)
+            self._spooled += kept
+            self._spool_bytes += sum(map(len, lines))
+        registry.gauge('mqtt.outbox.spooled').set(self._spooled)
+
+    def _own_spool_path(self):
+        return f'{self.spool_path}.{os.getpid()}.{time.time_ns()}'
+
+    def _spool(self, messages):
+        if not self.spool_path:
+            registry.counter('mqtt.outbox.dropped').inc(len(messages))
+            return
+        with self._cond:
+            lines = [_encode(topic, payload) for topic, payload in messages]
+            size = sum(map(len, lines))
+            if self._spool_bytes + size > self.max_spool_bytes:
+                registry.counter('mqtt.outbox.dropped').inc(len(messages))
+                return
+            if self._own_spool is None:
+                self._own_spool = SpoolFile.create(self._own_spool_path())
+                self._spool_files.append(self._own_spool)
+            self._own_spool.handle.writelines(lines)
+            self._own_spool.handle.flush()
+            self._spooled += len(lines)
+            self._spool_bytes += size
+            registry.gauge('mqtt.outbox.spooled').set(self._spooled)
+
+    def _replay_spool(self):
+        """Move the oldest spooled messages into the backlog; the files are only read"""
+        with self._cond:
+            batch = []
+            limit = max(self.max_queued // 10, 1)
+            drained = False
+            while len(batch) < limit:
+                if not self._spool_files:
+                    drained = True
+                    break
+                spool = self._spool_files[0]
+                line = spool.readline()
+                self._spool_bytes -= len(line)
+                message = spool.decode(line) if line else None
+                if message is not None:
+                    batch.append(message)
+                if spool.offset >= spool.size():
+                    # Read to the end: an earlier process's file goes, our own starts over
+                    if spool is self._own_spool:
+                        spool.handle.truncate(0)
+                        spool.offset = 0
+                        drained = True
+                        break
+                    self._spool_files.popleft()
+                    spool.remove()
+            # Newest of the batch first, so the backlog ends up in spool order
+            for topic, payload in reversed(batch):
+                self._enqueue(topic, payload, front=True)
+            self._spooled = 0 if drained else max(self._spooled - len(batch), 0)
+            if drained:
+                self._spool_bytes = 0
+            registry.gauge('mqtt.outbox.spooled').set(self._spooled)
+            self._update_gauges()
+            self._cond.notify()
+
+    def _write_spool(self, older, newer):
+        """
+        At exit: one spool file with `older`, everything not replayed yet and
+        then `newer`, unlocked so the next process takes it over
+        """
+        if not self.spool_path:
+            registry.counter('mqtt.outbox.dropped').inc(len(older) + len(newer))
+            return
+        lines = [_encode(topic, payload) for topic, payload in older]
+        for spool in self._spool_files:
+            lines += [line for line in spool.unread() if spool.decode(line) is not None]
+        newer_lines = [_encode(topic, payload) for topic, payload in newer]
+        if sum(map(len, lines + newer_lines)) > self.max_spool_bytes:
+            registry.counter('mqtt.outbox.dropped').inc(len(newer))
+            newer_lines = []
+        lines += newer_lines
+
+        own = self._own_spool
+        if own is None and lines:
+            own = SpoolFile.create(self._own_spool_path())
+        for spool in self._spool_files:
+            if spool is not own:
+                spool.remove()
+        if own is not None and lines:
+            own.handle.truncate(0)
+            own.handle.writelines(lines)
+            own.handle.flush()
+            own.handle.close()
+        elif own is not None:
+            own.remove()
+        self._spool_files.clear()
+        self._own_spool = None
+        self._spooled = self._spool_bytes = 0
+        registry.gauge('mqtt.outbox.spooled').set(0)
+
+    def close(self, timeout=5):
+        """Wait up to `timeout` for the queue to drain, then spool what is left"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with self._cond:
+                if self._send is None or not (self._queue or self._backlog or self._inflight or self._spooled):
+                    break
+            time.sleep(0.05)
+        with self._cond:
+            self._send = None
+            self._requeue_inflight()
+            backlog = [tuple(message) for message in self._backlog]
+            left = [tuple(message) for message in self._queue.values()]
+            self._backlog.clear()
+            self._queue.clear()
+            self._update_gauges()
+            # The backlog is older than what is still spooled, the queue newer
+            self._write_spool(backlog, left)
+        if backlog or left:
+            logger.info("Spooled %s unsent MQTT message(s)", len(backlog) + len(left))
+
+
+outbox = Outbox()
@@ -0,0 +1,194 @@
+"""
+Standalone asyncio MQTT ingestion (manage.py mqtt_worker).
+
+Messages are read by an asyncio client (aiomqtt) and handed to the
+synchronous handlers in mqtt_handlers on a small thread pool, since they
+use the ORM. At most `concurrency` messages are in flight; beyond that
+the worker stops reading and the broker/client queue absorbs the burst.
+
+Location and sensor topics are subscribed as MQTT v5 shared subscriptions
+($share/<group>/<topic>), so any number of workers can split the load.
+Challenge leaderboards are held per process, so rivalries/ topics are
+subscribed without $share/ unless named in `topics`: every worker
+subscribed to them sees every message. When running several workers, give
+rivalries/+/updates to one of them and start the others with --topics
+users/+/location gyrosensor/+/data.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import os
+import signal
+import socket
+import ssl
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from .log_events import log_event
+from .mqtt_handlers import STATEFUL_SUBSCRIPTIONS, SUBSCRIPTIONS, attach_publisher, flush_buffers, router
+from .mqtt_outbox import outbox as default_outbox
+from .payload_codecs import PayloadError
+
+logger = logging.getLogger(__name__)
+payload_logger = logging.getLogger('masshealth.mqtt.payloads')
+
+RECONNECT_MAX_SECONDS = 60
+
+
+def _run_route(route, topic, payload, params):
+    close_old_connections()
+    route(topic, payload, params)
+
+
+class MQTTWorker:
+    def __init__(self, topics=None, group=None, concurrency=None, db_workers=None, shutdown_timeout=None, outbox=None):
+        config = getattr(settings, 'MQTT_WORKER', {})
+        self.topics = list(topics or SUBSCRIPTIONS)
+        # Stateful topics are only split across workers when asked for by name
+        self.shared_topics = set(topics or set(SUBSCRIPTIONS) - set(STATEFUL_SUBSCRIPTIONS))
+        self.group = config.get('SHARED_GROUP') if group is None else group
+        self.concurrency = concurrency or config.get('CONCURRENCY', 32)
+        self.db_workers = db_workers or config.get('DB_WORKERS', 4)
+        self.shutdown_timeout = shutdown_timeout or config.get('SHUTDOWN_TIMEOUT_SECONDS', 10)
+        self.outbox = outbox or default_outbox
+        self.processed = 0
+        self.failed = 0
+        self._stop = None
+        self._slots = None
+        self._tasks = set()
+        self._executor = None
+
+    def subscription(self, topic):
+        return f'$share/{self.group}/{topic}' if self.group and topic in self.shared_topics else topic
+
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    def _make_client(self):
+        import aiomqtt
+
+        config = settings.MQTT_CONFIG
+        tls_context = None
+        if config['use_tls']:
+            # Same TLS settings as the in-process paho client
+            tls_context = ssl.create_default_context()
+            tls_context.check_hostname = False
+            tls_context.verify_mode = ssl.CERT_NONE
+        return aiomqtt.Client(
+            config['broker'],
+            config['port'],
+            username=config['username'],
+            password=config['password'],
+            # Unique per replica, brokers drop the older session on a duplicate id
+            identifier=f"{config['client_id']}-{socket.gethostname()}-{os.getpid()}",
+            protocol=aiomqtt.ProtocolVersion.V5,
+            keepalive=config['keepalive'],
+            tls_context=tls_context,
+            tls_insecure=True if tls_context else None,
+            max_queued_incoming_messages=self.concurrency * 4,
+        )
+
+    async def run(self):
+        import aiomqtt
+
+        loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._executor = ThreadPoolExecutor(max_workers=self.db_workers, thread_name_prefix='mqtt-db')
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows or not the main thread: rely on KeyboardInterrupt / stop()
+
+        attach_publisher(self.outbox.put)
+        backoff = 1
+        try:
+            while not self._stop.is_set():
+                try:
+                    async with self._make_client() as client:
+                        backoff = 1
+                        self._attach_outbox(client, loop)
+                        for topic in self.topics:
+                            await client.subscribe(self.subscription(topic), qos=1)
+                        logger.info("MQTT worker subscribed to %s", ', '.join(map(self.subscription, self.topics)))
+                        await self._until_stopped(self._consume(client))
+                        # Stopping: send what is queued while still connected
+                        await loop.run_in_executor(None, self.outbox.close, self.shutdown_timeout)
+                except aiomqtt.MqttError as e:
+                    if self._stop.is_set():
+                        break
+                    logger.warning("MQTT connection lost (%s), reconnecting in %ss", e, backoff)
+                    await self._until_stopped(asyncio.sleep(backoff))
+                    backoff = min(backoff * 2, RECONNECT_MAX_SECONDS)
+                finally:
+                    self.outbox.detach()
+        finally:
+            await self._shutdown(loop)
+
+    async def _until_stopped(self, coroutine):
+        """Run a coroutine until it finishes or stop() is called; re-raises its errors"""
+        work = asyncio.ensure_future(coroutine)
+        stopped = asyncio.ensure_future(self._stop.wait())
+        done, pending = await asyncio.wait({work, stopped}, return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if work in done:
+            work.result()
+
+    async def _consume(self, client):
+        async for message in client.messages:
+            # Backpressure: wait for a free slot before reading the next message
+            await self._slots.acquire()
+            content_type = getattr(message.properties, 'ContentType', None)
+            task = asyncio.create_task(self._handle(message.topic.value, message.payload, content_type))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, topic, raw, content_type=None):
+        try:
+            # Routed on the event loop, only the handler itself needs a DB thread
+            route, params = router.match(topic)
+            if route is None:
+                return
+            payload = route.decode(raw, content_type)
+            log_event(payload_logger, logging.DEBUG, 'mqtt.message', topic=topic, payload=payload)
+            await asyncio.get_running_loop().run_in_executor(self._executor, _run_route, route, topic, payload, params)
+            self.processed += 1
+        except PayloadError as e:
+            self.failed += 1
+            log_event(logger, logging.WARNING, 'mqtt.decode_failed', topic=topic, error=str(e))
+        except Exception:
+            self.failed += 1
+            logger.exception("Error processing message from %s", topic, extra={'event': 'mqtt.handler_failed'})
+        finally:
+            self._slots.release()
+
+    def _attach_outbox(self, client, loop):
+        def send(topic, data):
+            # Called from the outbox sender thread
+            future = asyncio.run_coroutine_threadsafe(client.publish(topic, data, qos=1), loop)
+
+            def wait(timeout):
+                try:
+                    future.result(timeout)  # raises if the publish failed
+                except concurrent.futures.TimeoutError:
+                    return False
+                return True
+
+            return wait
+
+        self.outbox.attach(send)
+
+    async def _shutdown(self, loop):
+        if self._tasks:
+            logger.info("Waiting for %s in-flight message(s)", len(self._tasks))
+            await asyncio.wait(set(self._tasks), timeout=self.shutdown_timeout)
+        await loop.run_in_executor(self._executor, flush_buffers)
+        # Anything published since the connection closed is spooled for the next run
+        self.outbox.close(timeout=0)
+        self._executor.shutdown(wait=True)
+        logger.info("MQTT worker stopped: %s processed, %s failed", self.processed, self.failed)
@@ -0,0 +1,121 @@
+"""
+Compact binary payloads for device topics, accepted next to JSON.
+
+Binary frames start with a tag byte that can never begin a JSON document,
+so a route that has a binary codec tells the two apart by the first byte.
+MQTT v5 publishers can also set the content type explicitly (the
+standalone worker reads it; the paho client speaks MQTT 3.1.1 and relies
+on the tag byte). All fields are little-endian.
+
+users/<id>/location, 11 bytes (JSON is ~70):
+    B   tag 0x01
+    i   latitude  * 1e7
+    i   longitude * 1e7
+    H   accuracy in decimetres, 0xFFFF when unknown
+
+gyrosensor/<device>/data, 15 bytes + 6 per sample (JSON is ~16 per sample):
+    B   tag 0x02
+    Q   epoch ms of the first sample
+    H   sample rate in Hz
+    H   sample count n
+    H   device step count for the batch, 0xFFFF when not sent
+    n * (h x, h y, h z)
+
+Decoded frames have the same keys as the JSON messages, with sensor
+samples as an (n, 3) int16 array read straight from the buffer.
+"""
+import json
+import struct
+
+import numpy as np
+
+JSON_CONTENT_TYPE = 'application/json'
+NONE_U16 = 0xFFFF
+
+_LOCATION = struct.Struct('<BiiH')
+_SENSOR_HEADER = struct.Struct('<BQHHH')
+_COORDINATE_SCALE = 1e7
+
+
+class PayloadError(ValueError):
+    """Raised for messages that cannot be decoded in any format their topic accepts"""
+    pass
+
+
+class BinaryCodec:
+    def __init__(self, content_type, tag, decoder):
+        self.content_type = content_type
+        self.tag = bytes([tag])
+        self.decoder = decoder
+
+    def decode(self, raw):
+        try:
+            return self.decoder(memoryview(raw))
+        except struct.error as e:
+            raise PayloadError(f'Truncated {self.content_type} frame: {e}')
+
+    def __repr__(self):
+        return f'<BinaryCodec {self.content_type}>'
+
+
+def decode_json(raw):
+    try:
+        return json.loads(bytes(raw).decode() if isinstance(raw, (bytes, bytearray, memoryview)) else raw)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise PayloadError(f'Invalid JSON: {e}')
+
+
+def decode(raw, codec=None, content_type=None):
+    """Decode one message for a route accepting JSON and optionally `codec`"""
+    if codec is not None:
+        if content_type == codec.content_type or (content_type in (None, '') and raw[:1] == codec.tag):
+            return codec.decode(raw)
+    if content_type not in (None, '', JSON_CONTENT_TYPE):
+        raise PayloadError(f'Unsupported content type {content_type}')
+    return decode_json(raw)
+
+
+def encode_location(latitude, longitude, accuracy=None):
+    return _LOCATION.pack(
+        LOCATION.tag[0],
+        round(latitude * _COORDINATE_SCALE),
+        round(longitude * _COORDINATE_SCALE),
+        NONE_U16 if accuracy is None else min(round(accuracy * 10), NONE_U16 - 1),
+    )
+
+
+def _decode_location(buffer):
+    _, latitude, longitude, accuracy = _LOCATION.unpack_from(buffer)
+    return {
+        'latitude': latitude / _COORDINATE_SCALE,
+        'longitude': longitude / _COORDINATE_SCALE,
+        'accuracy': None if accuracy == NONE_U16 else accuracy / 10,
+    }
+
+
+def encode_sensor_batch(ts, rate, xyz, steps=None):
+    samples = np.ascontiguousarray(xyz, dtype='<i2')
+    header = _SENSOR_HEADER.pack(
+        SENSOR_BATCH.tag[0], ts, rate, len(samples), NONE_U16 if steps is None else steps
+    )
+    return header + samples.tobytes()
+
+
+def _decode_sensor_batch(buffer):
+    _, ts, rate, count, steps = _SENSOR_HEADER.unpack_from(buffer)
+    if len(buffer) != _SENSOR_HEADER.size + 6 * count:
+        raise PayloadError(f'Sensor frame announces {count} samples but holds {len(buffer) - _SENSOR_HEADER.size} bytes')
+    if not count or not rate:
+        raise PayloadError('Sensor frame needs a sample rate and at least one sample')
+    payload = {
+        'ts': ts,
+        'rate': rate,
+        'samples': np.frombuffer(buffer, dtype='<i2', count=3 * count, offset=_SENSOR_HEADER.size).reshape(count, 3),
+    }
+    if steps != NONE_U16:
+        payload['steps'] = steps
+    return payload
+
+
+LOCATION = BinaryCodec('application/vnd.masshealth.location', 0x01, _decode_location)
+SENSOR_BATCH = BinaryCodec('application/vnd.masshealth.sensor-batch', 0x02, _decode_sensor_batch)
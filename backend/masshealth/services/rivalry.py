@@ -0,0 +1,375 @@
+"""
+Live scoring for accepted challenges (rivalries).
+
+Score updates arrive over MQTT, either directly on rivalries/<id>/updates
+or as step counts from a participant's wearable, and are applied to an
+in-memory Leaderboard per challenge. Nothing is written per message:
+
+- every PUBLISH_INTERVAL_MS at most, the participants whose score or rank
+  changed are published as one delta on rivalries/<id>/leaderboard
+- every SNAPSHOT_INTERVAL_SECONDS, changed scores of all challenges are
+  upserted into ChallengeScore with a single bulk query
+
+Cached boards re-read the challenge status every MEMBERSHIP_TTL_SECONDS,
+so a challenge completed, declined or deleted in another process stops
+taking updates.
+
+Accepted update payloads on rivalries/<id>/updates:
+    {"user_id": 5, "score": 120}     absolute score
+    {"user_id": 5, "delta": 10}      relative change
+Scores not yet snapshotted are lost if the process dies.
+"""
+import atexit
+import logging
+import threading
+import time
+from bisect import bisect_left, insort
+
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+LIVE_STATUS = 'accepted'
+
+
+class RivalryUpdateError(ValueError):
+    """Raised for updates that do not name a participant and a score"""
+    pass
+
+
+class Leaderboard:
+    """
+    Scores of one challenge with ranks kept in a sorted list of
+    (-score, order reached, user id) keys: ties go to whoever got there first.
+    """
+
+    def __init__(self, challenge_id, participants, scores=None):
+        self.challenge_id = challenge_id
+        self.participants = frozenset(participants)
+        self.version = 0
+        self.last_published = 0.0
+        self.checked_at = time.monotonic()  # when the challenge was last seen live
+        self.unpublished = set()
+        self.unsaved = set()
+        self._published_ranks = {}
+        self._scores = {}
+        self._keys = {}
+        self._order = []
+        self._counter = 0
+        for user_id in sorted(self.participants):
+            self._place(user_id, (scores or {}).get(user_id, 0))
+        self._published_ranks = {user_id: self.rank(user_id) for user_id in self.participants}
+
+    def _place(self, user_id, score):
+        old_key = self._keys.get(user_id)
+        if old_key is not None:
+            del self._order[bisect_left(self._order, old_key)]
+        self._counter += 1
+        key = (-score, self._counter, user_id)
+        insort(self._order, key)
+        self._keys[user_id] = key
+        self._scores[user_id] = score
+
+    def set_score(self, user_id, score):
+        if user_id not in self.participants:
+            raise RivalryUpdateError(f'User {user_id} is not part of challenge {self.challenge_id}')
+        if self._scores.get(user_id) == score:
+            return False
+        self._place(user_id, score)
+        self.unpublished.add(user_id)
+        self.unsaved.add(user_id)
+        return True
+
+    def add(self, user_id, delta):
+        return self.set_score(user_id, self._scores.get(user_id, 0) + delta)
+
+    def score(self, user_id):
+        return self._scores.get(user_id, 0)
+
+    def rank(self, user_id):
+        return bisect_left(self._order, self._keys[user_id]) + 1
+
+    def standings(self):
+        return [
+            {'user_id': user_id, 'score': -negative_score, 'rank': position}
+            for position, (negative_score, _, user_id) in enumerate(self._order, start=1)
+        ]
+
+    def take_delta(self):
+        """Participants whose score or rank changed since the last delta, or None"""
+        if not self.unpublished:
+            return None
+        changes = []
+        for entry in self.standings():
+            user_id = entry['user_id']
+            if user_id in self.unpublished or self._published_ranks.get(user_id) != entry['rank']:
+                changes.append(entry)
+                self._published_ranks[user_id] = entry['rank']
+        self.unpublished.clear()
+        self.version += 1
+        return {
+            'challenge_id': self.challenge_id,
+            'version': self.version,
+            'changes': changes,
+            'ts': int(time.time() * 1000),
+        }
+
+
+class RivalryEngine:
+    def __init__(self):
+        config = getattr(settings, 'RIVALRY', {})
+        self.publish_interval = config.get('PUBLISH_INTERVAL_MS', 1000) / 1000
+        self.snapshot_interval = config.get('SNAPSHOT_INTERVAL_SECONDS', 5)
+        self.tick_interval = config.get('TICK_MS', 200) / 1000
+        self.membership_ttl = config.get('MEMBERSHIP_TTL_SECONDS', 60)
+        self.publisher = None  # callable(topic, payload), set by the MQTT client
+        self._boards = {}
+        self._not_live = {}  # challenge id -> time it was found not live
+        self._user_challenges = {}  # user id -> (challenge ids, loaded at)
+        self._epoch = 0  # bumped by invalidate() so loads that raced it are not cached
+        self._lock = threading.RLock()
+        self._ticker = None
+        self._last_snapshot = time.monotonic()
+
+    def _live_participants(self, challenge_id):
+        """(from user, to user) of a live challenge, None if it is not live"""
+        from masshealth.models import Challenge
+
+        return (
+            Challenge.objects.filter(pk=challenge_id, status=LIVE_STATUS)
+            .values_list('from_user_id', 'to_user_id').first()
+        )
+
+    def _load_board(self, challenge_id):
+        """Leaderboard of a live challenge from the database, None if it is not live"""
+        from masshealth.models import ChallengeScore
+
+        row = self._live_participants(challenge_id)
+        if row is None:
+            return None
+        scores = dict(ChallengeScore.objects.filter(challenge_id=challenge_id).values_list('user_id', 'score'))
+        return Leaderboard(challenge_id, row, scores)
+
+    def board(self, challenge_id):
+        # Queries run outside the lock; a load that raced an invalidate() is not cached
+        while True:
+            with self._lock:
+                board = self._boards.get(challenge_id)
+                now = time.monotonic()
+                if board is not None and now - board.checked_at < self.membership_ttl:
+                    return board
+                if board is None and now - self._not_live.get(challenge_id, -self.membership_ttl) < self.membership_ttl:
+                    return None
+                epoch = self._epoch
+            if board is not None:
+                # Changed by another process? Its signals only reach that process's engine
+                row = self._live_participants(challenge_id)
+                with self._lock:
+                    if self._boards.get(challenge_id) is not board:
+                        continue
+                    if row is not None and frozenset(row) == board.participants:
+                        board.checked_at = time.monotonic()
+                        return board
+                self.invalidate(challenge_id)
+                continue
+            loaded = self._load_board(challenge_id)
+            with self._lock:
+                if self._epoch != epoch:
+                    continue
+                if loaded is None:
+                    self._not_live[challenge_id] = time.monotonic()
+                    return None
+                return self._boards.setdefault(challenge_id, loaded)
+
+    def _apply(self, challenge_id, change):
+        """Run change(board) under the lock on the current board; False if the challenge is not live"""
+        while True:
+            board = self.board(challenge_id)
+            if board is None:
+                return False
+            with self._lock:
+                # Retry if the board was invalidated while it was being looked up
+                if self._boards.get(challenge_id) is board:
+                    change(board)
+                    return True
+
+    def handle_update(self, challenge_id, payload):
+        """Apply one rivalries/<id>/updates message; False if the challenge is not live"""
+        if not isinstance(payload, dict) or 'user_id' not in payload:
+            raise RivalryUpdateError('Rivalry update needs user_id and score or delta')
+        try:
+            user_id = int(payload['user_id'])
+            score = int(payload['score']) if 'score' in payload else None
+            delta = int(payload['delta']) if 'delta' in payload else None
+        except (TypeError, ValueError):
+            raise RivalryUpdateError('user_id, score and delta must be integers')
+        if score is None and delta is None:
+            raise RivalryUpdateError('Rivalry update needs user_id and score or delta')
+
+        if score is not None:
+            applied = self._apply(int(challenge_id), lambda board: board.set_score(user_id, score))
+        else:
+            applied = self._apply(int(challenge_id), lambda board: board.add(user_id, delta))
+        if applied:
+            self._ensure_ticker()
+        return applied
+
+    def record_steps(self, user_id, steps):
+        """Add a participant's new steps to every live challenge they are in"""
+        if steps <= 0:
+            return
+        for challenge_id in self._challenges_of(user_id):
+            self._apply(challenge_id, lambda board: board.add(user_id, steps))
+        self._ensure_ticker()
+
+    def _challenges_of(self, user_id):
+        from masshealth.models import Challenge
+
+        with self._lock:
+            cached = self._user_challenges.get(user_id)
+            if cached and time.monotonic() - cached[1] < self.membership_ttl:
+                return cached[0]
+            epoch = self._epoch
+        challenge_ids = list(
+            Challenge.objects
+            .filter(Q(from_user_id=user_id) | Q(to_user_id=user_id), status=LIVE_STATUS)
+            .values_list('id', flat=True)
+        )
+        with self._lock:
+            if self._epoch == epoch:
+                self._user_challenges[user_id] = (challenge_ids, time.monotonic())
+        return challenge_ids
+
+    def invalidate(self, challenge_id, user_ids=(), persist=True):
+        """Forget cached state after a challenge changed, publishing and persisting it first"""
+        with self._lock:
+            self._epoch += 1
+            board = self._boards.pop(challenge_id, None)
+            self._not_live.pop(challenge_id, None)
+            for user_id in user_ids:
+                self._user_challenges.pop(user_id, None)
+            if board is None or not persist:
+                return
+            delta = board.take_delta()
+        if delta and self.publisher is not None:
+            self.publisher(f"rivalries/{challenge_id}/leaderboard", delta)
+        self.snapshot(only=[board])
+
+    def publish_due(self, now=None):
+        now = time.monotonic() if now is None else now
+        deltas = []
+        with self._lock:
+            for board in self._boards.values():
+                if board.unpublished and now - board.last_published >= self.publish_interval:
+                    delta = board.take_delta()
+                    board.last_published = now
+                    deltas.append(delta)
+        if self.publisher is not None:
+            for delta in deltas:
+                self.publisher(f"rivalries/{delta['challenge_id']}/leaderboard", delta)
+        return len(deltas)
+
+    def snapshot(self, only=None):
+        """Upsert every changed score with one query; returns the number of rows written"""
+        from masshealth.models import ChallengeScore
+
+        now = timezone.now()
+        with self._lock:
+            rows = []
+            taken = []
+            for board in (only if only is not None else list(self._boards.values())):
+                for user_id in board.unsaved:
+                    rows.append(ChallengeScore(
+                        challenge_id=board.challenge_id, user_id=user_id,
+                        score=board.score(user_id), updated_at=now,
+                    ))
+                    taken.append((board, user_id))
+                board.unsaved.clear()
+        if not rows:
+            return 0
+        try:
+            try:
+                self._write_scores(rows)
+            except IntegrityError:
+                rows, taken = self._without_deleted_challenges(rows, taken)
+                self._write_scores(rows)
+        except Exception:
+            # Saved with the next snapshot (at their score by then)
+            with self._lock:
+                for board, user_id in taken:
+                    board.unsaved.add(user_id)
+            raise
+        return len(rows)
+
+    def _write_scores(self, rows):
+        from masshealth.models import ChallengeScore
+
+        # A savepoint, so a failed write does not break a surrounding transaction
+        with transaction.atomic():
+            ChallengeScore.objects.bulk_create(
+                rows,
+                update_conflicts=True,
+                unique_fields=['challenge', 'user'],
+                update_fields=['score', 'updated_at'],
+                batch_size=500,
+            )
+
+    def _without_deleted_challenges(self, rows, taken):
+        """
+        Drop the scores (and cached boards) of challenges deleted by another
+        process, so one of them does not fail every later snapshot
+        """
+        from masshealth.models import Challenge
+
+        challenge_ids = {row.challenge_id for row in rows}
+        existing = set(Challenge.objects.filter(pk__in=challenge_ids).values_list('pk', flat=True))
+        deleted = challenge_ids - existing
+        if deleted:
+            logger.warning("Dropping unsaved scores of deleted challenge(s) %s", sorted(deleted))
+            for challenge_id in deleted:
+                self.invalidate(challenge_id, persist=False)
+        return (
+            [row for row in rows if row.challenge_id in existing],
+            [(board, user_id) for board, user_id in taken if board.challenge_id in existing],
+        )
+
+    def tick(self):
+        self.publish_due()
+        if time.monotonic() - self._last_snapshot >= self.snapshot_interval:
+            self._last_snapshot = time.monotonic()
+            self.snapshot()
+
+    def _ensure_ticker(self):
+        if self._ticker is not None:
+            return
+        with self._lock:
+            if self._ticker is None:
+                self._ticker = threading.Thread(target=self._run, name='rivalry-ticker', daemon=True)
+                self._ticker.start()
+                atexit.register(self.snapshot)
+
+    def _run(self):
+        while True:
+            time.sleep(self.tick_interval)
+            close_old_connections()
+            try:
+                self.tick()
+            except Exception:
+                logger.exception("Rivalry tick failed")
+
+
+rivalry_engine = RivalryEngine()
+
+
+def challenge_saved(sender, instance, raw=False, **kwargs):
+    """post_save receiver: drop cached state so status and participants are re-read"""
+    if not raw:
+        rivalry_engine.invalidate(instance.pk, (instance.from_user_id, instance.to_user_id))
+
+
+def challenge_deleted(sender, instance, **kwargs):
+    # Score rows went with the challenge, so there is nothing to persist
+    rivalry_engine.invalidate(instance.pk, (instance.from_user_id, instance.to_user_id), persist=False)
@@ -0,0 +1,342 @@
+"""
+Time-series store for wearable accelerometer samples (gyrosensor/<device>/data).
+
+Samples are buffered in memory per device and time window, then written
+as one SensorChunk per window: a zlib-compressed columnar blob holding
+the delta-coded millisecond offsets (int32) followed by the x, y and z
+columns (int16). Full windows are flushed with a single bulk insert, so
+a 100 Hz stream costs one row per device per minute instead of 6000.
+
+Accepted JSON payloads (ts is epoch ms, defaulting to arrival time; a
+batch stamped more than MAX_CLOCK_AHEAD_MS past its arrival is shifted
+back so it ends at arrival, since a future window would never close):
+    {"x": 12, "y": -40, "z": 1010, "ts": 1718000000000}
+    {"samples": [[x, y, z], ...], "rate": 100, "ts": <first sample>, "steps": 3}
+    {"samples": [[ts, x, y, z], ...]}
+Binary frames (services.payload_codecs) decode to the second layout with
+samples already as an int16 array.
+"steps" is the device's own count for the batch, kept until the chunk is
+analysed server-side.
+"""
+import atexit
+import logging
+import struct
+import threading
+import time
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+import numpy as np
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import Sum
+from django.utils import timezone
+
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+CHUNK_VERSION = 1
+_HEADER = struct.Struct('<BI')  # format version, sample count
+DEFAULT_RATE_HZ = 100
+MAX_CLOCK_AHEAD_MS = 10_000
+
+
+class SensorPayloadError(ValueError):
+    """Raised for sensor messages that do not match any accepted layout"""
+    pass
+
+
+def encode_chunk(offsets, xyz):
+    """Pack sorted ms offsets from the chunk start (n,) and int16 samples (n, 3)"""
+    deltas = np.diff(offsets, prepend=0).astype('<i4')
+    columns = np.ascontiguousarray(xyz.T, dtype='<i2')
+    return _HEADER.pack(CHUNK_VERSION, len(offsets)) + zlib.compress(deltas.tobytes() + columns.tobytes(), 6)
+
+
+def decode_chunk(blob, start_ms=0):
+    """(epoch ms timestamps int64 (n,), int16 samples (n, 3)) from a chunk blob"""
+    version, count = _HEADER.unpack_from(blob)
+    if version != CHUNK_VERSION:
+        raise ValueError(f'Unknown sensor chunk version {version}')
+    body = zlib.decompress(bytes(blob[_HEADER.size:]))
+    timestamps = np.cumsum(np.frombuffer(body, dtype='<i4', count=count), dtype=np.int64) + start_ms
+    columns = np.frombuffer(body, dtype='<i2', count=3 * count, offset=4 * count).reshape(3, count)
+    return timestamps, columns.T
+
+
+def parse_payload(payload, received_ms):
+    """(timestamps int64, samples int16 (n, 3), device step count or None) from a decoded message"""
+    timestamps, xyz, steps = _parse_layout(payload, received_ms)
+    ahead = int(timestamps.max()) - received_ms
+    if ahead > MAX_CLOCK_AHEAD_MS:
+        timestamps = timestamps - ahead
+    return timestamps, xyz, steps
+
+
+def _number(payload, key, default, convert=int):
+    try:
+        value = convert(payload.get(key, default))
+    except (TypeError, ValueError, OverflowError):
+        raise SensorPayloadError(f'{key} must be a number')
+    if not abs(value) <= 2 ** 62:  # also false for NaN
+        raise SensorPayloadError(f'{key} must be a number')
+    return value
+
+
+def _rate(payload):
+    rate = _number(payload, 'rate', DEFAULT_RATE_HZ, float)
+    if rate <= 0:
+        raise SensorPayloadError('rate must be positive')
+    return rate
+
+
+def _steps(payload):
+    if payload.get('steps') is None:
+        return None
+    steps = _number(payload, 'steps', None)
+    if steps < 0:
+        raise SensorPayloadError('steps must not be negative')
+    return steps
+
+
+def _parse_layout(payload, received_ms):
+    if not isinstance(payload, dict):
+        raise SensorPayloadError('Sensor payload must be a JSON object')
+    start = _number(payload, 'ts', received_ms)
+
+    samples = payload.get('samples')
+    if isinstance(samples, np.ndarray) and samples.dtype == np.int16:
+        # Decoded binary frame: already int16 (n, 3), nothing to convert or clip
+        if not len(samples):
+            raise SensorPayloadError('samples must not be empty')
+        timestamps = start + np.round(np.arange(len(samples)) * (1000.0 / _rate(payload))).astype(np.int64)
+        return timestamps, samples, _steps(payload)
+
+    if samples is not None:
+        try:
+            rows = np.asarray(samples, dtype=np.int64)
+        except (TypeError, ValueError, OverflowError):
+            rows = None  # ragged or not numbers
+        if rows is None or rows.ndim != 2 or rows.shape[1] not in (3, 4) or not len(rows):
+            raise SensorPayloadError('samples must be a non-empty list of [x, y, z] or [ts, x, y, z]')
+        if rows.shape[1] == 4:
+            timestamps, xyz = rows[:, 0], rows[:, 1:]
+        else:
+            timestamps = start + np.round(np.arange(len(rows)) * (1000.0 / _rate(payload))).astype(np.int64)
+            xyz = rows
+    elif all(axis in payload for axis in ('x', 'y', 'z')):
+        timestamps = np.array([start], dtype=np.int64)
+        xyz = np.array([[_number(payload, axis, None) for axis in ('x', 'y', 'z')]], dtype=np.int64)
+    else:
+        raise SensorPayloadError('Sensor payload needs x/y/z or samples')
+
+    return timestamps, np.clip(xyz, -32768, 32767).astype(np.int16), _steps(payload)
+
+
+def _local_day(epoch_ms):
+    return timezone.localtime(datetime.fromtimestamp(epoch_ms / 1000, tz=dt_timezone.utc)).date()
+
+
+class SensorBuffer:
+    """
+    Collects samples per (device, window) and writes closed windows in bulk.
+
+    A window is written once it has been closed for LATE_GRACE_SECONDS, by
+    a background flusher thread every FLUSH_INTERVAL_SECONDS. Everything is
+    flushed when MAX_BUFFERED_SAMPLES is reached and at interpreter exit.
+    Windows whose write fails stay buffered for the next flush, but while
+    writes fail the oldest windows past MAX_BUFFERED_SAMPLES are dropped
+    (sensor.dropped_samples). Samples still buffered when the process dies
+    are lost.
+    """
+
+    def __init__(self):
+        config = getattr(settings, 'SENSOR_STORE', {})
+        self.window_ms = config.get('WINDOW_SECONDS', 60) * 1000
+        self.grace_ms = config.get('LATE_GRACE_SECONDS', 5) * 1000
+        self.flush_interval = config.get('FLUSH_INTERVAL_SECONDS', 5)
+        self.max_samples = config.get('MAX_BUFFERED_SAMPLES', 100_000)
+        # (device_id, window start) -> {'t': [arrays], 'xyz': [arrays], 'steps': int or None}
+        self._windows = {}
+        self._buffered = 0
+        self._retry_at = 0.0  # no forced flush before this (monotonic) after one failed
+        self._lock = threading.Lock()
+        self._flusher = None
+
+    def add(self, device_id, timestamps, xyz, steps=None):
+        windows = timestamps // self.window_ms * self.window_ms
+        if windows[0] == windows[-1]:
+            groups = [(int(windows[0]), slice(None))]
+        else:
+            groups = [(int(start), windows == start) for start in np.unique(windows)]
+
+        with self._lock:
+            for index, (start, selection) in enumerate(groups):
+                entry = self._windows.setdefault((device_id, start), {'t': [], 'xyz': [], 'steps': None})
+                entry['t'].append(timestamps[selection])
+                entry['xyz'].append(xyz[selection])
+                # A batch's device step count is attributed to the window it starts in
+                if steps is not None and index == 0:
+                    entry['steps'] = (entry['steps'] or 0) + steps
+            self._buffered += len(timestamps)
+            full = self._buffered >= self.max_samples
+            if full and time.monotonic() < self._retry_at:
+                self._drop_oldest()
+                full = False
+
+        self._ensure_flusher()
+        if full:
+            try:
+                self.flush(force=True)
+            except Exception:
+                # Not raised into the message handler; the database is likely down
+                logger.exception("Sensor buffer flush failed with %s samples buffered", self._buffered)
+                with self._lock:
+                    self._retry_at = time.monotonic() + self.flush_interval
+                    self._drop_oldest()
+
+    def _drop_oldest(self):
+        """Under the lock: drop the oldest windows until the buffer is below its limit"""
+        dropped = 0
+        for key in sorted(self._windows, key=lambda key: key[1]):
+            if self._buffered < self.max_samples:
+                break
+            count = sum(len(t) for t in self._windows.pop(key)['t'])
+            self._buffered -= count
+            dropped += count
+        if dropped:
+            registry.counter('sensor.dropped_samples').inc(dropped)
+            logger.warning("Dropped %s buffered sensor samples while writes are failing", dropped)
+
+    def _ensure_flusher(self):
+        if self._flusher is not None:
+            return
+        with self._lock:
+            if self._flusher is None:
+                self._flusher = threading.Thread(target=self._run, name='sensor-flush', daemon=True)
+                self._flusher.start()
+                atexit.register(self.flush, force=True)
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            close_old_connections()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("Sensor buffer flush failed")
+
+    def _take_ready(self, force):
+        cutoff = int(time.time() * 1000) - self.window_ms - self.grace_ms
+        with self._lock:
+            ready = [key for key in self._windows if force or key[1] <= cutoff]
+            taken = [(key, self._windows.pop(key)) for key in ready]
+            self._buffered -= sum(sum(len(t) for t in entry['t']) for _, entry in taken)
+        return taken
+
+    def flush(self, force=False):
+        """Write closed windows (all windows if force); returns the number of chunks written"""
+        taken = self._take_ready(force)
+        if not taken:
+            return 0
+        try:
+            return self._write(taken)
+        except Exception:
+            # Keep the samples for the next flush instead of losing the windows
+            self._restore(taken)
+            raise
+
+    def _restore(self, taken):
+        with self._lock:
+            for key, entry in taken:
+                self._buffered += sum(len(t) for t in entry['t'])
+                current = self._windows.get(key)
+                if current is not None:
+                    # Samples that arrived for the window meanwhile
+                    entry['t'].extend(current['t'])
+                    entry['xyz'].extend(current['xyz'])
+                    if current['steps'] is not None:
+                        entry['steps'] = (entry['steps'] or 0) + current['steps']
+                self._windows[key] = entry
+
+    def _write(self, taken):
+        from masshealth.models import CustomUser, SensorChunk
+
+        # Devices named after a user id (gyrosensor/<user id>/data) are linked to that user
+        numeric_ids = {int(device) for (device, _), _ in taken if device.isdigit()}
+        user_ids = set(CustomUser.objects.filter(id__in=numeric_ids).values_list('id', flat=True))
+
+        chunks = []
+        for (device_id, _), entry in taken:
+            timestamps = np.concatenate(entry['t'])
+            xyz = np.concatenate(entry['xyz'])
+            order = np.argsort(timestamps, kind='stable')
+            timestamps, xyz = timestamps[order], xyz[order]
+            start_ms = int(timestamps[0])
+            chunks.append(SensorChunk(
+                device_id=device_id,
+                user_id=int(device_id) if device_id.isdigit() and int(device_id) in user_ids else None,
+                day=_local_day(start_ms),
+                start_ms=start_ms,
+                end_ms=int(timestamps[-1]),
+                sample_count=len(timestamps),
+                data=encode_chunk(timestamps - start_ms, xyz),
+                steps=entry['steps'],
+            ))
+        SensorChunk.objects.bulk_create(chunks, batch_size=500)
+        return len(chunks)
+
+
+sensor_buffer = SensorBuffer()
+
+
+def ingest(device_id, payload, received_ms=None):
+    """Buffer one decoded gyrosensor message"""
+    received_ms = received_ms if received_ms is not None else int(time.time() * 1000)
+    timestamps, xyz, steps = parse_payload(payload, received_ms)
+    sensor_buffer.add(device_id, timestamps, xyz, steps)
+    return len(timestamps)
+
+
+def read_range(device_id, start_ms, end_ms):
+    """All stored samples of a device with start_ms <= ts <= end_ms, in time order"""
+    from masshealth.models import SensorChunk
+
+    rows = (
+        SensorChunk.objects
+        .filter(device_id=device_id, start_ms__lte=end_ms, end_ms__gte=start_ms)
+        .order_by('start_ms')
+        .values_list('start_ms', 'data')
+    )
+    decoded = [decode_chunk(data, chunk_start) for chunk_start, data in rows]
+    if not decoded:
+        return np.empty(0, dtype=np.int64), np.empty((0, 3), dtype=np.int16)
+
+    timestamps = np.concatenate([t for t, _ in decoded])
+    xyz = np.concatenate([samples for _, samples in decoded])
+    keep = (timestamps >= start_ms) & (timestamps <= end_ms)
+    timestamps, xyz = timestamps[keep], xyz[keep]
+    # Late chunks for an earlier window can overlap their neighbours
+    if len(timestamps) > 1 and np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, xyz = timestamps[order], xyz[order]
+    return timestamps, xyz
+
+
+def daily_steps(days, device_id=None, user=None):
+    """{date: steps} for the last `days` days (today included), from a single grouped query"""
+    from masshealth.models import SensorChunk
+
+    first_day = timezone.localdate() - timedelta(days=days - 1)
+    chunks = SensorChunk.objects.filter(day__gte=first_day)
+    if device_id is not None:
+        chunks = chunks.filter(device_id=device_id)
+    if user is not None:
+        chunks = chunks.filter(user=user)
+
+    totals = defaultdict(int)
+    for day, steps in chunks.order_by().values('day').annotate(steps=Sum('steps')).values_list('day', 'steps'):
+        totals[day] += steps or 0
+    return dict(totals)
@@ -0,0 +1,228 @@
+"""
+Derived assets for sounds, built once when an upload is processed:
+
+- peaks: a downsampled min/max waveform in the audiowaveform JSON layout
+  (8-bit, one channel), small enough to ship in the sound listing so the
+  app can draw a waveform without fetching any audio
+- preview: the first few seconds as a mono 22.05kHz WAV with a short fade-out
+
+The audio itself is served by ranged_file_response with byte ranges and
+versioned URLs, so players can seek and start before the file is complete
+and clients can cache it indefinitely.
+"""
+import hashlib
+import logging
+import os
+import re
+import subprocess
+
+import numpy as np
+from django.http import HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.cache import patch_cache_control
+from django.utils.http import http_date, parse_etags
+
+from . import mdct
+
+logger = logging.getLogger(__name__)
+
+PEAKS_WIDTH = 800
+PREVIEW_SECONDS = 5
+PREVIEW_SAMPLE_RATE = 22050
+PREVIEW_FADE_SECONDS = 0.05
+STREAM_CHUNK_SIZE = 64 * 1024
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def load_samples(path):
+    """(int16 samples, sample rate) for a processed sound, None if it can't be decoded"""
+    from .sound_processing import transcode_to_pcm
+
+    try:
+        return mdct.read_wav(path)
+    except mdct.MDCTError:
+        pass
+    try:
+        return transcode_to_pcm(path)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        logger.warning("Could not decode %s for waveform/preview: %s", path, e)
+        return None
+
+
+def compute_peaks(samples, sample_rate, width=PEAKS_WIDTH):
+    """
+    Min/max pairs over `width` equal slices of the audio, all channels
+    folded together, scaled to 8 bits. Layout follows audiowaveform's JSON
+    output so existing waveform renderers can draw it as is.
+    """
+    frames = len(samples)
+    samples_per_pixel = max(1, -(-frames // width))
+    whole = frames // samples_per_pixel * samples_per_pixel
+
+    # View whole slices as rows; only the trailing partial slice is handled apart
+    rows = np.asarray(samples[:whole]).reshape(-1, samples_per_pixel * samples.shape[1])
+    minima, maxima = rows.min(axis=1), rows.max(axis=1)
+    if whole < frames:
+        rest = np.asarray(samples[whole:])
+        minima = np.append(minima, rest.min())
+        maxima = np.append(maxima, rest.max())
+
+    data = np.empty(2 * len(minima), dtype=np.int16)
+    data[0::2] = minima >> 8
+    data[1::2] = maxima >> 8
+    return {
+        'version': 2,
+        'channels': 1,
+        'sample_rate': sample_rate,
+        'samples_per_pixel': samples_per_pixel,
+        'bits': 8,
+        'length': len(minima),
+        'data': data.tolist(),
+    }
+
+
+def make_preview(samples, sample_rate, seconds=PREVIEW_SECONDS):
+    """First `seconds` of audio as mono int16 at PREVIEW_SAMPLE_RATE (or the source rate if lower)"""
+    clip = np.asarray(samples[:int(seconds * sample_rate)], dtype=np.float64).mean(axis=1)
+
+    # Integer decimation, averaging each group as a crude low-pass
+    factor = max(1, sample_rate // PREVIEW_SAMPLE_RATE)
+    if factor > 1:
+        clip = clip[:len(clip) // factor * factor].reshape(-1, factor).mean(axis=1)
+    rate = sample_rate // factor
+
+    fade = min(len(clip), int(PREVIEW_FADE_SECONDS * rate))
+    if fade and len(samples) > seconds * sample_rate:
+        clip[-fade:] *= np.linspace(1.0, 0.0, fade)
+    return np.round(clip).astype('<i2')[:, None], rate
+
+
+def build_sound_assets(sound, media_root):
+    """
+    Compute peaks and write the preview clip for a sound whose file is final.
+    Sets sound.peaks and sound.preview (not saved). Returns the decoded
+    (samples, sample_rate), or None when the audio could not be decoded.
+    """
+    decoded = load_samples(sound.file.path)
+    if decoded is None:
+        return None
+    samples, sample_rate = decoded
+    if not len(samples):
+        return decoded
+
+    sound.peaks = compute_peaks(samples, sample_rate)
+
+    preview, preview_rate = make_preview(samples, sample_rate)
+    preview_dir = os.path.join(media_root, 'sounds', 'previews')
+    os.makedirs(preview_dir, exist_ok=True)
+    mdct.write_wav(os.path.join(preview_dir, f"{sound.id}.wav"), preview, preview_rate)
+    sound.preview.name = f"sounds/previews/{sound.id}.wav"
+    return decoded
+
+
+def media_version(sound):
+    """
+    Short hash of the name, size and mtime of the sound's files; part of
+    every media URL, so it changes whenever a file is replaced or rewritten
+    (not only when the processing pipeline records it).
+    """
+    identity = []
+    for field in (sound.file, sound.preview):
+        if not field:
+            continue
+        try:
+            stat = os.stat(field.path)
+        except OSError:
+            continue
+        identity.append(f'{field.name}:{stat.st_size}:{stat.st_mtime_ns}')
+    return hashlib.sha1('|'.join(identity).encode()).hexdigest()[:12]
+
+
+def media_urls(request, sound):
+    """Versioned, range-capable URLs for the full audio and the preview clip"""
+    def url(variant):
+        path = reverse('sound-media', kwargs={'sound_id': sound.id, 'variant': variant})
+        return request.build_absolute_uri(f"{path}?v={media_version(sound)}")
+
+    return {
+        'stream_url': url('audio') if sound.file else None,
+        'preview_url': url('preview') if sound.preview else None,
+    }
+
+
+def _parse_range(header, size):
+    """(start, end) inclusive for a single satisfiable byte range, None to serve everything, False if unsatisfiable"""
+    match = _RANGE_RE.match(header.replace(' ', ''))
+    if not match:
+        # Multiple ranges or other units: a full response is always allowed
+        return None
+    first, last = match.groups()
+    if not first and not last:
+        return None
+    if not first:
+        suffix = int(last)
+        if suffix == 0 or size == 0:
+            return False
+        return max(0, size - suffix), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        # An invalid range is ignored rather than unsatisfiable (RFC 9110 14.1.1)
+        return None
+    if start >= size:
+        return False
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def _read_range(path, start, length):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def ranged_file_response(request, path, content_type, etag_seed, immutable=False):
+    """
+    Serve a file with single byte-range support (206 / 416), ETag and
+    If-Range validation. `immutable` marks the response cacheable for a
+    year; only pass it when the URL is versioned.
+    """
+    stat = os.stat(path)
+    size = stat.st_size
+    etag = f'"{etag_seed}-{int(stat.st_mtime)}-{size}"'
+
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match and (etag in parse_etags(if_none_match) or if_none_match.strip() == '*'):
+        response = HttpResponseNotModified()
+    else:
+        byte_range = None
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        if range_header and (not if_range or if_range.strip() == etag):
+            byte_range = _parse_range(range_header, size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+        else:
+            start, end = byte_range or (0, size - 1)
+            length = max(0, end - start + 1)
+            body = _read_range(path, start, length) if request.method != 'HEAD' else []
+            response = StreamingHttpResponse(body, content_type=content_type, status=206 if byte_range else 200)
+            response['Content-Length'] = str(length)
+            if byte_range:
+                response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(stat.st_mtime)
+    if immutable:
+        patch_cache_control(response, public=True, max_age=IMMUTABLE_MAX_AGE, immutable=True)
+    else:
+        patch_cache_control(response, public=True, no_cache=True)
+    return response
@@ -0,0 +1,253 @@
+import logging
+import os
+import subprocess
+import tempfile
+from datetime import timedelta
+
+import numpy as np
+from django.conf import settings
+from django.utils import timezone
+
+from . import mdct
+from .jobs import background_jobs
+from .sound_assets import build_sound_assets
+
+logger = logging.getLogger(__name__)
+
+MDCT_TIMEOUT_SECONDS = 600
+TARGET_SAMPLE_RATE = 44100
+
+
+def _empty_stats():
+    return {
+        'compressed': False,
+        'original_size': 0,
+        'compressed_size': 0,
+        'ratio': 0,
+        'savings_percent': 0,
+        'error': None
+    }
+
+
+def transcode_to_pcm(path, chunk_size=1024 * 1024):
+    """
+    Decode anything ffmpeg understands to 44.1kHz stereo int16 samples.
+    Raw PCM is read from ffmpeg's stdout a chunk at a time into one growing
+    buffer, so the decoded audio is held once and nothing touches the disk.
+    """
+    pcm = bytearray()
+    # stderr goes to a file: a corrupt input can log more than a pipe holds
+    with tempfile.TemporaryFile() as errors:
+        with subprocess.Popen([
+            'ffmpeg', '-v', 'error', '-i', path,
+            '-f', 's16le', '-acodec', 'pcm_s16le',
+            '-ar', str(TARGET_SAMPLE_RATE), '-ac', '2', 'pipe:1'
+        ], stdout=subprocess.PIPE, stderr=errors) as process:
+            while chunk := process.stdout.read(chunk_size):
+                pcm += chunk
+        if process.returncode:
+            errors.seek(0)
+            raise subprocess.CalledProcessError(process.returncode, process.args, stderr=errors.read())
+    frames = len(pcm) // 4
+    return np.frombuffer(pcm, dtype='<i2', count=frames * 2).reshape(frames, 2), TARGET_SAMPLE_RATE
+
+
+def compress_sound(sound):
+    """
+    Transcode the upload to 44.1kHz stereo and run the MDCT compressor on it.
+    On success the sound points at the compressed file, which is the only
+    file written. Returns the compression stats; failures are reported in
+    stats['error'].
+    """
+    stats = _empty_stats()
+    original_path = sound.file.path
+    stats['original_size'] = os.path.getsize(original_path)
+
+    backend = mdct_backend()
+    if backend is None:
+        stats['error'] = 'MDCT compressor not configured'
+        return stats
+    stats['backend'] = backend
+
+    compressed_dir = os.path.join(settings.MEDIA_ROOT, 'sounds', 'compressed')
+    os.makedirs(compressed_dir, exist_ok=True)
+    compressed_path = os.path.join(compressed_dir, f"{sound.id}.wav")
+
+    if backend == 'external':
+        return _compress_external(sound, original_path, compressed_path, stats)
+
+    try:
+        samples, sample_rate = transcode_to_pcm(original_path)
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        stats['error'] = _ffmpeg_error(e)
+        # Without ffmpeg the upload itself has to be 16-bit PCM WAV
+        try:
+            samples, sample_rate = mdct.read_wav(original_path)
+        except mdct.MDCTError:
+            return stats
+        stats['error'] = None
+
+    try:
+        reconstructed, codec_stats = mdct.compress(samples, sound.block_size_n, sound.discard_m)
+    except mdct.MDCTError as e:
+        stats['error'] = f'MDCT error: {e}'
+        return stats
+    mdct.write_wav(compressed_path, reconstructed, sample_rate)
+    _mark_compressed(sound, stats, codec_stats['encoded_size'])
+    return stats
+
+
+def _ffmpeg_error(e):
+    if isinstance(e, FileNotFoundError):
+        return 'ffmpeg not found'
+    return f'ffmpeg failed: {e.stderr.decode(errors="replace")[:100]}'
+
+
+def _compress_external(sound, original_path, compressed_path, stats):
+    # The external tool only reads files, so it gets one transcoded temp WAV
+    # as input and writes its output straight to the final location
+    with tempfile.NamedTemporaryFile(suffix='.wav', delete=False) as tmp_wav:
+        tmp_wav_path = tmp_wav.name
+
+    try:
+        try:
+            subprocess.run([
+                'ffmpeg', '-y', '-v', 'error', '-i', original_path,
+                '-ar', str(TARGET_SAMPLE_RATE), '-ac', '2', tmp_wav_path
+            ], check=True, capture_output=True)
+            input_path = tmp_wav_path
+        except (FileNotFoundError, subprocess.CalledProcessError) as e:
+            stats['error'] = _ffmpeg_error(e)
+            input_path = original_path
+
+        mdct_path = settings.MDCT_COMPRESSOR_PATH
+        # Use absolute paths for Windows compatibility
+        abs_input = os.path.abspath(input_path)
+        abs_output = os.path.abspath(compressed_path)
+        logger.info("MDCT running: %s %s %s %s %s", mdct_path, abs_input, abs_output,
+                    sound.block_size_n, sound.discard_m)
+
+        try:
+            result = subprocess.run([
+                mdct_path, abs_input, abs_output,
+                str(sound.block_size_n), str(sound.discard_m)
+            ], capture_output=True, timeout=MDCT_TIMEOUT_SECONDS, cwd=os.path.dirname(mdct_path))
+        except subprocess.TimeoutExpired:
+            stats['error'] = f'MDCT timed out after {MDCT_TIMEOUT_SECONDS}s'
+            _remove(compressed_path)
+            return stats
+
+        stdout = result.stdout.decode('utf-8', errors='replace') if result.stdout else ''
+        stderr = result.stderr.decode('utf-8', errors='replace') if result.stderr else ''
+        logger.debug("MDCT exit %s\nstdout: %s\nstderr: %s", result.returncode, stdout, stderr)
+
+        if result.returncode != 0:
+            stats['error'] = f'MDCT exit {result.returncode}: {stderr or stdout or "no output"}'[:200]
+            _remove(compressed_path)
+        elif os.path.exists(compressed_path) and os.path.getsize(compressed_path) > 0:
+            _mark_compressed(sound, stats, os.path.getsize(compressed_path))
+        else:
+            stats['error'] = 'MDCT produced empty output'
+            _remove(compressed_path)
+        return stats
+    finally:
+        _remove(tmp_wav_path)
+
+
+def _remove(path):
+    if os.path.exists(path):
+        os.unlink(path)
+
+
+def mdct_backend():
+    """
+    'python' or 'external' according to MDCT_BACKEND, or None when the
+    external tool is required but missing. 'auto' prefers the external
+    tool when it is installed and falls back to the in-process codec.
+    """
+    backend = getattr(settings, 'MDCT_BACKEND', 'auto')
+    mdct_path = getattr(settings, 'MDCT_COMPRESSOR_PATH', None)
+    external_available = bool(mdct_path and os.path.exists(mdct_path))
+    if backend == 'python':
+        return 'python'
+    if backend == 'external':
+        return 'external' if external_available else None
+    return 'external' if external_available else 'python'
+
+
+def _mark_compressed(sound, stats, compressed_size):
+    sound.file.name = f"sounds/compressed/{sound.id}.wav"
+    stats['compressed'] = True
+    stats['compressed_size'] = compressed_size
+    if stats['original_size'] > 0 and compressed_size > 0:
+        stats['ratio'] = round(stats['original_size'] / compressed_size, 2)
+        stats['savings_percent'] = round(100 * (stats['original_size'] - compressed_size) / stats['original_size'], 1)
+
+
+def probe_duration(path):
+    """Duration in seconds according to mutagen, or None if it can't tell"""
+    import mutagen
+
+    try:
+        audio = mutagen.File(path)
+    except Exception as e:
+        logger.warning("Could not get audio duration for %s: %s", path, e)
+        return None
+    if audio and hasattr(audio, 'info') and hasattr(audio.info, 'length'):
+        return audio.info.length
+    return None
+
+
+def process_sound(sound_id):
+    """Background job: compress an uploaded sound, build its waveform and preview, probe its duration"""
+    from masshealth.models import Sound
+
+    # Claim the job so a sweep and the upload never process the same sound twice
+    claimed = Sound.objects.filter(
+        pk=sound_id, status=Sound.STATUS_PENDING
+    ).update(status=Sound.STATUS_PROCESSING, updated_at=timezone.now())
+    if not claimed:
+        return
+
+    sound = Sound.objects.get(pk=sound_id)
+    try:
+        sound.compression = compress_sound(sound)
+        decoded = build_sound_assets(sound, settings.MEDIA_ROOT)
+        duration = probe_duration(sound.file.path)
+        if duration is None and decoded is not None:
+            samples, sample_rate = decoded
+            duration = len(samples) / sample_rate
+        if duration is not None:
+            sound.duration = duration
+        sound.status = Sound.STATUS_READY
+        sound.error = ''
+    except Exception as e:
+        logger.exception("Processing sound %s failed", sound_id)
+        sound.status = Sound.STATUS_FAILED
+        sound.error = f'Pipeline error: {str(e)[:200]}'
+    sound.processed_at = timezone.now()
+    sound.save(update_fields=[
+        'file', 'compression', 'peaks', 'preview', 'duration', 'status', 'error', 'processed_at', 'updated_at'
+    ])
+
+
+def enqueue_sound_processing(sound):
+    """Queue processing after the surrounding transaction commits"""
+    background_jobs.submit_on_commit(process_sound, sound.pk)
+
+
+def stale_pending_sounds(older_than_minutes=10):
+    """
+    Ids of sounds stuck in pending (the queue was full or the process
+    restarted). Sounds left processing by a worker that died are reset first.
+    """
+    from masshealth.models import Sound
+
+    cutoff = timezone.now() - timedelta(minutes=older_than_minutes)
+    Sound.objects.filter(
+        status=Sound.STATUS_PROCESSING,
+        updated_at__lt=cutoff - timedelta(seconds=MDCT_TIMEOUT_SECONDS),
+    ).update(status=Sound.STATUS_PENDING)
+    return list(
+        Sound.objects.filter(status=Sound.STATUS_PENDING, updated_at__lt=cutoff).values_list('pk', flat=True)
+    )
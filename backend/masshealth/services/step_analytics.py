@@ -0,0 +1,201 @@
+"""
+Server-side step detection over stored accelerometer chunks.
+
+Same algorithm as StepCounter_Update in the wearable firmware
+(extras/Core/Src/main.c), applied to whole arrays instead of one sample
+per tick:
+
+    magnitude = sqrt(x^2 + y^2 + z^2)
+    filtered  = 0.8 * filtered + 0.2 * magnitude        (one-pole low-pass)
+    step      = filtered crosses STEP_THRESHOLD upwards,
+                more than REFRACTORY_MS after the previous step
+
+The filter runs through scipy.signal.lfilter when SciPy is installed and
+otherwise as a convolution with the filter's impulse response truncated
+where it falls below float precision. Derived per-minute cadence gives
+active minutes and intensity zones per device and day (DailyActivity).
+Bump ALGORITHM_VERSION when anything here changes results;
+recompute_activity reprocesses every day analysed with an older version.
+"""
+from collections import defaultdict
+from datetime import datetime, time as dt_time, timedelta
+
+import numpy as np
+from django.db import transaction
+from django.utils import timezone
+
+from .sensor_store import decode_chunk, read_range
+
+try:
+    from scipy.signal import lfilter
+except ImportError:  # optional, the NumPy path gives the same result
+    lfilter = None
+
+ALGORITHM_VERSION = 1
+
+FILTER_ALPHA = 0.8
+STEP_THRESHOLD = 1200.0
+REFRACTORY_MS = 250
+
+# Samples before a range that are replayed so the filter and refractory
+# period are in the same state as in a continuous run
+WARMUP_MS = 2000
+
+# Steps per minute at which a minute enters each zone (Tudor-Locke cadence bands)
+INTENSITY_ZONES = (
+    ('sedentary', 0),
+    ('light', 20),
+    ('moderate', 100),
+    ('vigorous', 130),
+)
+ACTIVE_CADENCE = 100
+
+# 0.8 ** 128 < 1e-12: beyond this the impulse response is below float noise
+_IMPULSE = (1 - FILTER_ALPHA) * FILTER_ALPHA ** np.arange(128)
+
+
+def magnitude(xyz):
+    squared = xyz.astype(np.int32)
+    return np.sqrt((squared * squared).sum(axis=1), dtype=np.float64)
+
+
+def low_pass(values, initial=0.0):
+    """filtered[n] = 0.8 * filtered[n-1] + 0.2 * values[n], starting from `initial`"""
+    if lfilter is not None:
+        filtered, _ = lfilter([1 - FILTER_ALPHA], [1.0, -FILTER_ALPHA], values, zi=[FILTER_ALPHA * initial])
+        return filtered
+    filtered = np.convolve(values, _IMPULSE)[:len(values)]
+    if initial:
+        filtered += initial * FILTER_ALPHA ** np.arange(1, len(values) + 1)
+    return filtered
+
+
+def detect_steps(timestamps, filtered, previous=0.0, last_step_ms=None):
+    """Timestamps of accepted steps: rising threshold crossings outside the refractory period"""
+    above = filtered > STEP_THRESHOLD
+    before = np.concatenate(([previous > STEP_THRESHOLD], above[:-1]))
+    candidates = timestamps[above & ~before]
+    if not len(candidates):
+        return candidates
+
+    gaps = np.diff(candidates, prepend=-np.inf if last_step_ms is None else last_step_ms)
+    if np.all(gaps > REFRACTORY_MS):
+        return candidates
+
+    # Crossings are sparse (a few per second at most), so only they are walked
+    accepted = []
+    last = -np.inf if last_step_ms is None else last_step_ms
+    for candidate in candidates:
+        if candidate - last > REFRACTORY_MS:
+            accepted.append(candidate)
+            last = candidate
+    return np.asarray(accepted, dtype=np.int64)
+
+
+def analyze(timestamps, xyz, initial=0.0, last_step_ms=None):
+    """Step timestamps for one continuous, time-ordered stretch of samples"""
+    if not len(timestamps):
+        return np.empty(0, dtype=np.int64)
+    filtered = low_pass(magnitude(xyz), initial)
+    return detect_steps(timestamps, filtered, initial, last_step_ms)
+
+
+def minute_metrics(step_times, sample_times):
+    """Cadence per minute that has samples, then zone minutes, active minutes and peak cadence"""
+    if not len(sample_times):
+        return {'active_minutes': 0, 'zone_minutes': {name: 0 for name, _ in INTENSITY_ZONES}, 'peak_cadence': 0}
+
+    first_minute = sample_times[0] // 60000
+    minutes = np.unique(sample_times // 60000 - first_minute)
+    cadence = np.bincount(step_times // 60000 - first_minute, minlength=int(minutes[-1]) + 1)[minutes]
+
+    bounds = np.array([lower for _, lower in INTENSITY_ZONES])
+    zones = np.searchsorted(bounds, cadence, side='right') - 1
+    counts = np.bincount(zones, minlength=len(INTENSITY_ZONES))
+    return {
+        'active_minutes': int(np.count_nonzero(cadence >= ACTIVE_CADENCE)),
+        'zone_minutes': {name: int(count) for (name, _), count in zip(INTENSITY_ZONES, counts)},
+        'peak_cadence': int(cadence.max()),
+    }
+
+
+def _day_bounds_ms(day):
+    start = timezone.make_aware(datetime.combine(day, dt_time.min))
+    return int(start.timestamp() * 1000), int((start + timedelta(days=1)).timestamp() * 1000)
+
+
+def analyze_day(device_id, day):
+    """
+    Recompute steps for every chunk of a device on a day and its
+    DailyActivity row. Returns the DailyActivity, or None without data.
+    """
+    from masshealth.models import DailyActivity, SensorChunk
+
+    chunks = list(
+        SensorChunk.objects
+        .filter(device_id=device_id, day=day)
+        .order_by('start_ms')
+        .only('id', 'user_id', 'start_ms', 'data')
+    )
+    if not chunks:
+        return None
+
+    decoded = [decode_chunk(chunk.data, chunk.start_ms) for chunk in chunks]
+    timestamps = np.concatenate([t for t, _ in decoded])
+    xyz = np.concatenate([samples for _, samples in decoded])
+    if np.any(np.diff(timestamps) < 0):
+        order = np.argsort(timestamps, kind='stable')
+        timestamps, xyz = timestamps[order], xyz[order]
+
+    # Replay the tail of the previous day so the first steps match a continuous run
+    day_start, _ = _day_bounds_ms(day)
+    warm_times, warm_xyz = read_range(device_id, day_start - WARMUP_MS, day_start - 1)
+    warm_steps = analyze(warm_times, warm_xyz)
+    initial = low_pass(magnitude(warm_xyz))[-1] if len(warm_times) else 0.0
+    last_step = int(warm_steps[-1]) if len(warm_steps) else None
+    step_times = analyze(timestamps, xyz, initial, last_step)
+
+    # Each step belongs to the latest chunk starting at or before it
+    starts = np.array([chunk.start_ms for chunk in chunks], dtype=np.int64)
+    per_chunk = np.bincount(
+        np.maximum(np.searchsorted(starts, step_times, side='right') - 1, 0),
+        minlength=len(chunks),
+    )
+    for chunk, steps in zip(chunks, per_chunk):
+        chunk.steps = int(steps)
+        chunk.analysis_version = ALGORITHM_VERSION
+
+    metrics = minute_metrics(step_times, timestamps)
+    user_id = next((chunk.user_id for chunk in chunks if chunk.user_id), None)
+    with transaction.atomic():
+        SensorChunk.objects.bulk_update(chunks, ['steps', 'analysis_version'], batch_size=500)
+        activity, _ = DailyActivity.objects.update_or_create(
+            device_id=device_id,
+            day=day,
+            defaults={
+                'user_id': user_id,
+                'steps': len(step_times),
+                'samples': len(timestamps),
+                'algorithm_version': ALGORITHM_VERSION,
+                **metrics,
+            },
+        )
+    return activity
+
+
+def stale_days(all_days=False, since=None, device_id=None):
+    """(device_id, day) pairs whose chunks were never analysed or used an older algorithm"""
+    from masshealth.models import SensorChunk
+
+    chunks = SensorChunk.objects.all()
+    if not all_days:
+        chunks = chunks.exclude(analysis_version=ALGORITHM_VERSION)
+    if since is not None:
+        chunks = chunks.filter(day__gte=since)
+    if device_id is not None:
+        chunks = chunks.filter(device_id=device_id)
+
+    pairs = defaultdict(set)
+    for device, day in chunks.order_by().values_list('device_id', 'day').distinct():
+        pairs[device].add(day)
+    return [(device, day) for device in sorted(pairs) for day in sorted(pairs[device])]
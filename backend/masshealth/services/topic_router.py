@@ -0,0 +1,196 @@
+"""
+MQTT topic routing.
+
+Handlers register topic patterns using MQTT wildcards, with optional
+named captures in place of '+':
+
+    users/{user_id:int}/location     one level, converted to int
+    gyrosensor/{device_id}/data      one level, kept as a string
+    sensors/#                        any remaining levels
+
+Patterns compile into a trie keyed by topic level, so matching costs one
+dict lookup per level regardless of how many routes exist. Literal levels
+win over captures, and captures over '#'. A capture whose converter
+rejects the level (a non-numeric user id) does not match.
+
+A route may also take a binary codec (services.payload_codecs); its
+messages are then decoded as that codec or JSON, see payload_codecs.decode.
+Handlers are called as handler(topic, payload, **captures). Per route,
+mqtt.messages, mqtt.errors and the mqtt.handler_ms histogram are kept in
+services.metrics (admin metrics endpoint, ?prefix=mqtt.); topics nothing
+matches are counted and logged as mqtt.unrouted.
+"""
+import logging
+import re
+import time
+
+from .log_events import log_event
+from .metrics import registry
+from .payload_codecs import decode
+
+logger = logging.getLogger(__name__)
+
+CONVERTERS = {
+    'str': str,
+    'int': int,
+}
+
+_CAPTURE = re.compile(r'^\{(\w+)(?::(\w+))?\}$')
+
+
+class TopicPatternError(ValueError):
+    """Raised for patterns that are not valid MQTT topic filters"""
+    pass
+
+
+def topic_matches(topic_filter, topic):
+    """Whether a topic matches a plain MQTT filter ('+' and '#' wildcards)"""
+    filter_levels = topic_filter.split('/')
+    levels = topic.split('/')
+    for index, level in enumerate(filter_levels):
+        if level == '#':
+            return True
+        if index >= len(levels) or (level != '+' and level != levels[index]):
+            return False
+    return len(levels) == len(filter_levels)
+
+
+class Route:
+    def __init__(self, pattern, handler, name, captures, codec=None):
+        self.pattern = pattern
+        self.handler = handler
+        self.name = name
+        self.codec = codec
+        self.captures = captures  # [(level index, name, converter)]
+        self.subscription = '/'.join(
+            '+' if _CAPTURE.match(level) else level for level in pattern.split('/')
+        )
+
+    def decode(self, raw, content_type=None):
+        try:
+            return decode(raw, self.codec, content_type)
+        except ValueError:
+            registry.counter('mqtt.errors', self.name).inc()
+            raise
+
+    def __call__(self, topic, payload, params):
+        # Looked up per call so an admin metrics reset does not orphan them
+        registry.counter('mqtt.messages', self.name).inc()
+        started = time.perf_counter()
+        try:
+            return self.handler(topic, payload, **params)
+        except Exception:
+            registry.counter('mqtt.errors', self.name).inc()
+            raise
+        finally:
+            registry.histogram('mqtt.handler_ms', self.name).observe((time.perf_counter() - started) * 1000)
+
+    def __repr__(self):
+        return f'<Route {self.name}: {self.pattern}>'
+
+
+class _Node:
+    __slots__ = ('children', 'capture', 'multi', 'route')
+
+    def __init__(self):
+        self.children = {}
+        self.capture = None  # child node for '+' / {name} levels
+        self.multi = None  # route registered with a trailing '#'
+        self.route = None
+
+
+class TopicRouter:
+    def __init__(self):
+        self.routes = []
+        self._root = _Node()
+
+    def add(self, pattern, handler, name=None, codec=None):
+        levels = pattern.split('/')
+        captures = []
+        node = self._root
+        for index, level in enumerate(levels):
+            if level == '#':
+                if index != len(levels) - 1:
+                    raise TopicPatternError(f"'#' must be the last level in {pattern!r}")
+                break
+            capture = _CAPTURE.match(level)
+            if capture or level == '+':
+                if capture:
+                    converter = capture.group(2) or 'str'
+                    if converter not in CONVERTERS:
+                        raise TopicPatternError(f'Unknown converter {converter!r} in {pattern!r}')
+                    captures.append((index, capture.group(1), CONVERTERS[converter]))
+                node.capture = node.capture or _Node()
+                node = node.capture
+            elif '+' in level or '#' in level or '{' in level:
+                raise TopicPatternError(f'Invalid level {level!r} in {pattern!r}')
+            else:
+                node = node.children.setdefault(level, _Node())
+
+        route = Route(pattern, handler, name or handler.__name__, captures, codec)
+        if levels[-1] == '#':
+            if node.multi is not None:
+                raise TopicPatternError(f'{pattern!r} is already routed to {node.multi.name}')
+            node.multi = route
+        else:
+            if node.route is not None:
+                raise TopicPatternError(f'{pattern!r} is already routed to {node.route.name}')
+            node.route = route
+        self.routes.append(route)
+        return route
+
+    def route(self, pattern, name=None, codec=None):
+        """Decorator form of add()"""
+        def decorator(handler):
+            self.add(pattern, handler, name, codec)
+            return handler
+        return decorator
+
+    @property
+    def subscriptions(self):
+        return tuple(route.subscription for route in self.routes)
+
+    def match(self, topic):
+        """(route, captured params) for a topic, or (None, None)"""
+        levels = topic.split('/')
+        route = self._walk(self._root, levels, 0)
+        if route is None:
+            registry.counter('mqtt.unrouted').inc()
+            log_event(logger, logging.WARNING, 'mqtt.unrouted', topic=topic)
+            return None, None
+        params = {}
+        for index, name, converter in route.captures:
+            params[name] = converter(levels[index])
+        return route, params
+
+    def _walk(self, node, levels, depth):
+        if depth == len(levels):
+            return node.route or node.multi
+        level = levels[depth]
+        child = node.children.get(level)
+        if child is not None:
+            found = self._walk(child, levels, depth + 1)
+            if found is not None and self._converts(found, levels):
+                return found
+        if node.capture is not None and level:
+            found = self._walk(node.capture, levels, depth + 1)
+            if found is not None and self._converts(found, levels):
+                return found
+        return node.multi
+
+    @staticmethod
+    def _converts(route, levels):
+        for index, _, converter in route.captures:
+            try:
+                converter(levels[index])
+            except ValueError:
+                return False
+        return True
+
+    def dispatch(self, topic, raw, content_type=None):
+        """Decode a raw message and run the matching handler; False when no route matches"""
+        route, params = self.match(topic)
+        if route is None:
+            return False
+        route(topic, route.decode(raw, content_type), params)
+        return True
@@ -0,0 +1,67 @@
+from contextlib import contextmanager
+
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .models import Challenge, ConditionOrInjury, CustomUser, FitnessGoal, MuscleGroup, Routine, Workout
+from .services import daily_stats
+from .services.catalog_cache import bump_catalog_version
+from .services.location_fanout import friends_changed, user_deleted
+from .services.rivalry import challenge_deleted, challenge_saved
+
+# Any change to reference data invalidates the cached catalog responses
+for catalog_model in (Workout, MuscleGroup, FitnessGoal, ConditionOrInjury):
+    post_save.connect(bump_catalog_version, sender=catalog_model, dispatch_uid=f'catalog_save_{catalog_model.__name__}')
+    post_delete.connect(bump_catalog_version, sender=catalog_model, dispatch_uid=f'catalog_delete_{catalog_model.__name__}')
+
+
+# Daily dashboard counters: model -> (counter on create, counter on delete).
+# Location pings are too frequent for a per-row UPDATE; the nightly rebuild counts them.
+DAILY_STAT_COUNTERS = {
+    CustomUser: ('signups', 'users_deleted'),
+    Routine: ('routines_created', 'routines_deleted'),
+    Challenge: ('challenges_created', None),
+}
+
+
+def count_created(sender, created, raw=False, **kwargs):
+    if created and not raw:
+        daily_stats.increment(DAILY_STAT_COUNTERS[sender][0])
+
+
+def count_deleted(sender, **kwargs):
+    daily_stats.increment(DAILY_STAT_COUNTERS[sender][1])
+
+
+def connect_daily_stats():
+    for stat_model, (created_field, deleted_field) in DAILY_STAT_COUNTERS.items():
+        post_save.connect(count_created, sender=stat_model, dispatch_uid=f'daily_stats_save_{stat_model.__name__}')
+        if deleted_field:
+            post_delete.connect(count_deleted, sender=stat_model, dispatch_uid=f'daily_stats_delete_{stat_model.__name__}')
+
+
+@contextmanager
+def daily_stats_paused():
+    """
+    Do not count saves and deletes, e.g. while removing rows that were
+    bulk_created (and so never counted as created)
+    """
+    for stat_model in DAILY_STAT_COUNTERS:
+        post_save.disconnect(sender=stat_model, dispatch_uid=f'daily_stats_save_{stat_model.__name__}')
+        post_delete.disconnect(sender=stat_model, dispatch_uid=f'daily_stats_delete_{stat_model.__name__}')
+    try:
+        yield
+    finally:
+        connect_daily_stats()
+
+
+connect_daily_stats()
+
+
+# Live leaderboards re-read a challenge once its status or participants change
+post_save.connect(challenge_saved, sender=Challenge, dispatch_uid='rivalry_challenge_save')
+post_delete.connect(challenge_deleted, sender=Challenge, dispatch_uid='rivalry_challenge_delete')
+
+
+# Friend location fan-out caches who follows whom
+m2m_changed.connect(friends_changed, sender=CustomUser.friends.through, dispatch_uid='location_fanout_friends')
+post_delete.connect(user_deleted, sender=CustomUser, dispatch_uid='location_fanout_user_delete')
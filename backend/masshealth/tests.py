@@ -1,3 +1,599 @@
-from django.test import TestCase
+import datetime
+import io
+import json
+import os
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.utils import timezone
+
+from .api.services.routine_editor import RoutineEditError, apply_operations, close_gap
+from .models import (
+    Challenge, ChallengeScore, DailyStat, MuscleGroup, Routine, RoutineWorkout, SensorChunk, UserLocation,
+    Workout,
+)
+from .services import daily_stats, image_renditions, location_fanout, mdct, step_analytics
+from .services.mqtt_outbox import Outbox
+from .services.metrics import registry
+from .services.rivalry import Leaderboard, RivalryEngine, RivalryUpdateError
+from .services.sensor_store import SensorBuffer, SensorPayloadError, encode_chunk, parse_payload
+from .services.sound_assets import _parse_range
+from .services.payload_codecs import (
+    LOCATION, SENSOR_BATCH, PayloadError, decode, encode_location, encode_sensor_batch,
+)
+from .services.topic_router import TopicPatternError, TopicRouter, topic_matches
+from .signals import daily_stats_paused
+
+CustomUser = get_user_model()
+
+
+class MDCTParityTests(SimpleTestCase):
+    # 16 stereo frames with clipped extremes, and the interleaved output and
+    # encoded size of the blockSplit..overlapAdd pipeline in backend/mdct.cpp
+    # for N=4, M=1 (built without libsndfile)
+    LEFT = [0, 1200, -3400, 5600, 32000, -32768, 17, -5, 900, 4400, -2100, 300, 12000, -700, 50, 8]
+    RIGHT = [10, -1200, 3300, 5000, -31000, 30000, 0, 5, -900, 4000, 2100, -300, 11000, 700, -50, 9]
+    REFERENCE = [
+        (-1410, 1729), (5284, -7296), (-9374, 12491), (11575, -4190),
+        (26106, -23026), (-25278, 21970), (-8603, 8069), (8615, -8064),
+        (-5591, 4859), (6938, 3655), (-1843, -1385), (42, 3184),
+        (11144, 9386), (141, 1517), (-781, -303), (839, 262),
+    ]
+    REFERENCE_ENCODED_SIZE = 72
+
+    def samples(self):
+        return np.array([self.LEFT, self.RIGHT], dtype='<i2').T
+
+    def test_matches_reference_output(self):
+        reconstructed, stats = mdct.compress(self.samples(), N=4, M=1)
+        self.assertEqual([tuple(frame) for frame in reconstructed.tolist()], self.REFERENCE)
+        self.assertEqual(stats['encoded_size'], self.REFERENCE_ENCODED_SIZE)
+        self.assertEqual(stats['original_size'], 64)
+
+    def test_batch_size_does_not_change_output(self):
+        whole, _ = mdct.compress(self.samples(), N=4, M=1)
+        for batch_blocks in (1, 2, 3):
+            batched, stats = mdct.compress(self.samples(), N=4, M=1, batch_blocks=batch_blocks)
+            np.testing.assert_array_equal(batched, whole)
+            self.assertEqual(stats['encoded_size'], self.REFERENCE_ENCODED_SIZE)
+
+    def test_wav_round_trip(self):
+        output, _ = mdct.compress_wav(self.wav_bytes(), N=4, M=1)
+        samples, sample_rate = mdct.read_wav(output)
+        self.assertEqual(sample_rate, 8000)
+        self.assertEqual([tuple(frame) for frame in samples.tolist()], self.REFERENCE)
+
+    def test_rejects_invalid_parameters(self):
+        with self.assertRaises(mdct.MDCTError):
+            mdct.compress(self.samples(), N=4, M=4)
+
+    def wav_bytes(self):
+        buffer = io.BytesIO()
+        mdct.write_wav(buffer, self.samples(), 8000)
+        return buffer.getvalue()
+
+
+class TopicRouterTests(SimpleTestCase):
+    def setUp(self):
+        self.router = TopicRouter()
+        self.calls = []
+
+    def handler(self, name):
+        def handle(topic, payload, **params):
+            self.calls.append((name, topic, payload, params))
+        handle.__name__ = name
+        return handle
+
+    def test_captures_are_converted(self):
+        self.router.add('users/{user_id:int}/location', self.handler('location'))
+        route, params = self.router.match('users/42/location')
+        self.assertEqual(route.name, 'location')
+        self.assertEqual(params, {'user_id': 42})
+        self.assertEqual(route.subscription, 'users/+/location')
+
+    def test_rejected_conversion_does_not_match(self):
+        self.router.add('users/{user_id:int}/location', self.handler('location'))
+        self.assertEqual(self.router.match('users/abc/location'), (None, None))
+
+    def test_literal_beats_capture_beats_multi_level(self):
+        self.router.add('sensors/#', self.handler('any'))
+        self.router.add('sensors/{device}/data', self.handler('device'))
+        self.router.add('sensors/hub/data', self.handler('hub'))
+        self.assertEqual(self.router.match('sensors/hub/data')[0].name, 'hub')
+        self.assertEqual(self.router.match('sensors/d1/data')[0].name, 'device')
+        self.assertEqual(self.router.match('sensors/d1/raw/x')[0].name, 'any')
+
+    def test_duplicate_and_invalid_patterns(self):
+        self.router.add('a/+/b', self.handler('first'))
+        with self.assertRaises(TopicPatternError):
+            self.router.add('a/{x}/b', self.handler('second'))
+        with self.assertRaises(TopicPatternError):
+            self.router.add('a/#/b', self.handler('bad'))
+        with self.assertRaises(TopicPatternError):
+            self.router.add('a/{x:float}', self.handler('bad'))
+
+    def test_dispatch_decodes_json(self):
+        self.router.add('users/{user_id:int}/status', self.handler('status'))
+        self.assertTrue(self.router.dispatch('users/7/status', b'{"online": true}'))
+        self.assertFalse(self.router.dispatch('nobody/listens', b'{}'))
+        self.assertEqual(self.calls, [('status', 'users/7/status', {'online': True}, {'user_id': 7})])
+
+    def test_topic_matches(self):
+        self.assertTrue(topic_matches('friends/+/locations', 'friends/3/locations'))
+        self.assertTrue(topic_matches('a/#', 'a/b/c'))
+        self.assertFalse(topic_matches('friends/+/locations', 'friends/3/locations/x'))
+        self.assertFalse(topic_matches('a/+', 'b/c'))
+
+
+class PayloadCodecTests(SimpleTestCase):
+    def test_location_round_trip(self):
+        frame = encode_location(46.0569465, 14.5057515, accuracy=12.3)
+        self.assertEqual(len(frame), 11)
+        self.assertEqual(decode(frame, LOCATION), {'latitude': 46.0569465, 'longitude': 14.5057515, 'accuracy': 12.3})
+        self.assertIsNone(decode(encode_location(1.5, -2.5), LOCATION)['accuracy'])
+
+    def test_sensor_batch_round_trip(self):
+        xyz = np.array([[1, -2, 3], [-32768, 32767, 0]], dtype='<i2')
+        payload = decode(encode_sensor_batch(1700000000000, 50, xyz, steps=4), SENSOR_BATCH)
+        self.assertEqual((payload['ts'], payload['rate'], payload['steps']), (1700000000000, 50, 4))
+        np.testing.assert_array_equal(payload['samples'], xyz)
+        self.assertNotIn('steps', decode(encode_sensor_batch(0, 50, xyz), SENSOR_BATCH))
+
+    def test_json_still_accepted(self):
+        self.assertEqual(decode(b'{"latitude": 1}', LOCATION), {'latitude': 1})
+        self.assertEqual(decode(b'{"ts": 1}', SENSOR_BATCH, content_type='application/json'), {'ts': 1})
+
+    def test_malformed_frames(self):
+        frame = encode_sensor_batch(0, 50, np.zeros((2, 3)))
+        with self.assertRaises(PayloadError):
+            decode(frame[:-1], SENSOR_BATCH)
+        with self.assertRaises(PayloadError):
+            decode(encode_location(1, 2)[:5], LOCATION)
+        with self.assertRaises(PayloadError):
+            decode(b'{"x": 1}', LOCATION, content_type='text/plain')
+
+
+class OutboxTests(SimpleTestCase):
+    def setUp(self):
+        self.spool_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.spool_dir.cleanup)
+        self.spool_path = os.path.join(self.spool_dir.name, 'outbox.spool')
+
+    def make_outbox(self, **config):
+        return Outbox(config={'MAX_QUEUED': 10, 'SPOOL_PATH': self.spool_path, **config})
+
+    def restart(self, **config):
+        """A new process that connects and takes over earlier spools"""
+        outbox = self.make_outbox(**config)
+        outbox._adopt_spools()
+        return outbox
+
+    def crash(self, outbox):
+        """The process dies: its spool files stay behind, unlocked"""
+        for spool in outbox._spool_files:
+            spool.handle.close()
+
+    def queued(self, outbox):
+        return [tuple(message) for message in outbox._queue.values()]
+
+    def pending(self, outbox):
+        """Everything waiting to be sent, in send order"""
+        return [tuple(message) for message in outbox._backlog] + self.queued(outbox)
+
+    def spooled_topics(self, outbox):
+        with open(outbox._own_spool.path) as spool:
+            return [json.loads(line)[0] for line in spool]
+
+    def test_coalesces_while_queued(self):
+        outbox = self.make_outbox()
+        outbox.put('friends/1/locations', {'locations': [{'user_id': 1, 'lat': 1}]})
+        outbox.put('friends/1/locations', {'locations': [{'user_id': 2, 'lat': 2}]})
+        outbox.put('friends/1/locations', {'locations': [{'user_id': 1, 'lat': 3}]})
+        outbox.put('users/5/status', {'online': True})
+        outbox.put('users/5/status', {'online': False})
+        outbox.put('other/topic', {'n': 1})
+        outbox.put('other/topic', {'n': 2})
+        self.assertEqual(self.queued(outbox), [
+            ('friends/1/locations', {'locations': [{'user_id': 1, 'lat': 3}, {'user_id': 2, 'lat': 2}]}),
+            ('users/5/status', {'online': False}),
+            ('other/topic', {'n': 1}),
+            ('other/topic', {'n': 2}),
+        ])
+
+    def test_requeued_message_merges_as_older(self):
+        outbox = self.make_outbox()
+        outbox.put('rivalries/1/leaderboard', {'changes': [{'user_id': 1, 'steps': 20}]})
+        with outbox._cond:
+            outbox._enqueue('rivalries/1/leaderboard', {'changes': [{'user_id': 1, 'steps': 10}]}, front=True)
+        self.assertEqual(self.queued(outbox), [('rivalries/1/leaderboard', {'changes': [{'user_id': 1, 'steps': 20}]})])
+
+    def test_full_queue_spools_the_oldest(self):
+        outbox = self.make_outbox(MAX_QUEUED=2)
+        for n in range(4):
+            outbox.put(f'topic/{n}', {'n': n})
+        self.assertEqual([topic for topic, _ in self.queued(outbox)], ['topic/2', 'topic/3'])
+        self.assertEqual(self.spooled_topics(outbox), ['topic/0', 'topic/1'])
+
+        # A new process picks the spool up again, ahead of anything queued
+        self.crash(outbox)
+        restarted = self.restart(MAX_QUEUED=20)
+        self.assertEqual(restarted._spooled, 2)
+        restarted.put('topic/4', {'n': 4})
+        restarted._replay_spool()
+        self.assertEqual([topic for topic, _ in self.pending(restarted)], ['topic/0', 'topic/1', 'topic/4'])
+        self.assertEqual(restarted._spooled, 0)
+        self.assertEqual(os.listdir(self.spool_dir.name), [])
+
+    def test_replay_reads_on_without_rewriting(self):
+        outbox = self.make_outbox(MAX_QUEUED=10)
+        for n in range(25):
+            outbox.put(f'topic/{n}', {'n': n})
+        size = os.path.getsize(outbox._own_spool.path)
+        outbox._replay_spool()
+        self.assertEqual([topic for topic, _ in outbox._backlog], ['topic/0'])
+        self.assertEqual(os.path.getsize(outbox._own_spool.path), size)
+        self.assertEqual(outbox._spooled, 14)
+
+    def test_live_process_keeps_its_spool(self):
+        outbox = self.make_outbox(MAX_QUEUED=1)
+        outbox.put('topic/0', {})
+        outbox.put('topic/1', {})
+        other = self.restart(MAX_QUEUED=1)
+        other.put('topic/2', {})
+        other.put('topic/3', {})
+        self.assertEqual((outbox._spooled, other._spooled), (1, 1))
+        self.assertEqual(self.spooled_topics(outbox), ['topic/0'])
+        self.assertEqual(self.spooled_topics(other), ['topic/2'])
+
+    def test_replayed_message_merges_as_older(self):
+        outbox = self.make_outbox(MAX_QUEUED=1)
+        outbox.put('friends/3/locations', {'locations': [{'user_id': 1, 'lat': 'old'}]})
+        outbox.put('other/topic', {})  # pushes the location out to the spool
+        self.crash(outbox)
+
+        restarted = self.restart()
+        restarted.put('friends/3/locations', {'locations': [{'user_id': 1, 'lat': 'new'}]})
+        restarted._replay_spool()
+        self.assertEqual(self.pending(restarted), [('friends/3/locations', {'locations': [{'user_id': 1, 'lat': 'new'}]})])
+
+    def test_restart_discards_leaderboard_deltas(self):
+        with open(self.spool_path + '.1.1', 'w') as spool:
+            spool.write(json.dumps(['rivalries/1/leaderboard', {'version': 57, 'changes': []}]) + '\n')
+            spool.write(json.dumps(['friends/1/locations', {'locations': []}]) + '\n')
+            spool.write('["cut short\n')
+        outbox = self.restart()
+        self.assertEqual(outbox._spooled, 1)
+        outbox._replay_spool()
+        self.assertEqual(self.pending(outbox), [('friends/1/locations', {'locations': []})])
+
+    def test_close_spools_unsent_messages(self):
+        outbox = self.make_outbox(MAX_QUEUED=1)
+        outbox.put('topic/0', {})
+        outbox.put('topic/1', {})  # topic/0 to the spool
+        with outbox._cond:
+            outbox._enqueue('topic/old', {}, front=True)
+        outbox.close(timeout=0)
+        restarted = self.restart(MAX_QUEUED=30)
+        restarted._replay_spool()
+        self.assertEqual([topic for topic, _ in self.pending(restarted)], ['topic/old', 'topic/0', 'topic/1'])
+
+
+@override_settings(SYNC_TO_SUPABASE=False)
+class DailyStatCounterTests(TestCase):
+    def today(self):
+        return DailyStat.objects.get(date=timezone.localdate())
+
+    def test_signals_count_users_and_routines(self):
+        user = CustomUser.objects.create_user(email='a@example.com', password='x', full_name='A')
+        other = CustomUser.objects.create_user(email='b@example.com', password='x', full_name='B')
+        routine = Routine.objects.create(name='Legs', user=user)
+        routine.save()  # updates are not counted
+        other.delete()
+
+        stat = self.today()
+        self.assertEqual((stat.signups, stat.users_deleted, stat.routines_created), (2, 1, 1))
+        self.assertEqual(daily_stats.get_totals(), {'users': 1, 'routines': 1})
+
+    def test_record_login_counts_first_login_of_the_day_once(self):
+        user = CustomUser.objects.create_user(email='a@example.com', password='x', full_name='A')
+        daily_stats.record_login(user)
+        user.last_login = timezone.now()
+        daily_stats.record_login(user)
+        stat = self.today()
+        self.assertEqual((stat.logins, stat.active_users), (2, 1))
+
+    def test_rebuild_counts_locations_and_resets_deletions(self):
+        user = CustomUser.objects.create_user(email='a@example.com', password='x', full_name='A')
+        CustomUser.objects.create_user(email='b@example.com', password='x', full_name='B').delete()
+        UserLocation.objects.create(user=user, latitude=1, longitude=2)
+        self.assertEqual(self.today().locations_ingested, 0)
+
+        daily_stats.rebuild_daily_stats()
+        stat = self.today()
+        self.assertEqual((stat.signups, stat.users_deleted, stat.locations_ingested), (1, 0, 1))
+        self.assertEqual(daily_stats.get_totals()['users'], 1)
+
+    def test_paused_counters_skip_bulk_created_users(self):
+        CustomUser.objects.create_user(email='a@example.com', password='x', full_name='A')
+        CustomUser.objects.bulk_create([CustomUser(email=f'load-{i}@example.com', full_name='L') for i in range(3)])
+        with daily_stats_paused():
+            CustomUser.objects.filter(email__startswith='load-').delete()
+        CustomUser.objects.create_user(email='b@example.com', password='x', full_name='B').delete()
+
+        stat = self.today()
+        self.assertEqual((stat.signups, stat.users_deleted), (2, 1))
+        self.assertEqual(daily_stats.get_totals()['users'], 1)
+
+
+class LeaderboardTests(SimpleTestCase):
+    def test_ties_go_to_whoever_got_there_first(self):
+        board = Leaderboard(1, [1, 2, 3])
+        board.set_score(2, 50)
+        board.set_score(1, 50)
+        board.set_score(3, 10)
+        self.assertEqual([(entry['user_id'], entry['rank']) for entry in board.standings()], [(2, 1), (1, 2), (3, 3)])
+        board.add(1, 1)
+        self.assertEqual((board.rank(1), board.rank(2)), (1, 2))
+        with self.assertRaises(RivalryUpdateError):
+            board.set_score(4, 1)
+
+    def test_delta_has_changed_scores_and_moved_ranks(self):
+        board = Leaderboard(7, [1, 2, 3], scores={1: 30, 2: 20, 3: 10})
+        self.assertIsNone(board.take_delta())
+        board.set_score(3, 25)  # 3 overtakes 2
+        delta = board.take_delta()
+        self.assertEqual((delta['challenge_id'], delta['version']), (7, 1))
+        self.assertEqual(delta['changes'], [
+            {'user_id': 3, 'score': 25, 'rank': 2},
+            {'user_id': 2, 'score': 20, 'rank': 3},
+        ])
+        self.assertFalse(board.set_score(1, 30))  # unchanged
+        self.assertIsNone(board.take_delta())
+
+
+@override_settings(SYNC_TO_SUPABASE=False)
+class RivalryEngineTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = CustomUser.objects.create_user(email='a@example.com', password='x', full_name='A')
+        self.bob = CustomUser.objects.create_user(email='b@example.com', password='x', full_name='B')
+        routine = Routine.objects.create(name='Legs', user=self.alice)
+        self.challenge = Challenge.objects.create(
+            from_user=self.alice, to_user=self.bob, routine=routine, status='accepted',
+        )
+        self.engine = RivalryEngine()
+        self.engine._ensure_ticker = lambda: None
+
+    def update(self, user, score):
+        return self.engine.handle_update(self.challenge.pk, {'user_id': user.pk, 'score': score})
+
+    def test_snapshot_persists_changed_scores(self):
+        self.assertTrue(self.update(self.alice, 12))
+        self.assertEqual(self.engine.snapshot(), 1)
+        self.assertEqual(self.engine.snapshot(), 0)
+        self.assertEqual(ChallengeScore.objects.get(user=self.alice).score, 12)
+
+    def test_challenge_completed_elsewhere_stops_taking_updates(self):
+        self.assertTrue(self.update(self.alice, 12))
+        # Another process: no signal reaches this engine
+        Challenge.objects.filter(pk=self.challenge.pk).update(status='completed')
+        self.assertTrue(self.update(self.alice, 13))  # still within the TTL
+        self.engine._boards[self.challenge.pk].checked_at -= self.engine.membership_ttl
+        self.assertFalse(self.update(self.alice, 14))
+        self.assertEqual(ChallengeScore.objects.get(user=self.alice).score, 13)
+
+    def test_deleted_challenge_does_not_block_snapshots(self):
+        routine = Routine.objects.create(name='Arms', user=self.bob)
+        other = Challenge.objects.create(from_user=self.bob, to_user=self.alice, routine=routine, status='accepted')
+        self.assertTrue(self.update(self.alice, 5))
+        self.assertTrue(self.engine.handle_update(other.pk, {'user_id': self.bob.pk, 'score': 8}))
+        Challenge.objects.filter(pk=self.challenge.pk).delete()
+
+        self.assertEqual(self.engine.snapshot(), 1)
+        self.assertEqual(list(ChallengeScore.objects.values_list('challenge_id', 'score')), [(other.pk, 8)])
+        self.assertNotIn(self.challenge.pk, self.engine._boards)
+
+
+@override_settings(SYNC_TO_SUPABASE=False)
+class ByteRangeTests(SimpleTestCase):
+    def test_parse_range(self):
+        for header, expected in (
+            ('bytes=0-99', (0, 99)),
+            ('bytes=90-200', (90, 99)),
+            ('bytes=-10', (90, 99)),
+            ('bytes=50-', (50, 99)),
+            ('bytes=50-10', None),
+            ('bytes=0-1,5-6', None),
+            ('bytes=100-', False),
+            ('bytes=150-10', None),
+            ('bytes=-0', False),
+        ):
+            with self.subTest(header=header):
+                self.assertEqual(_parse_range(header, 100), expected)
+
+
+class ImageRenditionsTests(TestCase):
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.name = image_renditions.content_name('ab' * 32, 'me.jpg')
+        self.path = os.path.join(media_root.name, self.name)
+        os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'jpeg')
+
+    def test_release_deletes_an_unreferenced_file(self):
+        image_renditions.release(self.name)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_release_keeps_a_file_leased_for_reuse(self):
+        self.assertTrue(image_renditions._lease(self.name))
+        image_renditions.release(self.name)
+        self.assertTrue(os.path.exists(self.path))
+
+
+class LocationFanoutTests(TestCase):
+    def setUp(self):
+        self.alice, self.bob, self.carol = (
+            CustomUser.objects.create_user(email=f'{name}@example.com', password='x', full_name=name)
+            for name in ('alice', 'bob', 'carol')
+        )
+        self.bob.friends.add(self.alice)
+        self.fanout = location_fanout.LocationFanout()
+        self.fanout._ensure_ticker = lambda: None
+        self.sent = []
+        self.fanout.publisher = lambda topic, payload: self.sent.append(
+            (topic, [position['latitude'] for position in payload['locations']])
+        )
+        patcher = mock.patch.object(location_fanout, 'location_fanout', self.fanout)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_coalesces_to_the_latest_position_per_interval(self):
+        interval = self.fanout.min_interval
+        self.fanout.record(self.alice.pk, 1.0, 1.0)
+        self.fanout.record(self.alice.pk, 2.0, 2.0)
+        self.assertEqual(self.fanout.flush(now=100), 1)
+        self.fanout.record(self.alice.pk, 3.0, 3.0)
+        self.assertEqual(self.fanout.flush(now=100 + interval / 2), 0)
+        self.assertEqual(self.fanout.flush(now=100 + interval), 1)
+        topic = f'friends/{self.bob.pk}/locations'
+        self.assertEqual(self.sent, [(topic, [2.0]), (topic, [3.0])])
+
+    def test_last_sent_only_keeps_senders_inside_their_interval(self):
+        self.fanout.record(self.alice.pk, 1.0, 1.0)
+        self.fanout.flush(now=100)
+        self.fanout.record(self.bob.pk, 1.0, 1.0)
+        self.fanout.flush(now=100 + self.fanout.min_interval)
+        self.assertEqual(set(self.fanout._last_sent), {self.bob.pk})
+
+    def test_friend_changes_invalidate_cached_followers(self):
+        self.fanout.record(self.alice.pk, 1.0, 1.0)
+        self.fanout.flush(now=100)
+        self.carol.friends.add(self.alice)
+        self.bob.friends.remove(self.alice)
+        self.fanout.record(self.alice.pk, 2.0, 2.0)
+        self.fanout.flush(now=200)
+        self.assertEqual(self.sent[-1], (f'friends/{self.carol.pk}/locations', [2.0]))
+        self.assertEqual(len(self.sent), 2)
+
+
+class RoutineEditorTests(TestCase):
+    def setUp(self):
+        user = CustomUser.objects.create_user(email='a@example.com', password='x', full_name='A')
+        self.routine = Routine.objects.create(name='Legs', user=user)
+        legs = MuscleGroup.objects.create(name='Legs')
+        self.squat, self.lunge = (
+            Workout.objects.create(name=name, video_url='https://example.com/v', muscle_group=legs)
+            for name in ('Squat', 'Lunge')
+        )
+
+    def add(self, *workouts):
+        # Highest order first, so the rows are not stored in order
+        for order, workout in reversed(list(enumerate(workouts, start=1))):
+            RoutineWorkout.objects.create(routine=self.routine, workout=workout, order=order)
+
+    def workouts(self):
+        return [
+            (rw.order, rw.workout.name)
+            for rw in RoutineWorkout.objects.filter(routine=self.routine).select_related('workout').order_by('order')
+        ]
+
+    def test_close_gap_with_a_repeated_workout(self):
+        self.add(self.lunge, self.squat, self.squat, self.squat)
+        with transaction.atomic():
+            RoutineWorkout.objects.get(routine=self.routine, order=1).delete()
+            close_gap(self.routine, 1)
+        self.assertEqual(self.workouts(), [(1, 'Squat'), (2, 'Squat'), (3, 'Squat')])
+
+    def test_apply_operations_reorders_moves_and_deletes_in_one_batch(self):
+        self.add(self.squat, self.lunge, self.squat)
+        with transaction.atomic():
+            apply_operations(self.routine, [
+                {'op': 'move', 'from': 3, 'to': 1},
+                {'op': 'remove', 'order': 2},
+                {'op': 'add', 'workout_id': self.lunge.pk, 'position': 1},
+                {'op': 'update', 'order': 3, 'rest_between_sets': 30},
+            ])
+        self.assertEqual(self.workouts(), [(1, 'Lunge'), (2, 'Squat'), (3, 'Lunge')])
+        self.assertEqual(RoutineWorkout.objects.get(routine=self.routine, order=3).rest_between_sets, 30)
+
+    def test_apply_operations_rolls_back_on_an_invalid_op(self):
+        self.add(self.squat, self.lunge)
+        for operations in (
+            [{'op': 'move', 'from': 1, 'to': 2}, {'op': 'remove', 'order': 5}],
+            [{'op': 'move', 'from': 1, 'to': 2}, {'op': 'jump'}],
+            [{'op': 'remove', 'order': 1}, {'op': 'update', 'order': 1, 'workout_mode': 'timer'}],
+        ):
+            with self.subTest(operations=operations), self.assertRaises(RoutineEditError):
+                with transaction.atomic():
+                    apply_operations(self.routine, operations)
+            self.assertEqual(self.workouts(), [(1, 'Squat'), (2, 'Lunge')])
+
+
+class SensorStoreTests(SimpleTestCase):
+    def test_malformed_payloads_are_payload_errors(self):
+        for payload in (
+            {'samples': [[1, 2, 3]], 'rate': 0},
+            {'samples': [[1, 2, 3], [4, 5]]},
+            {'samples': [[1, 2, 3]], 'ts': 'soon'},
+            {'samples': [[1, 2, 3]], 'steps': 'many'},
+            {'samples': [[1, 2, 3]], 'steps': -1},
+            {'x': 1, 'y': 'up', 'z': 3},
+            {'samples': [[1, 2, 3]], 'ts': float('nan')},
+        ):
+            with self.subTest(payload=payload), self.assertRaises(SensorPayloadError):
+                parse_payload(payload, 1_000)
+
+    def test_parses_a_batch(self):
+        timestamps, xyz, steps = parse_payload({'samples': [[1, 2, 3], [4, 5, 6]], 'rate': 50, 'ts': 0, 'steps': 3}, 1_000)
+        self.assertEqual((timestamps.tolist(), xyz.tolist(), steps), ([0, 20], [[1, 2, 3], [4, 5, 6]], 3))
+
+    @override_settings(SENSOR_STORE={'MAX_BUFFERED_SAMPLES': 10, 'WINDOW_SECONDS': 1})
+    def test_failing_writes_keep_the_newest_windows(self):
+        registry.reset()
+        buffer = SensorBuffer()
+        buffer._ensure_flusher = lambda: None
+
+        def fail(taken):
+            raise RuntimeError('database is down')
+
+        buffer._write = fail
+        xyz = np.zeros((4, 3), dtype=np.int16)
+        with self.assertLogs('masshealth.services.sensor_store', 'ERROR'):
+            for second in range(4):
+                buffer.add('d1', np.arange(4, dtype=np.int64) + second * 1000, xyz)
+        self.assertLess(buffer._buffered, 10)
+        self.assertEqual(sorted(start for _, start in buffer._windows), [2000, 3000])
+        self.assertEqual(registry.snapshot('sensor.')['sensor.dropped_samples'][''], 8)
+
+
+class StepAnalyticsTests(TestCase):
+    def test_first_steps_of_a_day_match_a_continuous_run(self):
+        day = datetime.date(2026, 3, 2)
+        day_start, _ = step_analytics._day_bounds_ms(day)
+        # 50 Hz square wave, 200 ms above the threshold in every 400 ms, straddling midnight
+        timestamps = np.arange(day_start - 1500, day_start + 1500, 20, dtype=np.int64)
+        xyz = np.zeros((len(timestamps), 3), dtype=np.int16)
+        xyz[(timestamps - day_start + 100) % 400 < 200, 2] = 2000
+        today = timestamps >= day_start
+        for chunk_day, keep in ((day - datetime.timedelta(days=1), ~today), (day, today)):
+            SensorChunk.objects.create(
+                device_id='d1',
+                day=chunk_day,
+                start_ms=int(timestamps[keep][0]),
+                end_ms=int(timestamps[keep][-1]),
+                sample_count=int(keep.sum()),
+                data=encode_chunk(timestamps[keep] - timestamps[keep][0], xyz[keep]),
+            )
+
+        expected = int((step_analytics.analyze(timestamps, xyz) >= day_start).sum())
+        # Without the previous day's tail the filter starts cold and finds an extra step
+        self.assertNotEqual(len(step_analytics.analyze(timestamps[today], xyz[today])), expected)
+        self.assertEqual(step_analytics.analyze_day('d1', day).steps, expected)
@@ -83,14 +83,38 @@ interface UserData {
   is_active: boolean;
 }
 
+interface CompressionStats {
+  compressed: boolean;
+  original_size: number;
+  compressed_size: number;
+  ratio: number;
+  savings_percent: number;
+  error: string | null;
+}
+
+interface SoundPeaks {
+  sample_rate: number;
+  samples_per_pixel: number;
+  length: number;
+  data: number[];
+}
+
 interface Sound {
   id: string;
   name: string;
   file_url: string;
+  stream_url: string | null;
+  preview_url: string | null;
+  peaks: SoundPeaks | null;
   duration: number;
   created_at: string;
+  status: "pending" | "processing" | "ready" | "failed";
+  compression: CompressionStats | null;
+  error: string | null;
 }
 
+const SOUND_STATUS_POLL_MS = 2000;
+
 interface Exercise {
   id: number;
   name: string;
@@ -583,16 +607,31 @@ function UsersTab() {
   const [users, setUsers] = useState<UserData[]>([]);
   const [loading, setLoading] = useState(true);
   const [search, setSearch] = useState("");
+  const [query, setQuery] = useState("");
+  // Keyset pagination: cursors[i] fetches page i + 1, the first page has none
+  const [cursors, setCursors] = useState<(string | null)[]>([null]);
   const [page, setPage] = useState(1);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [totalPages, setTotalPages] = useState(1);
   const [total, setTotal] = useState(0);
   const [editingUser, setEditingUser] = useState<UserData | null>(null);
 
+  // Search runs on the server, debounced, and restarts from the first page
+  useEffect(() => {
+    const timeout = setTimeout(() => {
+      setQuery(search.trim());
+      setCursors([null]);
+      setPage(1);
+    }, 300);
+    return () => clearTimeout(timeout);
+  }, [search]);
+
   const fetchUsers = useCallback(async () => {
     setLoading(true);
     try {
-      const response = await api.listAllUsers(page, 10);
+      const response = await api.listAllUsers({ cursor: cursors[page - 1], perPage: 10, search: query });
       setUsers(response.data.users || []);
+      setNextCursor(response.data.next_cursor || null);
       setTotalPages(response.data.total_pages || 1);
       setTotal(response.data.total || 0);
     } catch (err) {
@@ -601,17 +640,17 @@ function UsersTab() {
     } finally {
       setLoading(false);
     }
-  }, [page]);
+  }, [cursors, page, query]);
 
   useEffect(() => {
     fetchUsers();
   }, [fetchUsers]);
 
-  const filteredUsers = users.filter(
-    (user) =>
-      user.email.toLowerCase().includes(search.toLowerCase()) ||
-      user.full_name?.toLowerCase().includes(search.toLowerCase())
-  );
+  const goToNextPage = () => {
+    if (!nextCursor) return;
+    setCursors((prev) => [...prev.slice(0, page), nextCursor]);
+    setPage((p) => p + 1);
+  };
 
   const handleDeleteUser = async (userId: number) => {
     if (!confirm("Are you sure you want to delete this user?")) return;
@@ -693,7 +732,7 @@ function UsersTab() {
                   </tr>
                 </thead>
                 <tbody>
-                  {filteredUsers.map((user) => (
+                  {users.map((user) => (
                     <tr
                       key={user.id}
                       className="border-b border-gray-50 hover:bg-gray-50"
@@ -794,8 +833,8 @@ function UsersTab() {
                   <ChevronLeft className="w-4 h-4" />
                 </button>
                 <button
-                  onClick={() => setPage((p) => Math.min(totalPages, p + 1))}
-                  disabled={page === totalPages}
+                  onClick={goToNextPage}
+                  disabled={!nextCursor}
                   className="p-2 border border-gray-200 rounded-lg hover:bg-gray-50 disabled:opacity-50 disabled:cursor-not-allowed"
                 >
                   <ChevronRight className="w-4 h-4" />
@@ -1328,7 +1367,24 @@ function SoundsTab() {
       formData.append("discard_m", discardM.toString());
       const response = await api.uploadSound(formData);
 
-      const comp = response.data.compression;
+      setShowUploadModal(false);
+      setUploadFile(null);
+      setUploadName("");
+      setBlockSizeN(1024);
+      setDiscardM(100);
+      fetchSounds();
+
+      // Processing runs in the background; poll until it finishes
+      let sound: Sound = response.data;
+      while (sound.status === "pending" || sound.status === "processing") {
+        await new Promise((resolve) => setTimeout(resolve, SOUND_STATUS_POLL_MS));
+        sound = (await api.getSoundStatus(sound.id)).data;
+      }
+
+      if (sound.status === "failed") {
+        alert(`Processing failed\n\n${sound.error || "Unknown error"}`);
+      }
+      const comp = sound.compression;
       if (comp) {
         if (comp.compressed) {
           alert(
@@ -1349,11 +1405,6 @@ function SoundsTab() {
         }
       }
 
-      setShowUploadModal(false);
-      setUploadFile(null);
-      setUploadName("");
-      setBlockSizeN(1024);
-      setDiscardM(100);
       fetchSounds();
     } catch (err) {
       console.error("Failed to upload sound:", err);
@@ -1368,7 +1419,7 @@ function SoundsTab() {
       audioRef.current?.pause();
       setPlayingId(null);
     } else if (audioRef.current) {
-      audioRef.current.src = sound.file_url;
+      audioRef.current.src = sound.stream_url ?? sound.file_url;
       audioRef.current.play();
       setPlayingId(sound.id);
     }
@@ -1431,7 +1482,11 @@ function SoundsTab() {
                     {sound.name}
                   </p>
                   <p className="text-sm text-gray-500">
-                    {formatDuration(sound.duration)}
+                    {sound.status === "ready"
+                      ? formatDuration(sound.duration)
+                      : sound.status === "failed"
+                      ? "Processing failed"
+                      : "Processing..."}
                   </p>
                 </div>
                 <button
@@ -58,7 +58,14 @@ const api = {
   checkAdmin: () => apiClient.get('/api/auth/admin/check/'),
   getDashboardStats: () => apiClient.get('/api/auth/admin/stats/'),
   listAdmins: () => apiClient.get('/api/auth/admin/list/'),
-  listAllUsers: (page = 1, perPage = 20) => apiClient.get(`/api/auth/admin/users/?page=${page}&per_page=${perPage}`),
+  listAllUsers: (params: { cursor?: string | null; perPage?: number; search?: string } = {}) =>
+    apiClient.get('/api/auth/admin/users/', {
+      params: {
+        per_page: params.perPage ?? 20,
+        ...(params.cursor ? { cursor: params.cursor } : {}),
+        ...(params.search ? { search: params.search } : {}),
+      },
+    }),
   createAdmin: (data: { email: string; password: string; full_name: string; username: string; is_superuser?: boolean }) => apiClient.post('/api/auth/admin/create/', data),
   promoteToAdmin: (userId: number, isSuperuser = false) => apiClient.post(`/api/auth/admin/promote/${userId}/`, { is_superuser: isSuperuser }),
   demoteAdmin: (userId: number) => apiClient.post(`/api/auth/admin/demote/${userId}/`),
@@ -68,6 +75,7 @@ const api = {
 
   getSounds: () => apiClient.get('/api/auth/admin/sounds/'),
   uploadSound: (formData: FormData) => apiClient.post('/api/auth/admin/sounds/upload/', formData, { headers: { 'Content-Type': 'multipart/form-data' } }),
+  getSoundStatus: (soundId: string) => apiClient.get(`/api/auth/admin/sounds/${soundId}/status/`),
   deleteSound: (soundId: string) => apiClient.delete(`/api/auth/admin/sounds/${soundId}/`),
 
   importExercises: (exercises: object[]) => apiClient.post('/api/auth/admin/exercises/import/', { exercises }),